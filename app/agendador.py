@@ -0,0 +1,238 @@
+"""
+Agendador de tarefas periódicas (asyncio), iniciado no lifespan do FastAPI.
+
+- `a_cada(segundos)` para tarefas por intervalo e `cron("m h dom mes dow")` para horários fixos;
+- a função da tarefa é síncrona e roda numa thread (não trava o event loop);
+- cada execução pega um lock de arquivo que também guarda a hora da última
+  execução: com vários workers do uvicorn na mesma máquina, só um executa a
+  tarefa naquele ciclo;
+- duração, execuções e falhas ficam em `metricas()`.
+"""
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem lock entre processos
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+AGENDADOR_LOCK_DIR = os.getenv("AGENDADOR_LOCK_DIR", "/tmp")
+AGENDADOR_ATIVO = os.getenv("AGENDADOR_ATIVO", "1") == "1"
+
+
+# --- CRON ---
+
+def _campo_cron(expr: str, minimo: int, maximo: int) -> set:
+    valores = set()
+    for parte in expr.split(","):
+        passo = 1
+        if "/" in parte:
+            parte, p = parte.split("/")
+            passo = int(p)
+        if parte == "*":
+            ini, fim = minimo, maximo
+        elif "-" in parte:
+            a, b = parte.split("-")
+            ini, fim = int(a), int(b)
+        else:
+            ini = int(parte)
+            fim = ini if passo == 1 else maximo
+        valores.update(range(ini, fim + 1, passo))
+    return valores
+
+
+class Cron:
+    """Expressão cron de 5 campos: minuto hora dia mês dia_semana (0=domingo)."""
+
+    def __init__(self, expr: str):
+        partes = expr.split()
+        if len(partes) != 5:
+            raise ValueError(f"Cron inválido: {expr}")
+        self.expr = expr
+        self.minutos = _campo_cron(partes[0], 0, 59)
+        self.horas = _campo_cron(partes[1], 0, 23)
+        self.dias = _campo_cron(partes[2], 1, 31)
+        self.meses = _campo_cron(partes[3], 1, 12)
+        self.dias_semana = {d % 7 for d in _campo_cron(partes[4], 0, 7)}
+
+    def proxima(self, depois: datetime) -> datetime:
+        t = depois.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # no máximo um ano de busca, minuto a minuto pulando horas/dias inválidos
+        limite = t + timedelta(days=366)
+        while t < limite:
+            if t.month not in self.meses or t.day not in self.dias or (t.weekday() + 1) % 7 not in self.dias_semana:
+                t = (t + timedelta(days=1)).replace(hour=0, minute=0)
+                continue
+            if t.hour not in self.horas:
+                t = (t + timedelta(hours=1)).replace(minute=0)
+                continue
+            if t.minute not in self.minutos:
+                t += timedelta(minutes=1)
+                continue
+            return t
+        raise ValueError(f"Cron sem próxima execução: {self.expr}")
+
+
+# --- TAREFAS ---
+
+@dataclass
+class Tarefa:
+    nome: str
+    funcao: Callable[[], None]
+    intervalo: Optional[float] = None
+    cron: Optional[Cron] = None
+    execucoes: int = 0
+    falhas: int = 0
+    puladas: int = 0
+    ultima_duracao_ms: Optional[float] = None
+    ultima_execucao: Optional[str] = None
+    ultimo_erro: Optional[str] = None
+    proxima_execucao: Optional[str] = None
+    duracoes_ms: List[float] = field(default_factory=list)
+
+    def segundos_ate_proxima(self) -> float:
+        if self.cron:
+            agora = datetime.now()
+            proxima = self.cron.proxima(agora)
+            self.proxima_execucao = proxima.isoformat()
+            return max(0.0, (proxima - agora).total_seconds())
+        self.proxima_execucao = (datetime.now() + timedelta(seconds=self.intervalo)).isoformat()
+        return self.intervalo
+
+
+class _LockArquivo:
+    """
+    Lock exclusivo não bloqueante por tarefa (vale entre processos da mesma máquina).
+    O arquivo guarda o timestamp da última execução, para que outro worker que
+    chegue logo depois no mesmo ciclo não repita a tarefa.
+    """
+
+    def __init__(self, nome: str, intervalo_minimo: float):
+        self.caminho = os.path.join(AGENDADOR_LOCK_DIR, f"javis-tarefa-{nome}.lock")
+        self.intervalo_minimo = intervalo_minimo
+        self._fd = None
+
+    def __enter__(self) -> bool:
+        if fcntl is None:
+            return True
+        self._fd = open(self.caminho, "a+")
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._fd.close()
+            self._fd = None
+            return False
+        self._fd.seek(0)
+        try:
+            ultima = float(self._fd.read().strip() or 0)
+        except ValueError:
+            ultima = 0.0
+        if time.time() - ultima < self.intervalo_minimo:
+            self.__exit__()
+            return False
+        self._fd.seek(0)
+        self._fd.truncate()
+        self._fd.write(str(time.time()))
+        self._fd.flush()
+        return True
+
+    def __exit__(self, *exc):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._fd.close()
+            self._fd = None
+
+
+class Agendador:
+    def __init__(self):
+        self._tarefas: Dict[str, Tarefa] = {}
+        self._loops: List[asyncio.Task] = []
+
+    def a_cada(self, segundos: float, nome: Optional[str] = None):
+        def decorador(funcao):
+            self._registrar(Tarefa(nome or funcao.__name__, funcao, intervalo=segundos))
+            return funcao
+        return decorador
+
+    def cron(self, expr: str, nome: Optional[str] = None):
+        def decorador(funcao):
+            self._registrar(Tarefa(nome or funcao.__name__, funcao, cron=Cron(expr)))
+            return funcao
+        return decorador
+
+    def _registrar(self, tarefa: Tarefa) -> None:
+        if tarefa.nome in self._tarefas:
+            raise ValueError(f"Tarefa duplicada: {tarefa.nome}")
+        self._tarefas[tarefa.nome] = tarefa
+
+    def _executar(self, tarefa: Tarefa) -> None:
+        # cron: um disparo por minuto; intervalo: um disparo por ciclo
+        intervalo_minimo = 55 if tarefa.cron else tarefa.intervalo * 0.9
+        with _LockArquivo(tarefa.nome, intervalo_minimo) as obtido:
+            if not obtido:
+                # outro worker já está rodando esta tarefa
+                tarefa.puladas += 1
+                return
+            inicio = time.perf_counter()
+            try:
+                tarefa.funcao()
+                tarefa.ultimo_erro = None
+            except Exception as e:
+                tarefa.falhas += 1
+                tarefa.ultimo_erro = str(e)
+                logger.exception(f"Erro na tarefa {tarefa.nome}: {e}")
+            finally:
+                duracao = round((time.perf_counter() - inicio) * 1000, 1)
+                tarefa.execucoes += 1
+                tarefa.ultima_duracao_ms = duracao
+                tarefa.ultima_execucao = datetime.now().isoformat()
+                tarefa.duracoes_ms = (tarefa.duracoes_ms + [duracao])[-50:]
+                logger.info(f"Tarefa {tarefa.nome} executada", extra={"rota": f"tarefa:{tarefa.nome}", "duracao_ms": duracao})
+
+    async def _loop(self, tarefa: Tarefa) -> None:
+        while True:
+            await asyncio.sleep(tarefa.segundos_ate_proxima())
+            await asyncio.to_thread(self._executar, tarefa)
+
+    async def iniciar(self) -> None:
+        if not AGENDADOR_ATIVO or self._loops:
+            return
+        for tarefa in self._tarefas.values():
+            self._loops.append(asyncio.create_task(self._loop(tarefa), name=f"tarefa:{tarefa.nome}"))
+        logger.info(f"Agendador iniciado com {len(self._loops)} tarefa(s)")
+
+    async def parar(self) -> None:
+        for t in self._loops:
+            t.cancel()
+        await asyncio.gather(*self._loops, return_exceptions=True)
+        self._loops = []
+
+    def metricas(self) -> List[dict]:
+        res = []
+        for t in self._tarefas.values():
+            media = round(sum(t.duracoes_ms) / len(t.duracoes_ms), 1) if t.duracoes_ms else None
+            res.append({
+                "nome": t.nome,
+                "tipo": "cron" if t.cron else "intervalo",
+                "agenda": t.cron.expr if t.cron else f"{t.intervalo}s",
+                "execucoes": t.execucoes,
+                "falhas": t.falhas,
+                "puladas": t.puladas,
+                "ultima_execucao": t.ultima_execucao,
+                "ultima_duracao_ms": t.ultima_duracao_ms,
+                "media_duracao_ms": media,
+                "max_duracao_ms": max(t.duracoes_ms) if t.duracoes_ms else None,
+                "ultimo_erro": t.ultimo_erro,
+                "proxima_execucao": t.proxima_execucao,
+            })
+        return res
+
+
+agendador = Agendador()
@@ -0,0 +1,242 @@
+"""
+Arquivo frio do chat: mensagens antigas saem de tb_chat/tb_chat_turma.
+
+O job `arquivar` pega as mensagens mais velhas que CHAT_ARQUIVO_DIAS e, qualquer
+que seja a idade, as de turmas encerradas há mais de CHAT_ARQUIVO_TURMA_DIAS
+(data_termino_real). Elas são agrupadas por conversa (aluno no privado, turma no
+grupo) e gravadas como segmentos JSON compactados (gzip) no Storage, com até
+CHAT_SEGMENTO_MAX mensagens cada. Cada noite completa o segmento mais novo da
+conversa antes de abrir outro, então uma conversa com poucas mensagens por dia
+não vira um segmento minúsculo por noite. Cada segmento ganha um ponteiro em
+`tb_chat_segmentos`, e só então as linhas saem da tabela quente (do índice de
+busca e, no privado, dos contadores de não lidas). As consultas do dia a dia
+passam a varrer só o que é recente.
+
+O histórico continua igual para quem está olhando o presente. Ao rolar para trás,
+o app pede `segmento_anterior(..., antes=<created_at mais antigo que já tem>)` e
+recebe o trecho arquivado imediatamente anterior. O filtro por idade e o de
+turma encerrada rodam em noites diferentes e podem gravar segmentos da mesma
+conversa com períodos sobrepostos; por isso a leitura junta todos os segmentos
+que se sobrepõem ao trecho e devolve tudo de [inicio do trecho, antes). O
+próximo `antes` é esse início, então nada sobreposto fica para trás. Segmentos
+nunca mudam no lugar (completar um grava outro caminho), então ficam em cache.
+
+Se o job cair entre gravar o segmento e apagar as linhas, a próxima execução
+arquiva de novo as que ficaram; a leitura remove repetidas pelo id.
+
+Colunas esperadas em tb_chat_segmentos: id, origem, chave, id_min, id_max,
+inicio, fim, qtd, caminho (unique), tamanho, criado_em.
+"""
+import gzip
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional
+
+from app import busca_chat, chat_nao_lidas
+from app.cache import cache
+
+logger = logging.getLogger(__name__)
+
+CHAT_ARQUIVO_BUCKET = os.getenv("CHAT_ARQUIVO_BUCKET", "chat-arquivo")
+CHAT_ARQUIVO_DIAS = int(os.getenv("CHAT_ARQUIVO_DIAS", "180"))
+CHAT_ARQUIVO_TURMA_DIAS = int(os.getenv("CHAT_ARQUIVO_TURMA_DIAS", "30"))
+CHAT_SEGMENTO_MAX = int(os.getenv("CHAT_SEGMENTO_MAX", "500"))
+SEGMENTO_CACHE_TTL = float(os.getenv("SEGMENTO_CACHE_TTL", "86400"))
+# trava de segurança na junção de segmentos sobrepostos
+SEGMENTOS_POR_LEITURA = 20
+
+# origem -> (tabela, coluna que identifica a conversa)
+ORIGENS = {
+    "privado": ("tb_chat", "id_aluno"),
+    "grupo": ("tb_chat_turma", "codigo_turma"),
+}
+
+
+def _compactar(mensagens: List[dict]) -> bytes:
+    return gzip.compress(json.dumps(mensagens, ensure_ascii=False, default=str).encode("utf-8"), compresslevel=9)
+
+
+def _descompactar(dados: bytes) -> List[dict]:
+    return json.loads(gzip.decompress(dados).decode("utf-8"))
+
+
+def _turmas_encerradas(cliente) -> List[str]:
+    limite = (datetime.now() - timedelta(days=CHAT_ARQUIVO_TURMA_DIAS)).date().isoformat()
+    resp = cliente.table("tb_turmas").select("codigo_turma")\
+        .not_.is_("data_termino_real", "null")\
+        .lt("data_termino_real", limite)\
+        .execute()
+    return [t["codigo_turma"] for t in resp.data or []]
+
+
+def _gravar_segmento(cliente, origem: str, chave: str, mensagens: List[dict]) -> str:
+    mensagens = sorted(mensagens, key=lambda m: (m.get("created_at") or "", m["id"]))
+    id_min = min(m["id"] for m in mensagens)
+    id_max = max(m["id"] for m in mensagens)
+    caminho = f"{origem}/{chave}/{id_min}-{id_max}.json.gz"
+    dados = _compactar(mensagens)
+
+    cliente.storage.from_(CHAT_ARQUIVO_BUCKET).upload(
+        caminho, dados, file_options={"content-type": "application/gzip", "upsert": "true"}
+    )
+    cliente.table("tb_chat_segmentos").upsert({
+        "origem": origem,
+        "chave": chave,
+        "id_min": id_min,
+        "id_max": id_max,
+        "inicio": mensagens[0].get("created_at"),
+        "fim": mensagens[-1].get("created_at"),
+        "qtd": len(mensagens),
+        "caminho": caminho,
+        "tamanho": len(dados),
+        "criado_em": datetime.now().isoformat(),
+    }, on_conflict="caminho").execute()
+    return caminho
+
+
+def _descartar_segmento(cliente, segmento: dict) -> None:
+    """Tira o ponteiro e o objeto de um segmento que foi regravado com mais mensagens."""
+    cliente.table("tb_chat_segmentos").delete().eq("caminho", segmento["caminho"]).execute()
+    cache.invalidar("chat_segmento", segmento["caminho"])
+    try:
+        cliente.storage.from_(CHAT_ARQUIVO_BUCKET).remove([segmento["caminho"]])
+    except Exception as e:
+        # sem ponteiro o objeto não é mais lido; sobra só espaço
+        logger.warning(f"Segmento antigo ficou no Storage ({segmento['caminho']}): {e}")
+
+
+def _arquivar_conversa(cliente, origem: str, chave: str, lista: List[dict]) -> None:
+    """
+    Acrescenta as mensagens ao segmento mais novo da conversa enquanto ele tiver
+    menos de CHAT_SEGMENTO_MAX; o resto vira segmentos novos. Segmento nunca muda
+    no lugar (o cache é por caminho): o completado é gravado num caminho novo e o
+    antigo sai depois. Se cair no meio, os dois coexistem e a leitura junta pelo id.
+    """
+    ultimo = cliente.table("tb_chat_segmentos").select("*").eq("origem", origem).eq("chave", chave)\
+        .order("id_max", desc=True).limit(1).execute().data or []
+    anterior = ultimo[0] if ultimo and (ultimo[0].get("qtd") or 0) < CHAT_SEGMENTO_MAX else None
+
+    ids = {m["id"] for m in lista}
+    if anterior:
+        lista = [m for m in _ler_segmento(cliente, anterior) if m["id"] not in ids] + lista
+    # as mais antigas completam o segmento anterior, na ordem em que serão lidas
+    lista.sort(key=lambda m: (m.get("created_at") or "", m["id"]))
+
+    caminhos = [
+        _gravar_segmento(cliente, origem, chave, lista[i:i + CHAT_SEGMENTO_MAX])
+        for i in range(0, len(lista), CHAT_SEGMENTO_MAX)
+    ]
+    if anterior and anterior["caminho"] not in caminhos:
+        _descartar_segmento(cliente, anterior)
+    elif anterior:
+        # mesmo caminho regravado (reexecução depois de uma queda): o cache tem a versão velha
+        cache.invalidar("chat_segmento", anterior["caminho"])
+
+
+def _arquivar_lote(cliente, origem: str, mensagens: Iterable[dict]) -> int:
+    tabela, coluna = ORIGENS[origem]
+    por_conversa: Dict[str, List[dict]] = {}
+    for m in mensagens:
+        if m.get(coluna) is not None:
+            por_conversa.setdefault(str(m[coluna]), []).append(m)
+
+    total = 0
+    for chave, lista in por_conversa.items():
+        _arquivar_conversa(cliente, origem, chave, lista)
+
+        # só depois do segmento e do ponteiro gravados a linha quente pode sair
+        ids = [m["id"] for m in lista]
+        for i in range(0, len(ids), 200):
+            cliente.table(tabela).delete().in_("id", ids[i:i + 200]).execute()
+        busca_chat.remover(cliente, origem, ids)
+        if origem == "privado":
+            # não lidas arquivadas deixam de contar nos badges
+            afetadas = [
+                chat_nao_lidas.conversa(m["id_aluno"], m.get("id_colaborador"), bool(m.get("enviado_por_admin")))
+                for m in lista if not m.get("lida")
+            ]
+            if afetadas:
+                chat_nao_lidas.recalcular(cliente, afetadas)
+        total += len(lista)
+    return total
+
+
+def arquivar(cliente, lote: int = 2000, max_lotes: int = 50) -> Dict[str, int]:
+    """Move para o arquivo frio o que passou da idade ou é de turma encerrada."""
+    corte = (datetime.now() - timedelta(days=CHAT_ARQUIVO_DIAS)).isoformat()
+    encerradas = _turmas_encerradas(cliente)
+    resultado = {}
+
+    for origem, (tabela, _) in ORIGENS.items():
+        total = 0
+        filtros = [lambda q: q.lt("created_at", corte)]
+        if encerradas:
+            filtros.append(lambda q: q.in_("codigo_turma", encerradas))
+        for filtro in filtros:
+            ultimo = 0
+            for _ in range(max_lotes):
+                pagina = filtro(cliente.table(tabela).select("*")).gt("id", ultimo).order("id").limit(lote).execute().data or []
+                if not pagina:
+                    break
+                total += _arquivar_lote(cliente, origem, pagina)
+                ultimo = pagina[-1]["id"]
+                if len(pagina) < lote:
+                    break
+        resultado[origem] = total
+    return resultado
+
+
+# --- LEITURA ---
+
+def _ler_segmento(cliente, segmento: dict) -> List[dict]:
+    def baixar():
+        return _descompactar(cliente.storage.from_(CHAT_ARQUIVO_BUCKET).download(segmento["caminho"]))
+    return cache.obter("chat_segmento", segmento["caminho"], baixar, SEGMENTO_CACHE_TTL)
+
+
+def segmento_anterior(cliente, origem: str, chave: Any, antes: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Mensagens arquivadas imediatamente anteriores a `antes` (o created_at mais
+    antigo que o app já mostra; None = o trecho mais recente), já juntando os
+    segmentos sobrepostos.
+    """
+    def segmentos():
+        query = cliente.table("tb_chat_segmentos").select("*").eq("origem", origem).eq("chave", str(chave))
+        return query.lt("inicio", antes) if antes else query
+
+    # o segmento que chega mais perto de `antes` define o trecho...
+    segs = segmentos().order("fim", desc=True).order("id_max", desc=True).limit(1).execute().data or []
+    if not segs:
+        return {"mensagens": [], "tem_mais": False, "antes": None}
+
+    # ...e todo segmento que alcança o trecho entra junto, até o início parar de recuar
+    por_caminho = {segs[0]["caminho"]: segs[0]}
+    inicio = segs[0]["inicio"]
+    while len(por_caminho) < SEGMENTOS_POR_LEITURA:
+        sobrepostos = segmentos().gte("fim", inicio).order("inicio").limit(SEGMENTOS_POR_LEITURA).execute().data or []
+        novos = [g for g in sobrepostos if g["caminho"] not in por_caminho]
+        if not novos:
+            break
+        por_caminho.update({g["caminho"]: g for g in novos})
+        inicio = min(inicio, *(g["inicio"] for g in novos))
+
+    vistas = set()
+    mensagens = []
+    for seg in por_caminho.values():
+        for m in _ler_segmento(cliente, seg):
+            criada = m.get("created_at") or ""
+            if m["id"] not in vistas and criada >= inicio and (not antes or criada < antes):
+                vistas.add(m["id"])
+                mensagens.append(m)
+    mensagens.sort(key=lambda m: (m.get("created_at") or "", m["id"]))
+
+    mais = cliente.table("tb_chat_segmentos").select("id").eq("origem", origem).eq("chave", str(chave))\
+        .lt("inicio", inicio).limit(1).execute().data
+    return {
+        "mensagens": mensagens,
+        "tem_mais": bool(mais),
+        # próximo `antes` para continuar rolando
+        "antes": inicio,
+    }
@@ -0,0 +1,277 @@
+"""
+Busca textual no histórico do chat (tb_chat e tb_chat_turma) por índice invertido.
+
+`tb_chat_termos` guarda uma linha por (termo, origem, id_mensagem), com as
+colunas de filtro copiadas da mensagem (id_aluno, codigo_turma, id_unidade,
+created_at). Os termos são normalizados: minúsculas, sem acento, sem stopwords,
+então "Boleto", "boleto" e "BOLETOS?" caem no mesmo lugar ("boletos" só casa por
+prefixo, ver abaixo).
+
+O índice é incremental: `indexar` lê só as mensagens com id acima do cursor de
+cada origem (`tb_chat_termos_cursor`) e é chamado pelo agendador a cada poucos
+segundos, o que cobre todos os lugares que gravam mensagens sem precisar de
+gancho em cada um. Ids vêm de uma sequência, mas transações concorrentes podem
+confirmar fora da ordem (o gravador em lote num worker, um insert direto em
+outro): um id menor que aparece depois do cursor passar nunca seria lido. Por
+isso o cursor só avança sobre mensagens com mais de BUSCA_INDEXAR_MARGEM
+segundos; a primeira mais nova que isso para o lote e fica para a próxima rodada.
+
+Na busca, cada termo vira uma consulta por igualdade (o último também por
+prefixo, para a busca enquanto digita); as listas vêm em paralelo, são
+interseccionadas e só as mensagens que sobram são lidas. Cada lista é lida em
+páginas de POSTINGS_PAGINA (o max-rows do PostgREST corta calado acima disso) até
+as BUSCA_MAX_POSTINGS ocorrências mais recentes do termo; se algum termo bate no
+teto, mensagens mais antigas podem faltar e `info["truncada"]` avisa.
+
+Colunas esperadas: tb_chat_termos (termo, origem, id_mensagem, id_aluno,
+codigo_turma, id_unidade, created_at), unique (termo, origem, id_mensagem),
+índices em (termo, created_at) com text_pattern_ops para o prefixo;
+tb_chat_termos_cursor (origem PK, ultimo_id).
+"""
+import logging
+import os
+import re
+import unicodedata
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from app import paralelo
+
+logger = logging.getLogger(__name__)
+
+BUSCA_MAX_POSTINGS = int(os.getenv("BUSCA_MAX_POSTINGS", "5000"))
+BUSCA_INDEXAR_MARGEM = float(os.getenv("BUSCA_INDEXAR_MARGEM", "60"))
+# max-rows padrão do PostgREST: páginas maiores voltariam cortadas
+POSTINGS_PAGINA = 1000
+TERMO_MIN = 2
+TERMO_MAX = 40
+
+# origem -> (tabela, colunas lidas para indexar)
+ORIGENS = {
+    "privado": ("tb_chat", "id, id_aluno, codigo_turma, mensagem, created_at, tb_alunos(id_unidade)"),
+    "grupo": ("tb_chat_turma", "id, codigo_turma, mensagem, created_at"),
+}
+
+STOPWORDS = frozenset("""
+a o e é as os um uma uns umas de do da dos das no na nos nas em ao aos à às
+por pra para pelo pela pelos pelas com sem que se sua seu suas seus meu minha
+me te lhe nos vos ele ela eles elas eu tu voce voces isso isto esse essa este
+esta aquele aquela ja nao sim mas ou mais muito muita tem ter foi ser sao era
+como quando onde qual quais tambem so ai la aqui entao oi ola ok
+""".split())
+
+_NAO_PALAVRA = re.compile(r"[^a-z0-9]+")
+
+
+def normalizar(texto: Optional[str]) -> str:
+    texto = unicodedata.normalize("NFKD", texto or "").encode("ascii", "ignore").decode("ascii")
+    return texto.lower()
+
+
+def termos(texto: Optional[str]) -> List[str]:
+    """Termos distintos do texto, na ordem em que aparecem."""
+    vistos = []
+    for t in _NAO_PALAVRA.split(normalizar(texto)):
+        if TERMO_MIN <= len(t) <= TERMO_MAX and t not in STOPWORDS and t not in vistos:
+            vistos.append(t)
+    return vistos
+
+
+# --- INDEXAÇÃO ---
+
+def _cursor(cliente, origem: str) -> int:
+    resp = cliente.table("tb_chat_termos_cursor").select("ultimo_id").eq("origem", origem).limit(1).execute()
+    return resp.data[0]["ultimo_id"] if resp.data else 0
+
+
+def _unidades_turmas(cliente, codigos: Iterable[str]) -> Dict[str, Any]:
+    codigos = list({c for c in codigos if c})
+    if not codigos:
+        return {}
+    resp = cliente.table("tb_turmas").select("codigo_turma, id_unidade").in_("codigo_turma", codigos).execute()
+    return {t["codigo_turma"]: t.get("id_unidade") for t in resp.data or []}
+
+
+def _postings(origem: str, mensagens: List[dict], unidade_turma: Dict[str, Any]) -> List[dict]:
+    linhas = []
+    for m in mensagens:
+        if origem == "privado":
+            id_unidade = (m.get("tb_alunos") or {}).get("id_unidade")
+        else:
+            id_unidade = unidade_turma.get(m.get("codigo_turma"))
+        for termo in termos(m.get("mensagem")):
+            linhas.append({
+                "termo": termo,
+                "origem": origem,
+                "id_mensagem": m["id"],
+                "id_aluno": m.get("id_aluno"),
+                "codigo_turma": m.get("codigo_turma"),
+                "id_unidade": id_unidade,
+                "created_at": m.get("created_at"),
+            })
+    return linhas
+
+
+def _assentada(mensagem: dict, corte: datetime) -> bool:
+    """Criada antes do corte (transações mais velhas que isso já confirmaram)."""
+    try:
+        criada = datetime.fromisoformat(str(mensagem.get("created_at")).replace("Z", "+00:00"))
+    except ValueError:
+        return True
+    if criada.tzinfo is None:
+        criada = criada.replace(tzinfo=timezone.utc)
+    return criada < corte
+
+
+def indexar(cliente, lote: int = 500, max_lotes: int = 20) -> int:
+    """Indexa as mensagens novas de cada origem. Devolve quantas mensagens leu."""
+    total = 0
+    corte = datetime.now(timezone.utc) - timedelta(seconds=BUSCA_INDEXAR_MARGEM)
+    for origem, (tabela, colunas) in ORIGENS.items():
+        ultimo = _cursor(cliente, origem)
+        for _ in range(max_lotes):
+            pagina = cliente.table(tabela).select(colunas)\
+                .gt("id", ultimo).order("id").limit(lote).execute().data or []
+            # só o prefixo já assentado: o cursor não pode passar de uma mensagem recente
+            mensagens = []
+            for m in pagina:
+                if not _assentada(m, corte):
+                    break
+                mensagens.append(m)
+            if not mensagens:
+                break
+            unidade_turma = _unidades_turmas(cliente, (m.get("codigo_turma") for m in mensagens)) if origem == "grupo" else {}
+            linhas = _postings(origem, mensagens, unidade_turma)
+            for i in range(0, len(linhas), 1000):
+                cliente.table("tb_chat_termos").upsert(
+                    linhas[i:i + 1000], on_conflict="termo,origem,id_mensagem", ignore_duplicates=True
+                ).execute()
+            ultimo = mensagens[-1]["id"]
+            # o cursor só avança depois dos termos gravados: falha no meio reindexa (upsert ignora repetidos)
+            cliente.table("tb_chat_termos_cursor").upsert({"origem": origem, "ultimo_id": ultimo}, on_conflict="origem").execute()
+            total += len(mensagens)
+            if len(mensagens) < lote:
+                break
+    return total
+
+
+def remover(cliente, origem: str, ids_mensagens: List[int]) -> None:
+    """Tira do índice mensagens que saíram da tabela (apagadas ou arquivadas)."""
+    for i in range(0, len(ids_mensagens), 200):
+        cliente.table("tb_chat_termos").delete().eq("origem", origem).in_("id_mensagem", ids_mensagens[i:i + 200]).execute()
+
+
+# --- BUSCA ---
+
+Chave = Tuple[str, int]
+
+
+def buscar(
+    cliente,
+    q: str,
+    *,
+    id_aluno: Optional[int] = None,
+    codigo_turma: Optional[str] = None,
+    data_ini: Optional[str] = None,
+    data_fim: Optional[str] = None,
+    id_unidade: Optional[int] = None,
+    alunos_permitidos: Optional[Set[int]] = None,
+    turmas_permitidas: Optional[Set[str]] = None,
+    limite: int = 50,
+    info: Optional[Dict[str, Any]] = None,
+) -> List[dict]:
+    """
+    Mensagens que contêm todos os termos de `q`, mais recentes primeiro.
+    `id_unidade`/`alunos_permitidos`/`turmas_permitidas` aplicam o escopo de quem busca
+    (None = sem restrição por aquele critério). Se `info` for passado, recebe
+    "truncada": algum termo passou de BUSCA_MAX_POSTINGS ocorrências.
+    """
+    lista = termos(q)
+    if not lista:
+        return []
+
+    def consulta(termo: str, prefixo: bool):
+        def montar():
+            query = cliente.table("tb_chat_termos").select("origem, id_mensagem, id_aluno, codigo_turma, created_at")
+            query = query.like("termo", f"{termo}%") if prefixo else query.eq("termo", termo)
+            if id_aluno:
+                query = query.eq("id_aluno", id_aluno)
+            if codigo_turma:
+                query = query.eq("codigo_turma", codigo_turma)
+            if id_unidade:
+                query = query.eq("id_unidade", id_unidade)
+            if data_ini:
+                query = query.gte("created_at", data_ini)
+            if data_fim:
+                query = query.lte("created_at", f"{data_fim}T23:59:59" if len(data_fim) == 10 else data_fim)
+            return query.order("created_at", desc=True).order("id_mensagem", desc=True)
+
+        def executar():
+            postings: List[dict] = []
+            while len(postings) < BUSCA_MAX_POSTINGS:
+                ini = len(postings)
+                fim = min(ini + POSTINGS_PAGINA, BUSCA_MAX_POSTINGS) - 1
+                pagina = montar().range(ini, fim).execute().data or []
+                postings.extend(pagina)
+                if len(pagina) < fim - ini + 1:
+                    return postings, False
+            return postings, True
+        return executar
+
+    ultimo = len(lista) - 1
+    listas = paralelo.reunir(**{
+        f"t{i}": consulta(t, prefixo=(i == ultimo and len(t) >= 3))
+        for i, t in enumerate(lista)
+    })
+
+    if info is not None:
+        info["truncada"] = any(listas[f"t{i}"][1] for i in range(len(lista)))
+        if info["truncada"]:
+            logger.warning(f"Busca no chat truncada em {BUSCA_MAX_POSTINGS} ocorrências por termo: {q!r}")
+
+    encontrados: Optional[Dict[Chave, dict]] = None
+    for i in range(len(lista)):
+        atual = {(p["origem"], p["id_mensagem"]): p for p in listas[f"t{i}"][0]}
+        encontrados = atual if encontrados is None else {k: v for k, v in encontrados.items() if k in atual}
+        if not encontrados:
+            return []
+
+    def permitido(p: dict) -> bool:
+        if p["origem"] == "privado":
+            return alunos_permitidos is None or p.get("id_aluno") in alunos_permitidos
+        return turmas_permitidas is None or p.get("codigo_turma") in turmas_permitidas
+
+    achados = sorted((p for p in encontrados.values() if permitido(p)), key=lambda p: p["created_at"] or "", reverse=True)[:limite]
+    return _carregar_mensagens(cliente, achados)
+
+
+def _carregar_mensagens(cliente, achados: List[dict]) -> List[dict]:
+    ids = {"privado": [], "grupo": []}
+    for p in achados:
+        ids[p["origem"]].append(p["id_mensagem"])
+
+    r = paralelo.reunir(
+        privado=lambda: cliente.table("tb_chat").select("*, tb_alunos(nome_completo)")
+            .in_("id", ids["privado"]).execute().data if ids["privado"] else [],
+        grupo=lambda: cliente.table("tb_chat_turma").select("*")
+            .in_("id", ids["grupo"]).execute().data if ids["grupo"] else [],
+    )
+    por_chave = {("privado", m["id"]): m for m in r["privado"] or []}
+    por_chave.update({("grupo", m["id"]): m for m in r["grupo"] or []})
+
+    resultado = []
+    for p in achados:
+        m = por_chave.get((p["origem"], p["id_mensagem"]))
+        if not m:
+            continue  # apagada depois de indexada
+        resultado.append({
+            "origem": p["origem"],
+            "id": m["id"],
+            "id_aluno": m.get("id_aluno"),
+            "nome_aluno": (m.get("tb_alunos") or {}).get("nome_completo"),
+            "codigo_turma": m.get("codigo_turma"),
+            "autor": m.get("nome_exibicao"),
+            "mensagem": m.get("mensagem"),
+            "created_at": m.get("created_at"),
+        })
+    return resultado
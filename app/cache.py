@@ -0,0 +1,420 @@
+"""
+Cache compartilhado com backends intercambiáveis.
+
+Backends (CACHE_BACKEND):
+- "memoria": LRU dentro do processo (padrão; cada worker tem o seu);
+- "mmap":    tabela de slots num arquivo mapeado em memória, compartilhada por
+             todos os workers da mesma máquina (CACHE_MMAP_ARQUIVO);
+- "redis":   qualquer servidor que fale o protocolo Redis (CACHE_REDIS_URL).
+
+As chaves são agrupadas por namespace ("cursos", "calendario", "contexto"...).
+Invalidar um namespace inteiro é trocar a versão dele no backend: as chaves
+antigas simplesmente deixam de ser encontradas.
+
+Com backend compartilhado cada worker mantém ainda um L1 local bem curto; as
+invalidações são publicadas num barramento (arquivo mmap ou pub/sub do Redis)
+para que os outros workers descartem o L1 na hora.
+"""
+import copy
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+from app.singleflight import SingleFlight
+
+try:
+    import fcntl
+except ImportError:  # Windows: backend mmap indisponível
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+FALTA = object()
+
+
+# --- BACKENDS ---
+
+class CacheMemoria:
+    """LRU com TTL por item, seguro entre threads."""
+
+    compartilhado = False
+
+    def __init__(self, max_itens: int = 5000):
+        self.max_itens = max_itens
+        self._lock = threading.Lock()
+        self._itens: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, chave: str) -> Any:
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is None:
+                return FALTA
+            expira, valor = item
+            if expira and expira < time.time():
+                del self._itens[chave]
+                return FALTA
+            self._itens.move_to_end(chave)
+            return valor
+
+    def set(self, chave: str, valor: Any, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._itens[chave] = (time.time() + ttl if ttl else 0, valor)
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+
+    def delete(self, chave: str) -> None:
+        with self._lock:
+            self._itens.pop(chave, None)
+
+    def delete_prefixo(self, prefixo: str) -> None:
+        with self._lock:
+            for chave in [c for c in self._itens if c.startswith(prefixo)]:
+                del self._itens[chave]
+
+
+class CacheMmap:
+    """
+    Tabela hash de tamanho fixo num arquivo mapeado em memória.
+    Cada slot: hash da chave (8) + expiração (8) + tamanho (4) + pickle((chave, valor))
+    comprimido com zlib.
+    Colisão sobrescreve (é cache); valor maior que o slot (CACHE_MMAP_SLOT_BYTES,
+    16 KB comprimido por padrão) não é guardado e gera um aviso no log, uma vez
+    por namespace: árvores de curso grandes pedem um slot maior.
+    Leitura/escrita de cada slot é protegida por lockf só naquela faixa do arquivo.
+    O lockf é do processo, não da thread (duas threads do mesmo worker não se
+    excluem e o LOCK_UN de uma solta o da outra), então um threading.Lock da
+    instância envolve cada acesso. Slot ilegível (escrita rasgada) vira FALTA.
+    """
+
+    compartilhado = True
+    _CABECALHO = struct.Struct("<QdI")
+
+    def __init__(self, caminho: str, slots: int = 4096, bytes_slot: int = 16384):
+        if fcntl is None:
+            raise RuntimeError("Backend mmap requer fcntl (Linux/macOS)")
+        self.slots = slots
+        self.bytes_slot = bytes_slot
+        tamanho = slots * bytes_slot
+        self._fd = os.open(caminho, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size != tamanho:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size != tamanho:
+                    os.ftruncate(self._fd, tamanho)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._mm = mmap.mmap(self._fd, tamanho)
+        self._lock = threading.Lock()
+        self._avisados: set = set()
+
+    def _slot(self, chave: str):
+        h = zlib.crc32(chave.encode()) | (len(chave) << 32)
+        return h, (h % self.slots) * self.bytes_slot
+
+    def get(self, chave: str) -> Any:
+        h, inicio = self._slot(chave)
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_SH, self.bytes_slot, inicio)
+            try:
+                hash_slot, expira, tamanho = self._CABECALHO.unpack_from(self._mm, inicio)
+                if hash_slot != h or not tamanho or tamanho > self.bytes_slot - self._CABECALHO.size:
+                    return FALTA
+                dados = self._mm[inicio + self._CABECALHO.size: inicio + self._CABECALHO.size + tamanho]
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.bytes_slot, inicio)
+        if expira and expira < time.time():
+            return FALTA
+        try:
+            chave_slot, valor = pickle.loads(zlib.decompress(dados))
+        except (zlib.error, pickle.UnpicklingError, EOFError, ValueError) as e:
+            logger.warning(f"Slot do cache mmap ilegível (tratado como ausente): {e}")
+            return FALTA
+        return valor if chave_slot == chave else FALTA
+
+    def set(self, chave: str, valor: Any, ttl: Optional[float] = None) -> None:
+        dados = zlib.compress(pickle.dumps((chave, valor), protocol=pickle.HIGHEST_PROTOCOL), 1)
+        if len(dados) + self._CABECALHO.size > self.bytes_slot:
+            namespace = chave.split(":", 1)[0]
+            if namespace not in self._avisados:
+                self._avisados.add(namespace)
+                logger.warning(
+                    f"Valor de {len(dados)} bytes não cabe no slot do cache mmap ({self.bytes_slot}); "
+                    f"namespace '{namespace}' fica sem cache compartilhado (aumente CACHE_MMAP_SLOT_BYTES)"
+                )
+            return
+        h, inicio = self._slot(chave)
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.bytes_slot, inicio)
+            try:
+                self._CABECALHO.pack_into(self._mm, inicio, h, time.time() + ttl if ttl else 0, len(dados))
+                self._mm[inicio + self._CABECALHO.size: inicio + self._CABECALHO.size + len(dados)] = dados
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.bytes_slot, inicio)
+
+    def delete(self, chave: str) -> None:
+        h, inicio = self._slot(chave)
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.bytes_slot, inicio)
+            try:
+                hash_slot, _, _ = self._CABECALHO.unpack_from(self._mm, inicio)
+                if hash_slot == h:
+                    self._CABECALHO.pack_into(self._mm, inicio, 0, 0, 0)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.bytes_slot, inicio)
+
+
+class CacheRedis:
+    """Valores serializados com pickle num servidor Redis (ou compatível)."""
+
+    compartilhado = True
+
+    def __init__(self, url: str, prefixo: str = "javis:cache:"):
+        import redis  # dependência opcional, só quando CACHE_BACKEND=redis
+
+        self.cliente = redis.Redis.from_url(url)
+        self.prefixo = prefixo
+
+    def get(self, chave: str) -> Any:
+        dados = self.cliente.get(self.prefixo + chave)
+        return FALTA if dados is None else pickle.loads(dados)
+
+    def set(self, chave: str, valor: Any, ttl: Optional[float] = None) -> None:
+        dados = pickle.dumps(valor, protocol=pickle.HIGHEST_PROTOCOL)
+        self.cliente.set(self.prefixo + chave, dados, px=int(ttl * 1000) if ttl else None)
+
+    def delete(self, chave: str) -> None:
+        self.cliente.delete(self.prefixo + chave)
+
+
+# --- BARRAMENTO DE INVALIDAÇÃO ---
+
+class BarramentoLocal:
+    """Só o próprio processo (backend memória não precisa avisar ninguém)."""
+
+    def __init__(self):
+        self._ouvintes = []
+
+    def ouvir(self, callback: Callable[[str, Optional[str]], None]) -> None:
+        self._ouvintes.append(callback)
+
+    def publicar(self, ns: str, chave: Optional[str]) -> None:
+        for cb in self._ouvintes:
+            cb(ns, chave)
+
+
+class BarramentoArquivo(BarramentoLocal):
+    """
+    Anel de mensagens num arquivo mmap: publicar escreve no próximo slot e
+    incrementa a sequência; cada worker lê as novas mensagens a cada 0,5 s.
+    Se um worker ficar para trás mais que o tamanho do anel, descarta tudo.
+    """
+
+    _TAM_MSG = 256
+    _QTD_MSGS = 512
+    _SEQ = struct.Struct("<Q")
+
+    def __init__(self, caminho: str):
+        super().__init__()
+        tamanho = self._SEQ.size + self._TAM_MSG * self._QTD_MSGS
+        self._fd = os.open(caminho, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size != tamanho:
+                os.ftruncate(self._fd, tamanho)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._mm = mmap.mmap(self._fd, tamanho)
+        self._origem = uuid.uuid4().hex[:8]
+        self._lida = self._SEQ.unpack_from(self._mm, 0)[0]
+        threading.Thread(target=self._escutar, name="cache-barramento", daemon=True).start()
+
+    def publicar(self, ns: str, chave: Optional[str]) -> None:
+        super().publicar(ns, chave)
+        msg = pickle.dumps((self._origem, ns, chave))
+        if len(msg) > self._TAM_MSG - 2:
+            # chave grande demais para o slot: invalida o namespace inteiro
+            msg = pickle.dumps((self._origem, ns, None))
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            seq = self._SEQ.unpack_from(self._mm, 0)[0] + 1
+            pos = self._SEQ.size + (seq % self._QTD_MSGS) * self._TAM_MSG
+            struct.pack_into("<H", self._mm, pos, len(msg))
+            self._mm[pos + 2: pos + 2 + len(msg)] = msg
+            self._SEQ.pack_into(self._mm, 0, seq)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _escutar(self) -> None:
+        while True:
+            time.sleep(0.5)
+            try:
+                self._processar_novas()
+            except Exception as e:
+                logger.warning(f"Erro no barramento de cache: {e}")
+
+    def _processar_novas(self) -> None:
+        fcntl.flock(self._fd, fcntl.LOCK_SH)
+        try:
+            seq = self._SEQ.unpack_from(self._mm, 0)[0]
+            if seq == self._lida:
+                return
+            if seq - self._lida > self._QTD_MSGS:
+                mensagens = [None]
+            else:
+                mensagens = []
+                for s in range(self._lida + 1, seq + 1):
+                    pos = self._SEQ.size + (s % self._QTD_MSGS) * self._TAM_MSG
+                    tam = struct.unpack_from("<H", self._mm, pos)[0]
+                    mensagens.append(pickle.loads(self._mm[pos + 2: pos + 2 + tam]))
+            self._lida = seq
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        for m in mensagens:
+            if m is None:
+                super().publicar("*", None)
+            elif m[0] != self._origem:
+                super().publicar(m[1], m[2])
+
+
+class BarramentoRedis(BarramentoLocal):
+    """Pub/sub do Redis."""
+
+    CANAL = "javis:cache:invalidacao"
+
+    def __init__(self, cliente):
+        super().__init__()
+        self._cliente = cliente
+        self._origem = uuid.uuid4().hex[:8]
+        pubsub = cliente.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.CANAL: self._receber})
+        pubsub.run_in_thread(sleep_time=0.5, daemon=True)
+
+    def publicar(self, ns: str, chave: Optional[str]) -> None:
+        super().publicar(ns, chave)
+        self._cliente.publish(self.CANAL, pickle.dumps((self._origem, ns, chave)))
+
+    def _receber(self, mensagem) -> None:
+        origem, ns, chave = pickle.loads(mensagem["data"])
+        if origem != self._origem:
+            BarramentoLocal.publicar(self, ns, chave)
+
+
+# --- FACHADA ---
+
+class Cache:
+    def __init__(self, backend, barramento: BarramentoLocal, l1_ttl: float = 2.0):
+        self.backend = backend
+        self.barramento = barramento
+        self._voo = SingleFlight()
+        # L1 local só faz sentido na frente de um backend compartilhado
+        self._l1 = CacheMemoria(max_itens=1000) if backend.compartilhado else None
+        self._l1_ttl = l1_ttl
+        barramento.ouvir(self._ao_invalidar)
+
+    @staticmethod
+    def _chave_l1(ns: str, chave: Hashable) -> str:
+        return f"{ns}\x00{chave!r}"
+
+    def _versao(self, ns: str) -> str:
+        chave = f"__ns__:{ns}"
+        versao = self.backend.get(chave)
+        if versao is FALTA:
+            # Versão perdida (ex.: slot sobrescrito): começa uma nova, nunca reaproveita
+            versao = uuid.uuid4().hex[:12]
+            self.backend.set(chave, versao)
+        return versao
+
+    def get(self, ns: str, chave: Hashable) -> Any:
+        if self._l1 is not None:
+            valor = self._l1.get(self._chave_l1(ns, chave))
+            if valor is not FALTA:
+                return valor
+        valor = self.backend.get(f"{ns}:{self._versao(ns)}:{chave!r}")
+        if valor is not FALTA and self._l1 is not None:
+            self._l1.set(self._chave_l1(ns, chave), valor, self._l1_ttl)
+        return valor
+
+    def set(self, ns: str, chave: Hashable, valor: Any, ttl: Optional[float] = None) -> None:
+        self.backend.set(f"{ns}:{self._versao(ns)}:{chave!r}", valor, ttl)
+        if self._l1 is not None:
+            self._l1.set(self._chave_l1(ns, chave), valor, min(ttl or self._l1_ttl, self._l1_ttl))
+
+    def obter(self, ns: str, chave: Hashable, funcao: Callable[[], Any], ttl: Optional[float] = None) -> Any:
+        """Lê do cache; se faltar, carrega com single-flight e grava."""
+        valor = self.get(ns, chave)
+        if valor is not FALTA:
+            return valor
+
+        def carregar():
+            novo = funcao()
+            self.set(ns, chave, novo, ttl)
+            return novo
+
+        return self._voo.executar((ns, chave), carregar)
+
+    def invalidar(self, ns: str, chave: Optional[Hashable] = None) -> None:
+        """Remove uma chave, ou o namespace inteiro (chave=None), em todos os workers."""
+        if chave is None:
+            self.backend.set(f"__ns__:{ns}", uuid.uuid4().hex[:12])
+            self.barramento.publicar(ns, None)
+        else:
+            self.backend.delete(f"{ns}:{self._versao(ns)}:{chave!r}")
+            self.barramento.publicar(ns, repr(chave))
+
+    def _ao_invalidar(self, ns: str, chave_repr: Optional[str]) -> None:
+        if self._l1 is None:
+            return
+        if ns == "*":
+            self._l1.delete_prefixo("")
+        elif chave_repr is None:
+            self._l1.delete_prefixo(f"{ns}\x00")
+        else:
+            self._l1.delete(f"{ns}\x00{chave_repr}")
+
+
+class CacheCurto:
+    """
+    Namespace do cache com TTL fixo (a recarga passa por single-flight).
+    Devolve uma cópia profunda: quem chama pode alterar o resultado à vontade.
+    """
+
+    def __init__(self, ns: str, ttl: float):
+        self.ns = ns
+        self.ttl = ttl
+
+    def obter(self, chave: Hashable, funcao: Callable[[], Any]) -> Any:
+        return copy.deepcopy(cache.obter(self.ns, chave, funcao, self.ttl))
+
+    def invalidar(self, chave: Optional[Hashable] = None) -> None:
+        cache.invalidar(self.ns, chave)
+
+
+def criar_cache() -> Cache:
+    tipo = os.getenv("CACHE_BACKEND", "memoria")
+    try:
+        if tipo == "redis":
+            backend = CacheRedis(os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0"))
+            return Cache(backend, BarramentoRedis(backend.cliente))
+        if tipo == "mmap":
+            caminho = os.getenv("CACHE_MMAP_ARQUIVO", "/tmp/javis-cache.mmap")
+            backend = CacheMmap(
+                caminho,
+                slots=int(os.getenv("CACHE_MMAP_SLOTS", "4096")),
+                bytes_slot=int(os.getenv("CACHE_MMAP_SLOT_BYTES", "16384")),
+            )
+            return Cache(backend, BarramentoArquivo(caminho + ".barramento"))
+    except Exception as e:
+        logger.error(f"Backend de cache '{tipo}' indisponível (usando memória): {e}")
+    return Cache(CacheMemoria(), BarramentoLocal())
+
+
+cache = criar_cache()
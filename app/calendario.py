@@ -0,0 +1,241 @@
+"""
+Calendário materializado das turmas.
+
+As datas das aulas de cada turma (data_inicio + dia_semana + qtd_aulas, pulando
+feriados de tb_feriados) são calculadas uma vez e ficam no cache compartilhado
+(app/cache.py). O cache é
+invalidado quando a turma é salva/editada ou quando os feriados mudam.
+Todos os consumidores (previsão de término, conflito de reposição, liberação de
+aulas, agenda) usam a mesma fonte.
+"""
+import hashlib
+import secrets
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from app.cache import cache
+
+# Dicionário para traduzir dia da semana
+DIAS_MAPA = {
+    "Segunda": 0, "Segunda-feira": 0, "Terça": 1, "Terça-feira": 1,
+    "Quarta": 2, "Quarta-feira": 2, "Quinta": 3, "Quinta-feira": 3,
+    "Sexta": 4, "Sexta-feira": 4, "Sábado": 5, "Sabado": 5, "Domingo": 6
+}
+
+DURACAO_PADRAO = timedelta(hours=2, minutes=30)
+# Rede de segurança: mesmo sem invalidação, recalcula depois desse tempo
+CALENDARIO_TTL = 3600
+
+
+def _parse_data(valor) -> Optional[date]:
+    if not valor:
+        return None
+    if isinstance(valor, date):
+        return valor
+    try:
+        return datetime.strptime(str(valor)[:10], "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+
+def _parse_horario(horario: Optional[str]):
+    """'19:00 - 21:30' -> ((19, 0), duração). Sem fim informado usa 2h30."""
+    if not horario:
+        return None, DURACAO_PADRAO
+    partes = [p.strip() for p in horario.split("-")]
+    try:
+        h, m = map(int, partes[0].split(":"))
+    except ValueError:
+        return None, DURACAO_PADRAO
+    duracao = DURACAO_PADRAO
+    if len(partes) > 1:
+        try:
+            hf, mf = map(int, partes[1].split(":"))
+            fim = timedelta(hours=hf, minutes=mf) - timedelta(hours=h, minutes=m)
+            if fim > timedelta(0):
+                duracao = fim
+        except ValueError:
+            pass
+    return (h, m), duracao
+
+
+def dia_da_semana(dia_semana: Optional[str], padrao: int = 0) -> int:
+    if not dia_semana:
+        return padrao
+    return DIAS_MAPA.get(dia_semana.split("-")[0].strip(), DIAS_MAPA.get(dia_semana.strip(), padrao))
+
+
+def calcular_datas(data_inicio, dia_semana: Optional[str], qtd_aulas: int, feriados=()) -> Dict[str, List[date]]:
+    """
+    Primeira aula no primeiro `dia_semana` a partir de data_inicio, depois semanal.
+    Datas em `feriados` são puladas e a aula vai para a semana seguinte.
+    """
+    inicio = _parse_data(data_inicio)
+    if not inicio or not qtd_aulas:
+        return {"datas": [], "puladas": []}
+
+    alvo = dia_da_semana(dia_semana, inicio.weekday())
+    atual = inicio + timedelta(days=(alvo - inicio.weekday() + 7) % 7)
+    datas: List[date] = []
+    puladas: List[date] = []
+    # limite evita laço infinito com tabela de feriados mal preenchida
+    while len(datas) < qtd_aulas and len(puladas) < 104:
+        if atual in feriados:
+            puladas.append(atual)
+        else:
+            datas.append(atual)
+        atual += timedelta(days=7)
+    return {"datas": datas, "puladas": puladas}
+
+
+def montar_calendario(turma: Dict[str, Any], feriados=()) -> Dict[str, Any]:
+    res = calcular_datas(turma.get("data_inicio"), turma.get("dia_semana"), turma.get("qtd_aulas") or 0, feriados)
+    hora, duracao = _parse_horario(turma.get("horario"))
+
+    aulas = []
+    for numero, d in enumerate(res["datas"], start=1):
+        aula = {"numero": numero, "data": d.isoformat(), "inicio": None, "fim": None}
+        if hora:
+            ini = datetime(d.year, d.month, d.day, hora[0], hora[1])
+            aula["inicio"] = ini.strftime("%Y-%m-%dT%H:%M")
+            aula["fim"] = (ini + duracao).strftime("%Y-%m-%dT%H:%M")
+        aulas.append(aula)
+
+    return {
+        "codigo_turma": turma.get("codigo_turma"),
+        "nome_curso": turma.get("nome_curso"),
+        "dia_semana": turma.get("dia_semana"),
+        "horario": turma.get("horario"),
+        "sala": turma.get("sala"),
+        "id_professor": turma.get("id_professor"),
+        "aulas": aulas,
+        "datas_puladas": [d.isoformat() for d in res["puladas"]],
+        "previsao_termino": aulas[-1]["data"] if aulas else None,
+    }
+
+
+# --- FERIADOS ---
+
+def carregar_feriados(cliente, id_unidade: Optional[int] = None) -> set:
+    """Feriados globais (id_unidade nulo) + os da unidade. Cache até invalidar."""
+    def buscar():
+        datas: Dict[Optional[int], set] = {}
+        try:
+            rows = cliente.table("tb_feriados").select("data, id_unidade").execute().data or []
+        except Exception:
+            rows = []
+        for r in rows:
+            d = _parse_data(r.get("data"))
+            if d:
+                datas.setdefault(r.get("id_unidade"), set()).add(d)
+        return datas
+
+    datas = cache.obter("feriados", "todos", buscar, CALENDARIO_TTL)
+    return set(datas.get(None, set())) | set(datas.get(id_unidade, set()) if id_unidade else set())
+
+
+# --- CACHE DE CALENDÁRIOS ---
+
+def obter_calendario(cliente, codigo_turma: str, turma: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """Calendário materializado da turma (busca a turma se não for informada)."""
+    def montar():
+        dados = turma
+        if dados is None:
+            resp = cliente.table("tb_turmas")\
+                .select("codigo_turma, nome_curso, id_professor, dia_semana, horario, sala, data_inicio, qtd_aulas, id_unidade")\
+                .eq("codigo_turma", codigo_turma)\
+                .limit(1)\
+                .execute()
+            if not resp.data:
+                return None
+            dados = resp.data[0]
+        return montar_calendario(dados, carregar_feriados(cliente, dados.get("id_unidade")))
+
+    return cache.obter("calendario", codigo_turma, montar, CALENDARIO_TTL)
+
+
+def invalidar(codigo_turma: Optional[str] = None) -> None:
+    """Descarta o calendário de uma turma (ou de todas, se None) em todos os workers."""
+    cache.invalidar("calendario", codigo_turma)
+
+
+def invalidar_feriados() -> None:
+    cache.invalidar("feriados")
+    cache.invalidar("calendario")
+
+
+def aulas_realizadas(cal: Dict[str, Any], hoje: Optional[date] = None) -> int:
+    """Quantas aulas do calendário já aconteceram (data <= hoje)."""
+    hoje = hoje or date.today()
+    return sum(1 for a in cal.get("aulas", []) if a["data"] <= hoje.isoformat())
+
+
+# --- FEED ICAL ---
+# Apps de calendário assinam uma URL e a consultam por meses, sem mandar header:
+# o JWT do Supabase venceria logo. Cada usuário tem um token de feed próprio,
+# longo e aleatório; o banco guarda só o hash (tb_calendario_tokens: user_id PK,
+# token_hash unique, criado_em). Gerar de novo substitui o anterior; revogar apaga.
+
+def _hash_token_feed(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def gerar_token_feed(cliente, user_id: str) -> str:
+    token = secrets.token_urlsafe(32)
+    cliente.table("tb_calendario_tokens").upsert({
+        "user_id": user_id,
+        "token_hash": _hash_token_feed(token),
+        "criado_em": datetime.now(timezone.utc).isoformat(),
+    }, on_conflict="user_id").execute()
+    return token
+
+
+def revogar_token_feed(cliente, user_id: str) -> None:
+    cliente.table("tb_calendario_tokens").delete().eq("user_id", user_id).execute()
+
+
+def usuario_do_token_feed(cliente, token: str) -> Optional[str]:
+    """user_id dono do token de feed (None se não existe ou foi revogado)."""
+    resp = cliente.table("tb_calendario_tokens").select("user_id")\
+        .eq("token_hash", _hash_token_feed(token)).limit(1).execute()
+    return resp.data[0]["user_id"] if resp.data else None
+
+
+# --- ICAL ---
+
+def _escapar_ical(texto: str) -> str:
+    return (texto or "").replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+
+def gerar_ical(cal: Dict[str, Any]) -> str:
+    codigo = cal.get("codigo_turma") or ""
+    agora = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    linhas = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//Javis Games//Calendario Turmas//PT-BR",
+        "CALSCALE:GREGORIAN",
+        f"X-WR-CALNAME:{_escapar_ical('Turma ' + codigo)}",
+    ]
+    for aula in cal.get("aulas", []):
+        linhas += [
+            "BEGIN:VEVENT",
+            f"UID:{_escapar_ical(codigo)}-{aula['numero']}@javisgames",
+            f"DTSTAMP:{agora}",
+        ]
+        if aula["inicio"]:
+            ini = datetime.strptime(aula["inicio"], "%Y-%m-%dT%H:%M")
+            fim = datetime.strptime(aula["fim"], "%Y-%m-%dT%H:%M")
+            linhas.append(f"DTSTART:{ini.strftime('%Y%m%dT%H%M%S')}")
+            linhas.append(f"DTEND:{fim.strftime('%Y%m%dT%H%M%S')}")
+        else:
+            d = _parse_data(aula["data"])
+            linhas.append(f"DTSTART;VALUE=DATE:{d.strftime('%Y%m%d')}")
+        titulo = f"{cal.get('nome_curso') or codigo} - Aula {aula['numero']}"
+        linhas.append(f"SUMMARY:{_escapar_ical(titulo)}")
+        if cal.get("sala"):
+            linhas.append(f"LOCATION:{_escapar_ical(str(cal['sala']))}")
+        linhas.append("END:VEVENT")
+    linhas.append("END:VCALENDAR")
+    # RFC 5545 exige CRLF
+    return "\r\n".join(linhas) + "\r\n"
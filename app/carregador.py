@@ -0,0 +1,73 @@
+"""
+Carregador de dados com escopo de requisição (estilo DataLoader).
+
+Uma instância nova por requisição (via Depends). Dentro dela:
+- consultas idênticas são memorizadas (não repetem ida ao Supabase);
+- chaves "previstas" para a mesma tabela/coluna são buscadas juntas num único in_().
+"""
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from supabase import Client
+
+_FALTA = object()
+
+
+class Carregador:
+    def __init__(self, cliente: Client):
+        self._cliente = cliente
+        self._usuarios: Dict[str, Any] = {}
+        # (tabela, colunas, coluna) -> {valor: [linhas]}
+        self._linhas: Dict[Tuple[str, str, str], Dict[Any, List[Dict[str, Any]]]] = defaultdict(dict)
+        # (tabela, colunas, coluna) -> valores ainda não buscados
+        self._pendentes: Dict[Tuple[str, str, str], set] = defaultdict(set)
+
+    def usuario(self, token: str):
+        """auth.get_user memorizado por token (levanta a mesma exceção do Supabase)."""
+        if token not in self._usuarios:
+            self._usuarios[token] = self._cliente.auth.get_user(token).user
+        return self._usuarios[token]
+
+    def prever(self, tabela: str, coluna: str, valor: Any, colunas: str = "*") -> None:
+        """Declara uma busca futura; será agrupada com as demais da mesma tabela/coluna."""
+        chave = (tabela, colunas, coluna)
+        if valor is not None and valor not in self._linhas[chave]:
+            self._pendentes[chave].add(valor)
+
+    def linhas(self, tabela: str, coluna: str, valor: Any, colunas: str = "*") -> List[Dict[str, Any]]:
+        """Todas as linhas de `tabela` onde `coluna == valor`."""
+        chave = (tabela, colunas, coluna)
+        encontrados = self._linhas[chave].get(valor, _FALTA)
+        if encontrados is _FALTA:
+            self.prever(tabela, coluna, valor, colunas)
+            self._despachar(chave)
+            encontrados = self._linhas[chave].get(valor, [])
+        return encontrados
+
+    def linha(self, tabela: str, coluna: str, valor: Any, colunas: str = "*") -> Optional[Dict[str, Any]]:
+        """Primeira linha onde `coluna == valor`, ou None."""
+        encontrados = self.linhas(tabela, coluna, valor, colunas)
+        return encontrados[0] if encontrados else None
+
+    def _despachar(self, chave: Tuple[str, str, str]) -> None:
+        tabela, colunas, coluna = chave
+        valores = list(self._pendentes.pop(chave, ()))
+        if not valores:
+            return
+
+        # Precisamos da coluna-chave no resultado para distribuir as linhas
+        campos = [c.strip() for c in colunas.split(",")]
+        selecao = colunas if (colunas == "*" or coluna in campos) else f"{colunas}, {coluna}"
+
+        query = self._cliente.table(tabela).select(selecao)
+        if len(valores) == 1:
+            query = query.eq(coluna, valores[0])
+        else:
+            query = query.in_(coluna, valores)
+        resp = query.execute()
+
+        cache = self._linhas[chave]
+        for v in valores:
+            cache[v] = []
+        for linha in resp.data or []:
+            cache.setdefault(linha.get(coluna), []).append(linha)
@@ -0,0 +1,154 @@
+"""
+Envio de mensagens no grupo da turma (tb_chat_turma).
+
+- Identidade de exibição (nome/cargo) em cache por user_id: o colaborador ou o
+  aluno só é procurado na primeira mensagem, não a cada uma;
+- Inserts em micro-lotes: uma thread única junta as mensagens que chegam dentro
+  de CHAT_LOTE_JANELA_MS (ou até CHAT_LOTE_MAX) e grava todas num insert só.
+  Quem enviou espera o lote ser gravado, então a resposta continua confirmando a
+  escrita. Se a mensagem não sai da fila em CHAT_LOTE_ESPERA ela é retirada do
+  lote antes do erro: um erro significa "não gravou", e reenviar não duplica.
+  Como há um único gravador, a ordem de chegada é a ordem de gravação, e
+  `created_at` é atribuído na chegada, crescente por grupo (o now() do
+  Postgres seria o mesmo para o lote inteiro e embaralharia a ordem).
+"""
+import logging
+import os
+import queue
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from app.cache import cache
+
+logger = logging.getLogger(__name__)
+
+CHAT_IDENTIDADE_TTL = float(os.getenv("CHAT_IDENTIDADE_TTL", "3600"))
+CHAT_LOTE_JANELA_MS = float(os.getenv("CHAT_LOTE_JANELA_MS", "15"))
+CHAT_LOTE_MAX = int(os.getenv("CHAT_LOTE_MAX", "100"))
+CHAT_LOTE_ESPERA = float(os.getenv("CHAT_LOTE_ESPERA", "10"))
+
+ID_CARGO_PROFESSOR = 6
+
+
+# --- IDENTIDADE ---
+
+def identidade(cliente, user_id: str) -> Dict[str, str]:
+    """{"nome_exibicao", "cargo_exibicao"} do usuário (colaborador, senão aluno)."""
+    def buscar():
+        c = cliente.table("tb_colaboradores").select("nome_completo, id_cargo").eq("user_id", user_id).limit(1).execute().data
+        if c:
+            return {
+                "nome_exibicao": c[0]["nome_completo"].split()[0],
+                "cargo_exibicao": "Professor" if c[0]["id_cargo"] == ID_CARGO_PROFESSOR else "Staff",
+            }
+        a = cliente.table("tb_alunos").select("nome_completo").eq("user_id", user_id).limit(1).execute().data
+        if a:
+            return {"nome_exibicao": a[0]["nome_completo"].split()[0], "cargo_exibicao": "Aluno"}
+        return {"nome_exibicao": "Usuário", "cargo_exibicao": "Aluno"}
+
+    return cache.obter("chat_identidade", user_id, buscar, CHAT_IDENTIDADE_TTL)
+
+
+def invalidar_identidade(user_id: Optional[str] = None) -> None:
+    """Chamar quando o nome/cargo muda (None = todos)."""
+    cache.invalidar("chat_identidade", user_id)
+
+
+# --- GRAVAÇÃO EM MICRO-LOTES ---
+
+class _Envio:
+    __slots__ = ("linha", "evento", "erro", "_lock", "_estado")
+
+    def __init__(self, linha: Dict[str, Any]):
+        self.linha = linha
+        self.evento = threading.Event()
+        self.erro: Optional[BaseException] = None
+        self._lock = threading.Lock()
+        self._estado = "fila"  # fila -> gravando | cancelado
+
+    def reservar(self) -> bool:
+        """Gravador: pega a mensagem para o insert (False se quem enviou desistiu)."""
+        with self._lock:
+            if self._estado == "cancelado":
+                return False
+            self._estado = "gravando"
+            return True
+
+    def cancelar(self) -> bool:
+        """Quem enviou: tira da fila (False se o insert já começou)."""
+        with self._lock:
+            if self._estado == "gravando":
+                return False
+            self._estado = "cancelado"
+            return True
+
+
+class GravadorLotes:
+    def __init__(self, cliente, tabela: str = "tb_chat_turma"):
+        self._cliente = cliente
+        self._tabela = tabela
+        self._fila: "queue.Queue[_Envio]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        # último created_at atribuído por grupo (mantém a ordem dentro do lote)
+        self._ultimo: Dict[str, datetime] = {}
+
+    def _iniciar(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="chat-grupo-lotes", daemon=True)
+                self._thread.start()
+
+    def _carimbar(self, linha: Dict[str, Any]) -> None:
+        with self._lock:
+            agora = datetime.now(timezone.utc)
+            anterior = self._ultimo.get(linha["codigo_turma"])
+            if anterior and agora <= anterior:
+                agora = anterior + timedelta(microseconds=1)
+            self._ultimo[linha["codigo_turma"]] = agora
+        linha["created_at"] = agora.isoformat()
+
+    def enviar(self, linha: Dict[str, Any]) -> None:
+        """Enfileira e espera o lote ser gravado (relança o erro do insert)."""
+        self._iniciar()
+        envio = _Envio(dict(linha))
+        self._carimbar(envio.linha)
+        self._fila.put(envio)
+        if not envio.evento.wait(CHAT_LOTE_ESPERA):
+            if envio.cancelar():
+                raise TimeoutError("Mensagem não gravada a tempo")
+            # o insert já está em andamento: o resultado dele é a resposta
+            envio.evento.wait()
+        if envio.erro:
+            raise envio.erro
+
+    def _loop(self) -> None:
+        while True:
+            lote = [self._fila.get()]
+            limite = datetime.now() + timedelta(milliseconds=CHAT_LOTE_JANELA_MS)
+            while len(lote) < CHAT_LOTE_MAX:
+                resta = (limite - datetime.now()).total_seconds()
+                if resta <= 0:
+                    break
+                try:
+                    lote.append(self._fila.get(timeout=resta))
+                except queue.Empty:
+                    break
+            lote = [e for e in lote if e.reservar()]
+            if lote:
+                self._gravar(lote)
+
+    def _gravar(self, lote: List[_Envio]) -> None:
+        try:
+            self._cliente.table(self._tabela).insert([e.linha for e in lote]).execute()
+        except Exception as e:
+            logger.warning(f"Lote do chat de grupo falhou ({len(lote)} msgs), gravando uma a uma: {e}")
+            # Uma linha ruim não derruba as outras; a ordem continua a de chegada
+            for envio in lote:
+                try:
+                    self._cliente.table(self._tabela).insert(envio.linha).execute()
+                except Exception as erro:
+                    envio.erro = erro
+        for envio in lote:
+            envio.evento.set()
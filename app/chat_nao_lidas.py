@@ -0,0 +1,143 @@
+"""
+Contadores de mensagens não lidas do chat privado (tb_chat).
+
+`tb_chat_nao_lidas` tem uma linha por conversa e lado: (id_aluno, id_colaborador,
+para_equipe) -> qtd. `para_equipe` = mensagens do aluno esperando a equipe;
+o contrário são as da equipe esperando o aluno. id_colaborador nulo (suporte
+geral) vira 0, como em app/resumo_festas.py.
+
+Cada mensagem nova recalcula o contador da conversa dela (um count, em
+background) e marcar como lida é um UPDATE só na conversa inteira, seguido do
+recálculo. Como o valor é sempre recontado, e não somado, duas mensagens ao mesmo
+tempo ou uma falha no meio não deixam o contador torto. Os badges leem só esta
+tabela.
+
+Colunas esperadas: id_aluno (FK tb_alunos), id_colaborador, para_equipe, qtd,
+atualizado_em, com unique (id_aluno, id_colaborador, para_equipe). Em tb_chat,
+`lida` com default false.
+"""
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SUPORTE_GERAL = 0
+
+Conversa = Tuple[int, int, bool]
+
+
+def conversa(id_aluno: int, id_colaborador: Optional[int], enviado_por_admin: bool) -> Conversa:
+    """Contador afetado por uma mensagem: quem não enviou é quem tem para ler."""
+    return (int(id_aluno), int(id_colaborador) if id_colaborador else SUPORTE_GERAL, not enviado_por_admin)
+
+
+def _filtrar(query, id_aluno: int, id_colaborador: Optional[int], para_equipe: bool):
+    query = query.eq("id_aluno", id_aluno).eq("enviado_por_admin", not para_equipe)
+    if id_colaborador is None:
+        return query
+    if id_colaborador == SUPORTE_GERAL:
+        return query.is_("id_colaborador", "null")
+    return query.eq("id_colaborador", id_colaborador)
+
+
+def _linha(chave: Conversa, qtd: int) -> dict:
+    id_aluno, id_colaborador, para_equipe = chave
+    return {
+        "id_aluno": id_aluno,
+        "id_colaborador": id_colaborador,
+        "para_equipe": para_equipe,
+        "qtd": qtd,
+        "atualizado_em": datetime.now().isoformat(),
+    }
+
+
+def recalcular(cliente, conversas: Iterable[Conversa]) -> None:
+    linhas = []
+    for chave in set(conversas):
+        id_aluno, id_colaborador, para_equipe = chave
+        resp = _filtrar(
+            cliente.table("tb_chat").select("id", count="exact").eq("lida", False).limit(1),
+            id_aluno, id_colaborador, para_equipe
+        ).execute()
+        linhas.append(_linha(chave, resp.count or 0))
+    if linhas:
+        cliente.table("tb_chat_nao_lidas").upsert(linhas, on_conflict="id_aluno,id_colaborador,para_equipe").execute()
+
+
+def registrar_mensagem(cliente, id_aluno: int, id_colaborador: Optional[int], enviado_por_admin: bool) -> None:
+    """Versão para BackgroundTasks, chamada depois de cada insert em tb_chat."""
+    try:
+        recalcular(cliente, [conversa(id_aluno, id_colaborador, enviado_por_admin)])
+    except Exception as e:
+        logger.exception(f"Erro ao atualizar não lidas (aluno {id_aluno}): {e}")
+
+
+def marcar_lidas(cliente, id_aluno: int, para_equipe: bool, id_colaborador: Optional[int] = None) -> int:
+    """
+    Marca como lidas, num UPDATE só, as mensagens da conversa que esperavam este lado.
+    id_colaborador None = todas as conversas do aluno (visão da equipe). Devolve quantas.
+    """
+    resp = _filtrar(
+        cliente.table("tb_chat").update({"lida": True}).eq("lida", False),
+        id_aluno, id_colaborador, para_equipe
+    ).execute()
+
+    if id_colaborador is None:
+        contadores = cliente.table("tb_chat_nao_lidas").select("id_colaborador")\
+            .eq("id_aluno", id_aluno).eq("para_equipe", para_equipe).execute().data or []
+        chaves = [(int(id_aluno), c["id_colaborador"], para_equipe) for c in contadores]
+    else:
+        chaves = [(int(id_aluno), id_colaborador, para_equipe)]
+    # recontar (em vez de zerar) não perde mensagem que chegou durante o UPDATE
+    recalcular(cliente, chaves)
+    return len(resp.data or [])
+
+
+def somar(linhas: Iterable[dict], campo: str) -> Dict:
+    """{valor do campo: qtd} das linhas de contador (ignora zerados)."""
+    res: Dict = {}
+    for l in linhas:
+        if l.get("qtd"):
+            res[l[campo]] = res.get(l[campo], 0) + l["qtd"]
+    return res
+
+
+def reconstruir(cliente, lote: int = 1000) -> int:
+    """Reconta tudo a partir das mensagens não lidas (carga inicial e correção de deriva)."""
+    contagem: Dict[Conversa, int] = {}
+    ultimo = 0
+    while True:
+        pagina = cliente.table("tb_chat").select("id, id_aluno, id_colaborador, enviado_por_admin")\
+            .eq("lida", False).gt("id", ultimo).order("id").limit(lote).execute().data or []
+        for m in pagina:
+            if m.get("id_aluno"):
+                chave = conversa(m["id_aluno"], m.get("id_colaborador"), bool(m.get("enviado_por_admin")))
+                contagem[chave] = contagem.get(chave, 0) + 1
+        if len(pagina) < lote:
+            break
+        ultimo = pagina[-1]["id"]
+
+    # grava os valores novos primeiro e só depois acerta quem saiu da contagem:
+    # em nenhum momento um badge que deveria aparecer fica zerado
+    linhas = [_linha(chave, qtd) for chave, qtd in contagem.items()]
+    for i in range(0, len(linhas), lote):
+        cliente.table("tb_chat_nao_lidas").upsert(linhas[i:i + lote], on_conflict="id_aluno,id_colaborador,para_equipe").execute()
+
+    sobrando = []
+    inicio = 0
+    while True:
+        pagina = cliente.table("tb_chat_nao_lidas").select("id_aluno, id_colaborador, para_equipe")\
+            .gt("qtd", 0).order("id_aluno").order("id_colaborador").order("para_equipe")\
+            .range(inicio, inicio + lote - 1).execute().data or []
+        for c in pagina:
+            chave = (c["id_aluno"], c["id_colaborador"], c["para_equipe"])
+            if chave not in contagem:
+                sobrando.append(chave)
+        if len(pagina) < lote:
+            break
+        inicio += lote
+    # recontadas uma a uma (e não zeradas às cegas): uma mensagem que chegou depois
+    # da varredura continua contando
+    recalcular(cliente, sobrando)
+    return len(linhas)
@@ -0,0 +1,110 @@
+"""
+Horários livres para reposição (professor + sala), por conjuntos de intervalos.
+
+Os compromissos viram intervalos [inicio, fim): aulas das turmas do professor
+(calendário materializado, ver app/calendario.py), reposições já marcadas e as
+aulas de outras turmas na mesma sala. Ordenados e mesclados uma vez, eles são
+subtraídos das janelas de funcionamento de cada dia numa varredura só, e o que
+sobra é fatiado em slots da duração pedida. Um mês inteiro são algumas centenas
+de intervalos: a conta é instantânea, o custo está só nas consultas.
+"""
+import os
+from datetime import date, datetime, time, timedelta
+from typing import Iterable, List, Optional, Sequence, Set, Tuple
+
+Intervalo = Tuple[datetime, datetime]
+
+
+def _hora(texto: str) -> time:
+    h, m = texto.strip().split(":")
+    return time(int(h), int(m))
+
+
+# "08:00-12:00,13:00-21:00" = expediente com intervalo de almoço
+HORARIO_FUNCIONAMENTO = [
+    (_hora(a), _hora(b))
+    for a, b in (faixa.split("-") for faixa in os.getenv("HORARIO_FUNCIONAMENTO", "08:00-21:00").split(","))
+]
+# 0 = segunda ... 6 = domingo
+DIAS_FUNCIONAMENTO = {int(d) for d in os.getenv("DIAS_FUNCIONAMENTO", "0,1,2,3,4,5").split(",")}
+DURACAO_REPOSICAO = timedelta(hours=1)
+
+
+def mesclar(intervalos: Iterable[Intervalo]) -> List[Intervalo]:
+    """Ordena e junta intervalos sobrepostos ou encostados."""
+    res: List[Intervalo] = []
+    for ini, fim in sorted(i for i in intervalos if i[0] < i[1]):
+        if res and ini <= res[-1][1]:
+            if fim > res[-1][1]:
+                res[-1] = (res[-1][0], fim)
+        else:
+            res.append((ini, fim))
+    return res
+
+
+def subtrair(janelas: Sequence[Intervalo], ocupados: Sequence[Intervalo]) -> List[Intervalo]:
+    """janelas - ocupados, ambos ordenados e sem sobreposição (varredura linear)."""
+    livres: List[Intervalo] = []
+    j = 0
+    for ini, fim in janelas:
+        atual = ini
+        while j < len(ocupados) and ocupados[j][1] <= atual:
+            j += 1
+        k = j
+        while k < len(ocupados) and ocupados[k][0] < fim:
+            if ocupados[k][0] > atual:
+                livres.append((atual, ocupados[k][0]))
+            atual = max(atual, ocupados[k][1])
+            k += 1
+        if atual < fim:
+            livres.append((atual, fim))
+    return livres
+
+
+def fatiar(livres: Iterable[Intervalo], duracao: timedelta, passo: timedelta) -> List[Intervalo]:
+    """Slots de `duracao` começando a cada `passo` (alinhados ao passo) dentro dos livres."""
+    slots: List[Intervalo] = []
+    passo_s = int(passo.total_seconds())
+    for ini, fim in livres:
+        # alinha o primeiro início ao passo (ex.: 10:20 vira 10:30 com passo de 30 min)
+        segundos = ini.hour * 3600 + ini.minute * 60 + ini.second
+        inicio = ini + timedelta(seconds=(-segundos) % passo_s)
+        while inicio + duracao <= fim:
+            slots.append((inicio, inicio + duracao))
+            inicio += passo
+    return slots
+
+
+def janelas(data_ini: date, data_fim: date, feriados: Set[date] = frozenset(),
+            agora: Optional[datetime] = None) -> List[Intervalo]:
+    """Expediente de cada dia útil do período (o que já passou de hoje fica de fora)."""
+    res: List[Intervalo] = []
+    dia = data_ini
+    while dia <= data_fim:
+        if dia.weekday() in DIAS_FUNCIONAMENTO and dia not in feriados:
+            for a, b in HORARIO_FUNCIONAMENTO:
+                ini, fim = datetime.combine(dia, a), datetime.combine(dia, b)
+                if agora:
+                    ini = max(ini, agora)
+                if ini < fim:
+                    res.append((ini, fim))
+        dia += timedelta(days=1)
+    return res
+
+
+def aulas_do_calendario(cal: dict, data_ini: date, data_fim: date) -> List[Intervalo]:
+    res = []
+    for aula in (cal or {}).get("aulas", []):
+        if aula.get("inicio") and data_ini.isoformat() <= aula["data"] <= data_fim.isoformat():
+            res.append((datetime.strptime(aula["inicio"], "%Y-%m-%dT%H:%M"), datetime.strptime(aula["fim"], "%Y-%m-%dT%H:%M")))
+    return res
+
+
+def horarios_livres(ocupados: Iterable[Intervalo], data_ini: date, data_fim: date, *,
+                    feriados: Set[date] = frozenset(), duracao: timedelta = DURACAO_REPOSICAO,
+                    passo: Optional[timedelta] = None, agora: Optional[datetime] = None) -> List[dict]:
+    livres = subtrair(janelas(data_ini, data_fim, feriados, agora), mesclar(ocupados))
+    return [
+        {"inicio": i.strftime("%Y-%m-%dT%H:%M"), "fim": f.strftime("%Y-%m-%dT%H:%M")}
+        for i, f in fatiar(livres, duracao, passo or duracao)
+    ]
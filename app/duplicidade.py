@@ -0,0 +1,285 @@
+"""
+Detecção de leads/inscrições que já são alunos (CPF, telefone, e-mail e nome).
+
+A maioria dos leads não tem CPF, então a comparação exata de CPF deixava passar
+ex-alunos voltando. Aqui cada aluno entra num índice de blocos:
+
+- `cpf:<dígitos>`;
+- `tel:<8 últimos dígitos>` (ignora DDI/DDD e o 9 extra do celular);
+- `email:<e-mail normalizado>` (minúsculas; no gmail sem pontos e sem +sufixo);
+- `nome:<primeiro>|<último>` e `nome:<primeiro>|<segundo>` (sem acento e sem
+  partículas "de/da/dos..."), para quem omite um sobrenome.
+
+Um lead só é comparado com os alunos que dividem algum bloco com ele (em geral
+um punhado), nunca com a base inteira. A nota combina os sinais como evidências
+independentes, 1 - Π(1 - pᵢ): nome igual sozinho é só "possível", nome parecido
+e mesmo telefone já é "provável".
+
+O nome é comparado por tokens com grafia simplificada (z→s, y→i, th→t, letras
+dobradas...: Luiz/Luis, Souza/Sousa, Thiago/Tiago caem juntos), nos blocos e na
+nota. Os tokens do nome mais curto contidos no mais longo contam quase como
+nome igual, porque omitir um sobrenome ou o nome do meio é o caso comum.
+Primeiro nome diferente é evidência contra: telefone e e-mail de família são
+compartilhados por irmãos, então sem CPF igual a nota é cortada por
+FATOR_PRIMEIRO_NOME.
+
+O índice vive em memória no processo e é reconstruído em segundo plano a cada
+DUPLICIDADE_INDICE_TTL segundos; enquanto isso o anterior continua respondendo.
+
+Usado no CRM (`ja_e_aluno`/`possivel_aluno`) e no /cadastrar, que grava
+`id_aluno_provavel` e `score_duplicidade` na inscrição (colunas em tb_inscricoes).
+"""
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from app.busca_chat import normalizar
+
+logger = logging.getLogger(__name__)
+
+DUPLICIDADE_INDICE_TTL = float(os.getenv("DUPLICIDADE_INDICE_TTL", "600"))
+DUPLICIDADE_PROVAVEL = float(os.getenv("DUPLICIDADE_PROVAVEL", "0.85"))
+DUPLICIDADE_POSSIVEL = float(os.getenv("DUPLICIDADE_POSSIVEL", "0.6"))
+# blocos maiores que isso (nome muito comum, telefone de fachada) não dizem nada
+BLOCO_MAX = 50
+
+PARTICULAS = frozenset({"de", "da", "do", "das", "dos", "e"})
+
+# peso de cada sinal (chance de ser a mesma pessoa, olhando só para ele)
+PESO_CPF = 0.99
+PESO_EMAIL = 0.9
+PESO_TELEFONE = 0.8
+PESO_NOME_IGUAL = 0.7
+PESO_NOME_CONTIDO = 0.6
+PESO_NOME_PARCIAL = 0.4
+PESO_SO_PRIMEIRO_NOME = 0.15
+# primeiro nome diferente (irmão no mesmo telefone/e-mail): multiplica a nota
+FATOR_PRIMEIRO_NOME = 0.5
+# grafias que variam no registro de nomes em português
+GRAFIAS = (("ph", "f"), ("th", "t"), ("y", "i"), ("w", "v"), ("z", "s"), ("k", "c"))
+
+
+def digitos(valor: Optional[str]) -> str:
+    return re.sub(r"\D", "", valor or "")
+
+
+def norm_telefone(valor: Optional[str]) -> Optional[str]:
+    d = digitos(valor)
+    return d[-8:] if len(d) >= 8 else None
+
+
+def norm_email(valor: Optional[str]) -> Optional[str]:
+    email = (valor or "").strip().lower()
+    if "@" not in email:
+        return None
+    usuario, dominio = email.rsplit("@", 1)
+    if dominio in ("gmail.com", "googlemail.com"):
+        usuario = usuario.split("+", 1)[0].replace(".", "")
+        dominio = "gmail.com"
+    return f"{usuario}@{dominio}"
+
+
+def _grafia(token: str) -> str:
+    for de, para in GRAFIAS:
+        token = token.replace(de, para)
+    return re.sub(r"(.)\1+", r"\1", token)
+
+
+def tokens_nome(valor: Optional[str]) -> List[str]:
+    return [_grafia(t) for t in re.split(r"[^a-z]+", normalizar(valor)) if t and t not in PARTICULAS]
+
+
+def registro(nome=None, cpf=None, email=None, telefones: Iterable[Optional[str]] = (), **extra) -> Dict[str, Any]:
+    """Forma normalizada usada tanto para alunos quanto para leads."""
+    cpf_d = digitos(cpf)
+    return {
+        **extra,
+        "nome": nome,
+        "tokens": tokens_nome(nome),
+        "cpf": cpf_d if len(cpf_d) == 11 else None,
+        "email": norm_email(email),
+        "telefones": {t for t in (norm_telefone(x) for x in telefones) if t},
+    }
+
+
+def blocos(reg: Dict[str, Any]) -> Set[str]:
+    chaves = set()
+    if reg["cpf"]:
+        chaves.add(f"cpf:{reg['cpf']}")
+    if reg["email"]:
+        chaves.add(f"email:{reg['email']}")
+    for t in reg["telefones"]:
+        chaves.add(f"tel:{t}")
+    tk = reg["tokens"]
+    if len(tk) >= 2:
+        chaves.add(f"nome:{tk[0]}|{tk[-1]}")
+        chaves.add(f"nome:{tk[0]}|{tk[1]}")
+    return chaves
+
+
+def _comparar_nomes(a: List[str], b: List[str]) -> Optional[Tuple[float, Optional[str]]]:
+    """
+    (peso, motivo) do nome; None = primeiro nome diferente (evidência contra).
+    Sem nome de um dos lados não diz nada: (0, None).
+    """
+    if not a or not b:
+        return 0.0, None
+    if a[0] != b[0]:
+        return None
+    curto, longo = (a, b) if len(a) <= len(b) else (b, a)
+    restantes = list(longo[1:])
+    comuns = 0
+    for t in curto[1:]:
+        if t in restantes:
+            restantes.remove(t)
+            comuns += 1
+    if len(curto) == 1 or comuns == 0:
+        return PESO_SO_PRIMEIRO_NOME, None
+    if comuns == len(curto) - 1:
+        # todos os tokens do nome curto estão no longo
+        return (PESO_NOME_IGUAL, "nome") if len(curto) == len(longo) else (PESO_NOME_CONTIDO, "nome parecido")
+    return PESO_NOME_PARCIAL, "nome parecido"
+
+
+def comparar(lead: Dict[str, Any], aluno: Dict[str, Any]) -> Dict[str, Any]:
+    sinais = []
+    motivos = []
+    cpf_igual = bool(lead["cpf"] and lead["cpf"] == aluno["cpf"])
+    if cpf_igual:
+        sinais.append(PESO_CPF)
+        motivos.append("cpf")
+    if lead["email"] and lead["email"] == aluno["email"]:
+        sinais.append(PESO_EMAIL)
+        motivos.append("email")
+    if lead["telefones"] & aluno["telefones"]:
+        sinais.append(PESO_TELEFONE)
+        motivos.append("telefone")
+
+    nome = _comparar_nomes(lead["tokens"], aluno["tokens"])
+    if nome is not None:
+        peso, motivo = nome
+        if peso:
+            sinais.append(peso)
+        if motivo:
+            motivos.append(motivo)
+
+    resto = 1.0
+    for p in sinais:
+        resto *= 1 - p
+    score = 1 - resto
+    if nome is None and not cpf_igual:
+        score *= FATOR_PRIMEIRO_NOME
+        motivos.append("primeiro nome diferente")
+    return {"score": round(score, 3), "motivos": motivos}
+
+
+class IndiceAlunos:
+    def __init__(self, alunos: Iterable[Dict[str, Any]]):
+        self.alunos: Dict[Any, Dict[str, Any]] = {}
+        self.blocos: Dict[str, Set[Any]] = defaultdict(set)
+        for a in alunos:
+            reg = registro(
+                nome=a.get("nome_completo"), cpf=a.get("cpf"), email=a.get("email"),
+                telefones=(a.get("celular"), a.get("telefone")),
+                id_aluno=a["id_aluno"], id_unidade=a.get("id_unidade"),
+            )
+            self.alunos[a["id_aluno"]] = reg
+            for chave in blocos(reg):
+                self.blocos[chave].add(a["id_aluno"])
+
+    def candidatos(self, reg: Dict[str, Any]) -> Set[Any]:
+        ids: Set[Any] = set()
+        for chave in blocos(reg):
+            bloco = self.blocos.get(chave, ())
+            if len(bloco) <= BLOCO_MAX or chave.startswith("cpf:"):
+                ids.update(bloco)
+        return ids
+
+    def melhor(self, reg: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Aluno mais parecido com o registro, se passar de DUPLICIDADE_POSSIVEL."""
+        achado = None
+        for id_aluno in self.candidatos(reg):
+            aluno = self.alunos[id_aluno]
+            r = comparar(reg, aluno)
+            if r["score"] >= DUPLICIDADE_POSSIVEL and (achado is None or r["score"] > achado["score"]):
+                achado = {
+                    "id_aluno": id_aluno,
+                    "nome": aluno["nome"],
+                    "id_unidade": aluno.get("id_unidade"),
+                    **r,
+                    "provavel": r["score"] >= DUPLICIDADE_PROVAVEL,
+                }
+        return achado
+
+
+# --- ÍNDICE DO PROCESSO ---
+
+_indice: Optional[IndiceAlunos] = None
+_construido_em = 0.0
+_construindo = False
+_lock = threading.Lock()
+
+
+def _carregar_alunos(cliente, lote: int = 1000) -> List[dict]:
+    alunos, ultimo = [], 0
+    while True:
+        pagina = cliente.table("tb_alunos")\
+            .select("id_aluno, nome_completo, cpf, email, celular, telefone, id_unidade")\
+            .gt("id_aluno", ultimo).order("id_aluno").limit(lote).execute().data or []
+        alunos.extend(pagina)
+        if len(pagina) < lote:
+            return alunos
+        ultimo = pagina[-1]["id_aluno"]
+
+
+def _reconstruir(cliente) -> None:
+    global _indice, _construido_em, _construindo
+    try:
+        inicio = time.monotonic()
+        novo = IndiceAlunos(_carregar_alunos(cliente))
+        with _lock:
+            _indice, _construido_em = novo, time.monotonic()
+        logger.info(f"Índice de duplicidade: {len(novo.alunos)} alunos em {time.monotonic() - inicio:.1f}s")
+    except Exception as e:
+        logger.exception(f"Erro ao montar índice de duplicidade: {e}")
+    finally:
+        with _lock:
+            _construindo = False
+
+
+def obter_indice(cliente, esperar: bool = True) -> Optional[IndiceAlunos]:
+    """
+    Índice atual. Vencido: devolve o antigo e reconstrói em segundo plano.
+    Sem índice nenhum: monta na hora, ou (esperar=False) só dispara e devolve None.
+    """
+    global _construindo
+    with _lock:
+        atual, vencido = _indice, time.monotonic() - _construido_em > DUPLICIDADE_INDICE_TTL
+        disparar = (atual is None or vencido) and not _construindo
+        if disparar:
+            _construindo = True
+    if atual is None and esperar:
+        if disparar:
+            _reconstruir(cliente)
+        else:
+            # outra thread já está montando: espera ela terminar
+            while True:
+                with _lock:
+                    if not _construindo:
+                        break
+                time.sleep(0.05)
+        return _indice
+    if disparar:
+        threading.Thread(target=_reconstruir, args=(cliente,), name="indice-duplicidade", daemon=True).start()
+    return atual
+
+
+def invalidar() -> None:
+    """Força a reconstrução na próxima consulta (aluno novo ou editado neste processo)."""
+    global _construido_em
+    with _lock:
+        _construido_em = 0.0
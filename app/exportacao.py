@@ -0,0 +1,191 @@
+"""
+Exportações em streaming (CSV e XLSX) para as telas de gestão.
+
+As linhas são lidas do Supabase em páginas por keyset (`coluna > último valor`,
+ordenado pela chave) e escritas à medida que chegam, então a memória do servidor
+não cresce com o tamanho da exportação.
+
+O XLSX é montado à mão (planilha com inlineStr dentro de um zip escrito em fluxo),
+sem openpyxl: o modo write_only dele ainda junta o arquivo inteiro antes de entregar.
+"""
+import csv
+import io
+import zipfile
+from datetime import datetime
+from typing import Any, Callable, Iterable, Iterator, List, Sequence, Tuple
+from xml.sax.saxutils import escape
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+EXPORTACAO_LOTE = 1000
+
+# (campo, título da coluna)
+Colunas = Sequence[Tuple[str, str]]
+
+
+def paginar(montar_query: Callable[[], Any], chave: str, lote: int = EXPORTACAO_LOTE) -> Iterator[dict]:
+    """
+    Percorre a consulta por keyset. `montar_query` devolve uma query nova já com
+    os filtros da rota (o builder do supabase é mutável, não dá para reaproveitar).
+    """
+    ultimo = None
+    while True:
+        query = montar_query().order(chave).limit(lote)
+        if ultimo is not None:
+            query = query.gt(chave, ultimo)
+        pagina = query.execute().data or []
+        yield from pagina
+        if len(pagina) < lote:
+            return
+        ultimo = pagina[-1][chave]
+
+
+def paginas(linhas: Iterable[dict], tamanho: int = EXPORTACAO_LOTE) -> Iterator[List[dict]]:
+    """Reagrupa um fluxo de linhas em listas (para enriquecer página a página)."""
+    pagina = []
+    for linha in linhas:
+        pagina.append(linha)
+        if len(pagina) >= tamanho:
+            yield pagina
+            pagina = []
+    if pagina:
+        yield pagina
+
+
+def _valor(linha: dict, campo: str) -> Any:
+    # aceita "tb_turmas.nome" para campos de selects embutidos
+    valor: Any = linha
+    for parte in campo.split("."):
+        if isinstance(valor, list):
+            valor = valor[0] if valor else None
+        if not isinstance(valor, dict):
+            return None
+        valor = valor.get(parte)
+    return valor
+
+
+def _texto(valor: Any) -> str:
+    if valor is None:
+        return ""
+    if isinstance(valor, bool):
+        return "Sim" if valor else "Não"
+    return str(valor)
+
+
+# --- CSV ---
+
+def gerar_csv(linhas: Iterable[dict], colunas: Colunas) -> Iterator[bytes]:
+    # BOM + ";" para o Excel em pt-BR abrir direto com acentos e colunas certas
+    texto = io.StringIO()
+    escritor = csv.writer(texto, delimiter=";")
+    escritor.writerow([titulo for _, titulo in colunas])
+    yield ("\ufeff" + texto.getvalue()).encode("utf-8")
+    for linha in linhas:
+        texto.seek(0)
+        texto.truncate()
+        escritor.writerow([_texto(_valor(linha, campo)) for campo, _ in colunas])
+        yield texto.getvalue().encode("utf-8")
+
+
+# --- XLSX ---
+
+class _Saida:
+    """Destino de escrita que acumula bytes até o gerador drenar."""
+
+    def __init__(self):
+        self._partes: List[bytes] = []
+
+    def write(self, dados) -> int:
+        if isinstance(dados, str):
+            dados = dados.encode("utf-8")
+        self._partes.append(bytes(dados))
+        return len(dados)
+
+    def flush(self) -> None:
+        pass
+
+    def drenar(self) -> bytes:
+        dados = b"".join(self._partes)
+        self._partes = []
+        return dados
+
+
+_XLSX_ESTATICOS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    "xl/workbook.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Dados" sheetId="1" r:id="rId1"/></sheets></workbook>'
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+
+def _celula(valor: Any) -> str:
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        return f"<c><v>{valor}</v></c>"
+    texto = escape(_texto(valor))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{texto}</t></is></c>'
+
+
+def gerar_xlsx(linhas: Iterable[dict], colunas: Colunas) -> Iterator[bytes]:
+    saida = _Saida()
+    # saída sem seek: o zipfile usa data descriptors e escreve em fluxo
+    with zipfile.ZipFile(saida, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for nome, conteudo in _XLSX_ESTATICOS.items():
+            zf.writestr(nome, conteudo)
+        with zf.open("xl/worksheets/sheet1.xml", "w") as planilha:
+            planilha.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                "<row>" + "".join(_celula(titulo) for _, titulo in colunas) + "</row>"
+            ).encode("utf-8"))
+            for linha in linhas:
+                planilha.write(
+                    ("<row>" + "".join(_celula(_valor(linha, campo)) for campo, _ in colunas) + "</row>").encode("utf-8")
+                )
+                dados = saida.drenar()
+                if dados:
+                    yield dados
+            planilha.write(b"</sheetData></worksheet>")
+    yield saida.drenar()
+
+
+FORMATOS = {
+    "csv": (gerar_csv, "text/csv; charset=utf-8"),
+    "xlsx": (gerar_xlsx, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
+
+
+def resposta_exportacao(nome: str, formato: str, linhas: Iterable[dict], colunas: Colunas) -> StreamingResponse:
+    formato = (formato or "csv").lower()
+    if formato not in FORMATOS:
+        raise HTTPException(status_code=400, detail="Formato inválido (use csv ou xlsx).")
+    gerador, tipo = FORMATOS[formato]
+    arquivo = f"{nome}_{datetime.now().strftime('%Y%m%d_%H%M')}.{formato}"
+    return StreamingResponse(
+        gerador(linhas, colunas),
+        media_type=tipo,
+        headers={"Content-Disposition": f'attachment; filename="{arquivo}"'}
+    )
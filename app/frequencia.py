@@ -0,0 +1,167 @@
+"""
+Frequência dos alunos: chamadas (tb_chamadas) + reposições (tb_reposicoes.presenca).
+
+`tb_frequencia_alunos` tem uma linha por aluno e turma com os números já
+calculados (taxa de presença, faltas seguidas, reposições pendentes/realizadas):
+quem está em duas turmas tem duas linhas, sem misturar as presenças. Salvar uma
+chamada ou mexer numa reposição recalcula só os alunos envolvidos, em background;
+as consultas de frequência e de alunos em risco leem apenas essa tabela. Como em
+app/resumo_festas.py, o recálculo é do aluno inteiro, não por diferença.
+
+Colunas esperadas: id_aluno + codigo_turma (unique), nome_aluno, id_unidade,
+total_aulas, presencas, faltas, taxa_presenca, faltas_consecutivas, ultima_aula,
+ultima_presenca, reposicoes_pendentes, reposicoes_realizadas, reposicoes_faltou,
+atualizado_em.
+"""
+import logging
+import os
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app.exportacao import paginar
+
+logger = logging.getLogger(__name__)
+
+FREQUENCIA_TAXA_MINIMA = float(os.getenv("FREQUENCIA_TAXA_MINIMA", "0.75"))
+FREQUENCIA_FALTAS_SEGUIDAS = int(os.getenv("FREQUENCIA_FALTAS_SEGUIDAS", "2"))
+# abaixo disso a taxa ainda não diz nada (aluno recém-chegado)
+FREQUENCIA_MIN_AULAS = int(os.getenv("FREQUENCIA_MIN_AULAS", "4"))
+
+LOTE_ALUNOS = 100
+
+
+def calcular(id_aluno: int, codigo_turma: str, chamadas: List[dict], reposicoes: List[dict]) -> dict:
+    """Números de frequência de um aluno numa turma a partir das linhas dele nela."""
+    chamadas = sorted(
+        (c for c in chamadas if c.get("presenca") is not None),
+        key=lambda c: c.get("data_aula") or ""
+    )
+    presencas = sum(1 for c in chamadas if c["presenca"])
+    total = len(chamadas)
+
+    seguidas = 0
+    for c in reversed(chamadas):
+        if c["presenca"]:
+            break
+        seguidas += 1
+
+    ultima_presenca = next((c["data_aula"] for c in reversed(chamadas) if c["presenca"]), None)
+
+    pendentes = realizadas = faltou = 0
+    for r in reposicoes:
+        if r.get("presenca") is True:
+            realizadas += 1
+        elif r.get("presenca") is False:
+            faltou += 1
+        elif (r.get("status") or "Agendada") == "Agendada":
+            pendentes += 1
+
+    return {
+        "id_aluno": id_aluno,
+        "codigo_turma": codigo_turma,
+        "total_aulas": total,
+        "presencas": presencas,
+        "faltas": total - presencas,
+        "taxa_presenca": round(presencas / total, 3) if total else None,
+        "faltas_consecutivas": seguidas,
+        "ultima_aula": chamadas[-1].get("data_aula") if chamadas else None,
+        "ultima_presenca": ultima_presenca,
+        "reposicoes_pendentes": pendentes,
+        "reposicoes_realizadas": realizadas,
+        "reposicoes_faltou": faltou,
+    }
+
+
+def recalcular_alunos(cliente, ids_alunos: Iterable[int]) -> int:
+    ids = sorted({int(i) for i in ids_alunos if i})
+    for i in range(0, len(ids), LOTE_ALUNOS):
+        lote = ids[i:i + LOTE_ALUNOS]
+        alunos = cliente.table("tb_alunos").select("id_aluno, nome_completo, id_unidade")\
+            .in_("id_aluno", lote).execute().data or []
+        # paginado: 100 alunos passam fácil do max-rows do PostgREST (1000), que corta calado
+        chamadas = paginar(
+            lambda: cliente.table("tb_chamadas").select("id, id_aluno, codigo_turma, data_aula, presenca").in_("id_aluno", lote),
+            "id",
+        )
+        reposicoes = paginar(
+            lambda: cliente.table("tb_reposicoes").select("id, id_aluno, codigo_turma, status, presenca").in_("id_aluno", lote),
+            "id",
+        )
+
+        info = {a["id_aluno"]: a for a in alunos}
+        por_turma: Dict[Tuple[int, str], Dict[str, list]] = {}
+        for tipo, linhas_tipo in (("chamadas", chamadas), ("reposicoes", reposicoes)):
+            for linha in linhas_tipo:
+                if linha["id_aluno"] in info and linha.get("codigo_turma"):
+                    grupo = por_turma.setdefault((linha["id_aluno"], linha["codigo_turma"]), {"chamadas": [], "reposicoes": []})
+                    grupo[tipo].append(linha)
+
+        agora = datetime.now().isoformat()
+        linhas = []
+        for (id_aluno, codigo_turma), dados in por_turma.items():
+            linha = calcular(id_aluno, codigo_turma, dados["chamadas"], dados["reposicoes"])
+            a = info[id_aluno]
+            linha.update({"nome_aluno": a.get("nome_completo"), "id_unidade": a.get("id_unidade"), "atualizado_em": agora})
+            linhas.append(linha)
+        for j in range(0, len(linhas), 500):
+            cliente.table("tb_frequencia_alunos").upsert(linhas[j:j + 500], on_conflict="id_aluno,codigo_turma").execute()
+        # turmas que o aluno não tem mais (chamadas apagadas/transferência) não foram regravadas agora
+        cliente.table("tb_frequencia_alunos").delete().in_("id_aluno", lote).lt("atualizado_em", agora).execute()
+    return len(ids)
+
+
+def atualizar_alunos(cliente, ids_alunos: Iterable[int]) -> None:
+    """Versão para BackgroundTasks: erro só vai para o log."""
+    try:
+        recalcular_alunos(cliente, list(ids_alunos))
+    except Exception as e:
+        logger.exception(f"Erro ao atualizar frequência: {e}")
+
+
+def atualizar_por_reposicao(cliente, id_repo, id_aluno: Optional[int] = None) -> None:
+    try:
+        if id_aluno is None:
+            resp = cliente.table("tb_reposicoes").select("id_aluno").eq("id", id_repo).execute()
+            id_aluno = resp.data[0]["id_aluno"] if resp.data else None
+        if id_aluno:
+            recalcular_alunos(cliente, [id_aluno])
+    except Exception as e:
+        logger.exception(f"Erro ao atualizar frequência (reposição {id_repo}): {e}")
+
+
+def reconstruir(cliente, lote: int = 1000) -> int:
+    """Recalcula todos os alunos (carga inicial e correção de deriva)."""
+    total = 0
+    ultimo = 0
+    while True:
+        pagina = cliente.table("tb_alunos").select("id_aluno")\
+            .gt("id_aluno", ultimo).order("id_aluno").limit(lote).execute().data or []
+        total += recalcular_alunos(cliente, [a["id_aluno"] for a in pagina])
+        if len(pagina) < lote:
+            return total
+        ultimo = pagina[-1]["id_aluno"]
+
+
+def motivos_risco(linha: dict, taxa_minima: float = FREQUENCIA_TAXA_MINIMA,
+                  faltas_seguidas: int = FREQUENCIA_FALTAS_SEGUIDAS) -> List[str]:
+    motivos = []
+    if (linha.get("faltas_consecutivas") or 0) >= faltas_seguidas:
+        motivos.append(f"{linha['faltas_consecutivas']} faltas seguidas")
+    taxa = linha.get("taxa_presenca")
+    if taxa is not None and (linha.get("total_aulas") or 0) >= FREQUENCIA_MIN_AULAS and taxa < taxa_minima:
+        motivos.append(f"presença de {round(taxa * 100)}%")
+    if (linha.get("reposicoes_faltou") or 0) > 0:
+        motivos.append(f"faltou a {linha['reposicoes_faltou']} reposição(ões)")
+    return motivos
+
+
+def resumo_turma(linhas: List[dict]) -> dict:
+    total = sum(l.get("total_aulas") or 0 for l in linhas)
+    presencas = sum(l.get("presencas") or 0 for l in linhas)
+    return {
+        "alunos": len(linhas),
+        "taxa_presenca": round(presencas / total, 3) if total else None,
+        "reposicoes_pendentes": sum(l.get("reposicoes_pendentes") or 0 for l in linhas),
+        "reposicoes_realizadas": sum(l.get("reposicoes_realizadas") or 0 for l in linhas),
+        "em_risco": sum(1 for l in linhas if motivos_risco(l)),
+    }
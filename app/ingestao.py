@@ -0,0 +1,148 @@
+"""
+Ingestão write-behind: grava localmente agora, envia ao Supabase depois.
+
+A rota só acrescenta o registro num log SQLite (WAL + synchronous=FULL, ou seja,
+durável no disco) e responde 202. Uma tarefa do agendador lê o log em lotes,
+insere no Supabase e apaga o que foi confirmado. Falhas voltam com backoff
+exponencial; o que continua no log após um reinício é reenviado normalmente.
+
+Cada registro leva um `id_ingestao` (uuid) e o envio é um upsert com
+ignore_duplicates nessa coluna: se o processo cair entre o insert no Supabase e
+a limpeza do log, o reenvio não duplica a inscrição.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List
+
+logger = logging.getLogger(__name__)
+
+INGESTAO_DB = os.getenv("INGESTAO_DB", "ingestao.db")
+INGESTAO_LOTE = int(os.getenv("INGESTAO_LOTE", "200"))
+INGESTAO_MAX_TENTATIVAS = int(os.getenv("INGESTAO_MAX_TENTATIVAS", "12"))
+
+_lock = threading.Lock()
+_conexao: sqlite3.Connection | None = None
+
+
+def _conectar() -> sqlite3.Connection:
+    global _conexao
+    if _conexao is None:
+        con = sqlite3.connect(INGESTAO_DB, check_same_thread=False, isolation_level=None, timeout=10)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=FULL")
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS pendentes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tabela TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                tentativas INTEGER NOT NULL DEFAULT 0,
+                proxima_tentativa REAL NOT NULL DEFAULT 0,
+                ultimo_erro TEXT,
+                falhou INTEGER NOT NULL DEFAULT 0,
+                criado_em REAL NOT NULL
+            )
+        """)
+        con.execute("CREATE INDEX IF NOT EXISTS idx_pendentes_fila ON pendentes (falhou, proxima_tentativa)")
+        _conexao = con
+    return _conexao
+
+
+def enfileirar(tabela: str, payload: Dict[str, Any]) -> str:
+    """Grava o registro no log local (durável) e devolve o id_ingestao."""
+    payload = dict(payload)
+    payload.setdefault("id_ingestao", str(uuid.uuid4()))
+    with _lock:
+        _conectar().execute(
+            "INSERT INTO pendentes (tabela, payload, criado_em) VALUES (?, ?, ?)",
+            (tabela, json.dumps(payload, ensure_ascii=False), time.time())
+        )
+    return payload["id_ingestao"]
+
+
+def _marcar_falha(ids: List[int], erro: str) -> None:
+    agora = time.time()
+    with _lock:
+        con = _conectar()
+        for id_ in ids:
+            row = con.execute("SELECT tentativas FROM pendentes WHERE id = ?", (id_,)).fetchone()
+            if not row:
+                continue
+            tentativas = row[0] + 1
+            espera = min(3600, 2 ** tentativas)
+            con.execute(
+                "UPDATE pendentes SET tentativas = ?, proxima_tentativa = ?, ultimo_erro = ?, falhou = ? WHERE id = ?",
+                (tentativas, agora + espera, erro[:500], int(tentativas >= INGESTAO_MAX_TENTATIVAS), id_)
+            )
+
+
+def _apagar(ids: List[int]) -> None:
+    with _lock:
+        _conectar().executemany("DELETE FROM pendentes WHERE id = ?", [(i,) for i in ids])
+
+
+def _enviar(cliente, tabela: str, linhas: List[Dict[str, Any]]) -> None:
+    cliente.table(tabela).upsert(linhas, on_conflict="id_ingestao", ignore_duplicates=True).execute()
+
+
+def descarregar(cliente) -> int:
+    """Envia um lote de pendentes ao Supabase. Retorna quantos foram confirmados."""
+    with _lock:
+        rows = _conectar().execute(
+            "SELECT id, tabela, payload FROM pendentes WHERE falhou = 0 AND proxima_tentativa <= ? ORDER BY id LIMIT ?",
+            (time.time(), INGESTAO_LOTE)
+        ).fetchall()
+    if not rows:
+        return 0
+
+    por_tabela: Dict[str, List[tuple]] = {}
+    for id_, tabela, payload in rows:
+        por_tabela.setdefault(tabela, []).append((id_, json.loads(payload)))
+
+    confirmados = 0
+    for tabela, itens in por_tabela.items():
+        try:
+            _enviar(cliente, tabela, [p for _, p in itens])
+            _apagar([i for i, _ in itens])
+            confirmados += len(itens)
+        except Exception as e:
+            if len(itens) == 1:
+                _marcar_falha([itens[0][0]], str(e))
+                logger.warning(f"Ingestão em {tabela} falhou (vai tentar de novo): {e}")
+                continue
+            # Lote recusado: tenta um a um para isolar o registro problemático
+            for id_, payload in itens:
+                try:
+                    _enviar(cliente, tabela, [payload])
+                    _apagar([id_])
+                    confirmados += 1
+                except Exception as e_item:
+                    _marcar_falha([id_], str(e_item))
+                    logger.warning(f"Ingestão em {tabela} falhou para o item {id_}: {e_item}")
+    return confirmados
+
+
+def descarregar_tudo(cliente) -> int:
+    """Reenvia o log inteiro (usado na inicialização)."""
+    total = 0
+    while True:
+        enviados = descarregar(cliente)
+        total += enviados
+        if enviados < INGESTAO_LOTE:
+            return total
+
+
+def estatisticas() -> Dict[str, Any]:
+    with _lock:
+        con = _conectar()
+        pendentes = con.execute("SELECT COUNT(*), MIN(criado_em) FROM pendentes WHERE falhou = 0").fetchone()
+        falhas = con.execute("SELECT COUNT(*) FROM pendentes WHERE falhou = 1").fetchone()[0]
+    return {
+        "pendentes": pendentes[0],
+        "mais_antigo_s": round(time.time() - pendentes[1], 1) if pendentes[1] else None,
+        "falhas_definitivas": falhas,
+    }
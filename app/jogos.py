@@ -0,0 +1,154 @@
+"""
+Servidor dos jogos dos alunos gerados pelo pygbag (build/web).
+
+Estrutura esperada: JOGOS_DIR/<projeto>/index.html, <projeto>.apk, favicon.png...
+(é a pasta build/web que o `pygbag` gera, copiada com o nome do projeto).
+
+- variantes pré-compactadas: se existir `arquivo.br` ou `arquivo.gz` ao lado do
+  original e o navegador aceitar, ela é enviada com Content-Encoding (gerar com
+  `python -m app.jogos JOGOS_DIR`);
+- ETag forte com o sha256 do conteúdo (calculado uma vez por mtime/tamanho);
+  `?v=<hash>` na URL (ver /jogos/{projeto}/manifesto) devolve cache imutável de
+  um ano, sem `v` o navegador revalida e recebe 304;
+- FileResponse do Starlette: envio do arquivo sem passar pelo Python em blocos
+  quando o servidor suporta (pathsend) e suporte a Range (bytes=...) para o
+  .apk/.wasm grandes. Com Range, sempre a versão sem compactação.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import shutil
+import sys
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import FileResponse
+
+JOGOS_DIR = Path(os.getenv("JOGOS_DIR", "jogos")).resolve()
+
+# pygbag entrega .apk (zip com o jogo) e, dependendo do template, .wasm/.data
+mimetypes.add_type("application/wasm", ".wasm")
+mimetypes.add_type("application/octet-stream", ".apk")
+mimetypes.add_type("application/octet-stream", ".data")
+mimetypes.add_type("text/javascript", ".mjs")
+
+# só vale a pena pré-compactar o que não é compactado por natureza
+EXTENSOES_COMPACTAVEIS = {".html", ".js", ".mjs", ".css", ".json", ".wasm", ".data", ".txt", ".svg", ".tmx", ".py"}
+CACHE_IMUTAVEL = "public, max-age=31536000, immutable"
+CACHE_REVALIDAR = "public, no-cache"
+
+SUFIXO_ETAG = {"br": "br", "gzip": "gz"}
+
+router = APIRouter(prefix="/jogos", tags=["jogos"])
+
+_hashes: Dict[str, Tuple[int, int, str]] = {}
+_hashes_lock = threading.Lock()
+
+
+def _hash_arquivo(caminho: Path, st: os.stat_result) -> str:
+    chave = str(caminho)
+    with _hashes_lock:
+        item = _hashes.get(chave)
+    if item and item[0] == st.st_mtime_ns and item[1] == st.st_size:
+        return item[2]
+    h = hashlib.sha256()
+    with open(caminho, "rb") as f:
+        for bloco in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(bloco)
+    valor = h.hexdigest()[:32]
+    with _hashes_lock:
+        _hashes[chave] = (st.st_mtime_ns, st.st_size, valor)
+    return valor
+
+
+def _resolver(projeto: str, caminho: str) -> Path:
+    base = (JOGOS_DIR / projeto).resolve()
+    alvo = (base / (caminho or "index.html")).resolve()
+    # nada de ../ para fora da pasta do projeto
+    if base.parent != JOGOS_DIR or not alvo.is_relative_to(base):
+        raise HTTPException(status_code=404)
+    if alvo.is_dir():
+        alvo = alvo / "index.html"
+    if not alvo.is_file():
+        raise HTTPException(status_code=404)
+    return alvo
+
+
+def _variante(alvo: Path, request: Request) -> Tuple[Path, Optional[str]]:
+    if request.headers.get("range"):
+        return alvo, None
+    aceita = request.headers.get("accept-encoding") or ""
+    for codificacao, sufixo in (("br", ".br"), ("gzip", ".gz")):
+        if codificacao in aceita:
+            variante = alvo.with_name(alvo.name + sufixo)
+            if variante.is_file() and variante.stat().st_mtime_ns >= alvo.stat().st_mtime_ns:
+                return variante, codificacao
+    return alvo, None
+
+
+@router.get("/{projeto}/manifesto")
+def manifesto_jogo(projeto: str):
+    """Hash de cada arquivo do jogo, para montar URLs versionadas (?v=hash)."""
+    base = _resolver(projeto, "index.html").parent
+    arquivos = {}
+    for p in sorted(base.rglob("*")):
+        if p.is_file() and p.suffix not in (".gz", ".br"):
+            arquivos[p.relative_to(base).as_posix()] = _hash_arquivo(p, p.stat())
+    return {"projeto": projeto, "arquivos": arquivos}
+
+
+@router.get("/{projeto}/{caminho:path}")
+def servir_jogo(projeto: str, caminho: str, request: Request, v: Optional[str] = None):
+    alvo = _resolver(projeto, caminho)
+    hash_arquivo = _hash_arquivo(alvo, alvo.stat())
+    arquivo, codificacao = _variante(alvo, request)
+    # ETag forte é por representação: a versão compactada tem a sua
+    etag = f'"{hash_arquivo}-{SUFIXO_ETAG[codificacao]}"' if codificacao else f'"{hash_arquivo}"'
+
+    headers = {
+        "ETag": etag,
+        "Vary": "Accept-Encoding",
+        "Cache-Control": CACHE_IMUTAVEL if v == hash_arquivo else CACHE_REVALIDAR,
+    }
+    enviados = {t.strip() for t in (request.headers.get("if-none-match") or "").split(",")}
+    if etag in enviados or "*" in enviados:
+        return Response(status_code=304, headers=headers)
+    if codificacao:
+        headers["Content-Encoding"] = codificacao
+
+    media_type = mimetypes.guess_type(alvo.name)[0] or "application/octet-stream"
+    return FileResponse(arquivo, media_type=media_type, headers=headers, stat_result=arquivo.stat())
+
+
+# --- PRÉ-COMPACTAÇÃO ---
+
+def precomprimir(diretorio: Path) -> int:
+    """Gera .gz (e .br, se o pacote brotli estiver instalado) ao lado dos arquivos."""
+    try:
+        import brotli  # opcional
+    except ImportError:
+        brotli = None
+
+    gerados = 0
+    for p in Path(diretorio).rglob("*"):
+        if not p.is_file() or p.suffix.lower() not in EXTENSOES_COMPACTAVEIS:
+            continue
+        gz = p.with_name(p.name + ".gz")
+        if not gz.exists() or gz.stat().st_mtime_ns < p.stat().st_mtime_ns:
+            with open(p, "rb") as origem, gzip.open(gz, "wb", compresslevel=9) as destino:
+                shutil.copyfileobj(origem, destino)
+            gerados += 1
+        if brotli is not None:
+            br = p.with_name(p.name + ".br")
+            if not br.exists() or br.stat().st_mtime_ns < p.stat().st_mtime_ns:
+                br.write_bytes(brotli.compress(p.read_bytes(), quality=11))
+                gerados += 1
+    return gerados
+
+
+if __name__ == "__main__":
+    alvo = Path(sys.argv[1]) if len(sys.argv) > 1 else JOGOS_DIR
+    print(f"{precomprimir(alvo)} arquivo(s) compactado(s) em {alvo}")
@@ -0,0 +1,234 @@
+"""
+Limitador de taxa (token bucket) e descarte de carga para as rotas públicas.
+
+Cada rota tem baldes por IP e por e-mail. Quando um balde esvazia a rota responde
+429 com Retry-After. Além disso, há um teto de requisições simultâneas por rota:
+passou disso, 503 na hora (melhor recusar do que prender threads do worker).
+
+O estado dos baldes fica num armazenamento plugável: memória (um processo) ou
+Redis (compartilhado entre os workers do uvicorn), escolhido por LIMITADOR_REDIS_URL.
+Os limites podem ser sobrescritos por LIMITES_ROTAS (JSON com o mesmo formato).
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException, Request
+
+logger = logging.getLogger(__name__)
+
+# capacidade = rajada máxima; periodo = segundos para reencher o balde inteiro
+LIMITES_PADRAO = {
+    "login": {
+        "ip": {"capacidade": 20, "periodo": 60},
+        "email": {"capacidade": 5, "periodo": 900},
+        "max_simultaneas": 20,
+    },
+    "cadastrar": {
+        "ip": {"capacidade": 10, "periodo": 60},
+        "email": {"capacidade": 3, "periodo": 600},
+        "max_simultaneas": 20,
+    },
+    "recuperar-senha": {
+        "ip": {"capacidade": 5, "periodo": 600},
+        "email": {"capacidade": 3, "periodo": 3600},
+        "max_simultaneas": 10,
+    },
+}
+
+LIMITADOR_ATIVO = os.getenv("LIMITADOR_ATIVO", "1") == "1"
+# Quantos proxies confiáveis (nossos) ficam na frente do app e acrescentam ao
+# X-Forwarded-For. 0 = ignora o cabeçalho (o cliente escreve o que quiser nele).
+LIMITADOR_CONFIAR_PROXY = int(os.getenv("LIMITADOR_CONFIAR_PROXY", "0"))
+
+
+def _carregar_limites() -> Dict[str, dict]:
+    limites = {rota: dict(cfg) for rota, cfg in LIMITES_PADRAO.items()}
+    extra = os.getenv("LIMITES_ROTAS")
+    if extra:
+        try:
+            for rota, cfg in json.loads(extra).items():
+                limites.setdefault(rota, {}).update(cfg)
+        except ValueError as e:
+            logger.error(f"LIMITES_ROTAS inválido (usando padrão): {e}")
+    return limites
+
+
+LIMITES = _carregar_limites()
+
+
+# --- ARMAZENAMENTO DOS BALDES ---
+
+class ArmazenamentoMemoria:
+    """Baldes num dict do próprio processo (cada worker tem o seu)."""
+
+    MAX_CHAVES = 50_000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._baldes: Dict[str, Tuple[float, float]] = {}
+
+    def consumir(self, chave: str, capacidade: float, taxa: float, custo: float = 1.0) -> Tuple[bool, float]:
+        agora = time.monotonic()
+        with self._lock:
+            tokens, ts = self._baldes.get(chave, (capacidade, agora))
+            tokens = min(capacidade, tokens + (agora - ts) * taxa)
+            if tokens >= custo:
+                self._baldes[chave] = (tokens - custo, agora)
+                ok, espera = True, 0.0
+            else:
+                self._baldes[chave] = (tokens, agora)
+                ok, espera = False, (custo - tokens) / taxa
+            if len(self._baldes) > self.MAX_CHAVES:
+                self._limpar(agora)
+            return ok, espera
+
+    def _limpar(self, agora: float) -> None:
+        # Remove os baldes mais antigos (os que já estariam cheios de novo)
+        ordenados = sorted(self._baldes.items(), key=lambda kv: kv[1][1])
+        for chave, _ in ordenados[: len(ordenados) // 2]:
+            del self._baldes[chave]
+
+
+_SCRIPT_BALDE = """
+local cap = tonumber(ARGV[1])
+local taxa = tonumber(ARGV[2])
+local agora = tonumber(ARGV[3])
+local custo = tonumber(ARGV[4])
+local d = redis.call('HMGET', KEYS[1], 't', 'ts')
+local tokens = tonumber(d[1]) or cap
+local ts = tonumber(d[2]) or agora
+tokens = math.min(cap, tokens + math.max(0, agora - ts) * taxa)
+local ok = 0
+local espera = 0
+if tokens >= custo then
+  tokens = tokens - custo
+  ok = 1
+else
+  espera = (custo - tokens) / taxa
+end
+redis.call('HSET', KEYS[1], 't', tokens, 'ts', agora)
+redis.call('EXPIRE', KEYS[1], math.ceil(cap / taxa) + 1)
+return {ok, tostring(espera)}
+"""
+
+
+class ArmazenamentoRedis:
+    """Baldes no Redis (script Lua atômico): limite vale para todos os workers."""
+
+    def __init__(self, url: str, prefixo: str = "javis:limite:"):
+        import redis  # dependência opcional, só quando LIMITADOR_REDIS_URL é usado
+
+        self._cliente = redis.Redis.from_url(url)
+        self._script = self._cliente.register_script(_SCRIPT_BALDE)
+        self._prefixo = prefixo
+
+    def consumir(self, chave: str, capacidade: float, taxa: float, custo: float = 1.0) -> Tuple[bool, float]:
+        ok, espera = self._script(keys=[self._prefixo + chave], args=[capacidade, taxa, time.time(), custo])
+        return bool(int(ok)), float(espera)
+
+
+def _criar_armazenamento():
+    url = os.getenv("LIMITADOR_REDIS_URL")
+    if url:
+        try:
+            return ArmazenamentoRedis(url)
+        except Exception as e:
+            logger.error(f"Redis do limitador indisponível (usando memória): {e}")
+    return ArmazenamentoMemoria()
+
+
+# --- LIMITADOR ---
+
+class Limitador:
+    def __init__(self, armazenamento=None, limites: Optional[Dict[str, dict]] = None):
+        self.armazenamento = armazenamento or _criar_armazenamento()
+        self.limites = limites or LIMITES
+        self._lock = threading.Lock()
+        self._em_andamento: Dict[str, int] = {}
+        self._metricas: Dict[str, Dict[str, int]] = {}
+
+    def _contar(self, rota: str, evento: str) -> None:
+        with self._lock:
+            m = self._metricas.setdefault(rota, {})
+            m[evento] = m.get(evento, 0) + 1
+
+    def _verificar_balde(self, rota: str, dimensao: str, valor: str) -> None:
+        cfg = self.limites.get(rota, {}).get(dimensao)
+        if not cfg or not valor:
+            return
+        capacidade = float(cfg["capacidade"])
+        taxa = capacidade / float(cfg["periodo"])
+        try:
+            ok, espera = self.armazenamento.consumir(f"{rota}:{dimensao}:{valor}", capacidade, taxa)
+        except Exception as e:
+            # Armazenamento fora do ar não pode derrubar o login
+            logger.warning(f"Limitador sem armazenamento ({rota}): {e}")
+            return
+        if not ok:
+            self._contar(rota, f"rejeitadas_{dimensao}")
+            raise HTTPException(
+                status_code=429,
+                detail="Muitas tentativas. Aguarde e tente novamente.",
+                headers={"Retry-After": str(max(1, int(espera + 0.999)))}
+            )
+
+    @contextmanager
+    def controlar(self, request: Request, rota: str, email: Optional[str] = None):
+        """Aplica os baldes (IP/e-mail) e o teto de simultâneas durante a rota."""
+        if not LIMITADOR_ATIVO:
+            yield
+            return
+
+        self._verificar_balde(rota, "ip", ip_cliente(request))
+        self._verificar_balde(rota, "email", (email or "").strip().lower())
+
+        maximo = self.limites.get(rota, {}).get("max_simultaneas")
+        with self._lock:
+            atual = self._em_andamento.get(rota, 0)
+            if maximo and atual >= maximo:
+                descartar = True
+            else:
+                descartar = False
+                self._em_andamento[rota] = atual + 1
+        if descartar:
+            self._contar(rota, "descartadas")
+            raise HTTPException(
+                status_code=503,
+                detail="Servidor ocupado. Tente novamente em instantes.",
+                headers={"Retry-After": "2"}
+            )
+
+        self._contar(rota, "permitidas")
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._em_andamento[rota] -= 1
+
+    def metricas(self) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                rota: {**contadores, "em_andamento": self._em_andamento.get(rota, 0)}
+                for rota, contadores in self._metricas.items()
+            }
+
+
+def ip_cliente(request: Request) -> str:
+    """
+    IP usado nos baldes. Com N proxies confiáveis, cada um acrescenta um salto à
+    direita do X-Forwarded-For; o N-ésimo a partir da direita foi escrito pelo
+    primeiro proxy nosso e é o IP real. O que está mais à esquerda veio do cliente.
+    """
+    if LIMITADOR_CONFIAR_PROXY > 0:
+        saltos = [s.strip() for s in request.headers.get("x-forwarded-for", "").split(",") if s.strip()]
+        if len(saltos) >= LIMITADOR_CONFIAR_PROXY:
+            return saltos[-LIMITADOR_CONFIAR_PROXY]
+    return request.client.host if request.client else "desconhecido"
+
+
+limitador = Limitador()
@@ -0,0 +1,156 @@
+"""
+Pipeline de logs não bloqueante.
+
+As rotas só colocam o registro numa fila (QueueHandler); uma thread de fundo
+(QueueListener) formata em JSON e grava no arquivo com rotação por tamanho.
+Assim o flush em disco nunca fica no caminho da requisição.
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+# Contexto da requisição atual (preenchido pelo middleware e pelas funções de auth)
+rota_atual: ContextVar[str | None] = ContextVar("rota_atual", default=None)
+usuario_atual: ContextVar[str | None] = ContextVar("usuario_atual", default=None)
+# Caixa mutável criada pelo middleware. Rotas síncronas rodam no threadpool numa
+# cópia do contexto, então o que gravam em usuario_atual não volta ao middleware;
+# o mesmo dict, compartilhado pelas cópias, volta.
+_requisicao_atual: ContextVar[dict | None] = ContextVar("requisicao_atual", default=None)
+
+LOG_ARQUIVO = os.getenv("LOG_ARQUIVO", "app.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))
+LOG_NIVEL = os.getenv("LOG_NIVEL", "INFO")
+# Fração dos logs INFO marcados como "amostrar" que é realmente gravada (0.0 a 1.0)
+LOG_AMOSTRAGEM_INFO = float(os.getenv("LOG_AMOSTRAGEM_INFO", "0.1"))
+
+# Campos extras aceitos via logger.info(..., extra={...})
+CAMPOS_EXTRAS = ("rota", "usuario", "duracao_ms", "status", "metodo")
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+def iniciar_requisicao(rota: str) -> dict:
+    """Chamado pelo middleware: zera o contexto e devolve a caixa da requisição."""
+    caixa = {"usuario": None}
+    rota_atual.set(rota)
+    usuario_atual.set(None)
+    _requisicao_atual.set(caixa)
+    return caixa
+
+
+def definir_usuario(user_id: str | None) -> None:
+    """Usuário autenticado da requisição, para os logs da rota e o de acesso."""
+    usuario_atual.set(user_id)
+    caixa = _requisicao_atual.get()
+    if caixa is not None:
+        caixa["usuario"] = user_id
+
+
+class FormatadorJson(logging.Formatter):
+    """Formata cada registro como uma linha JSON."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        dados = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for campo in CAMPOS_EXTRAS:
+            valor = getattr(record, campo, None)
+            if valor is not None:
+                dados[campo] = valor
+        erro = getattr(record, "erro", None)
+        if erro:
+            dados["erro"] = erro
+        elif record.exc_info:
+            dados["erro"] = self.formatException(record.exc_info)
+        return json.dumps(dados, ensure_ascii=False, default=str)
+
+
+class FiltroContexto(logging.Filter):
+    """
+    Copia rota/usuário do contexto da requisição para o registro.
+    Roda no handler da fila, ou seja, ainda na thread da requisição.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "rota", None) is None:
+            record.rota = rota_atual.get()
+        if getattr(record, "usuario", None) is None:
+            record.usuario = usuario_atual.get()
+        return True
+
+
+class FiltroAmostragem(logging.Filter):
+    """Descarta parte dos logs INFO de alto volume (extra={"amostrar": True})."""
+
+    def __init__(self, taxa: float):
+        super().__init__()
+        self.taxa = taxa
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO or not getattr(record, "amostrar", False):
+            return True
+        return random.random() < self.taxa
+
+
+class _HandlerFila(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Resolve mensagem e traceback aqui (args/exc_info não são seguros entre threads),
+        # mas guarda o traceback num campo próprio em vez de colar na mensagem
+        erro = None
+        if record.exc_info:
+            erro = logging.Formatter().formatException(record.exc_info)
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        record.erro = erro
+        return record
+
+
+def configurar_logs() -> None:
+    """Configura o logger raiz com fila + thread de escrita. Idempotente."""
+    global _listener
+    if _listener is not None:
+        return
+
+    fila: queue.Queue = queue.Queue(-1)
+
+    formatador = FormatadorJson()
+    arquivo = logging.handlers.RotatingFileHandler(
+        LOG_ARQUIVO, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8"
+    )
+    arquivo.setFormatter(formatador)
+    console = logging.StreamHandler()
+    console.setFormatter(formatador)
+
+    handler_fila = _HandlerFila(fila)
+    handler_fila.addFilter(FiltroContexto())
+    handler_fila.addFilter(FiltroAmostragem(LOG_AMOSTRAGEM_INFO))
+
+    raiz = logging.getLogger()
+    raiz.handlers = [handler_fila]
+    raiz.setLevel(LOG_NIVEL)
+
+    _listener = logging.handlers.QueueListener(fila, arquivo, console, respect_handler_level=True)
+    _listener.start()
+    atexit.register(parar_logs)
+
+
+def parar_logs() -> None:
+    """Esvazia a fila e para a thread de escrita."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -90,6 +90,12 @@ class TurmaData(BaseModel):
     data_termino_real: str | None = None
 
 
+class FeriadoData(BaseModel):
+    data: str                      # YYYY-MM-DD
+    descricao: str | None = None
+    id_unidade: int | None = None  # None = vale para todas as unidades
+
+
 class LoginData(BaseModel):
     email: str
     password: str
@@ -156,6 +162,12 @@ class StatusUpdateData(BaseModel):
     status: str
 
 
+class LeadsStatusLoteData(BaseModel):
+    ids: list[int]
+    status: str
+    id_vendedor: int | None = None  # None = quem está logado
+
+
 class NovoFuncionarioData(BaseModel):
     nome: str
     email: str
@@ -0,0 +1,46 @@
+"""
+Consultas independentes em paralelo dentro de uma requisição.
+
+As rotas são síncronas e cada consulta ao Supabase é uma ida HTTP; quando uma
+tela precisa de várias consultas que não dependem umas das outras, `reunir`
+dispara todas num pool compartilhado e espera o conjunto. O tempo da rota vira
+o da consulta mais lenta, não a soma.
+
+Cada tarefa roda numa cópia do contexto da requisição (rota/usuário dos logs).
+Chamado de dentro de uma tarefa do próprio pool, `reunir` executa em sequência:
+esperar por outras tarefas ocupando uma thread do pool pode travá-lo inteiro
+quando todas as threads estão fazendo isso.
+"""
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+PARALELO_THREADS = int(os.getenv("PARALELO_THREADS", "16"))
+
+_pool = ThreadPoolExecutor(max_workers=PARALELO_THREADS, thread_name_prefix="paralelo")
+# marcado enquanto a thread executa uma tarefa do pool
+_local = threading.local()
+
+
+def _executar(contexto: contextvars.Context, funcao: Callable[[], Any]) -> Any:
+    _local.dentro = True
+    try:
+        return contexto.run(funcao)
+    finally:
+        _local.dentro = False
+
+
+def reunir(**tarefas: Callable[[], Any]) -> Dict[str, Any]:
+    """
+    Executa as funções (sem argumentos) em paralelo e devolve {nome: resultado}.
+    Se alguma falhar, a primeira exceção (na ordem dos nomes) é relançada.
+    """
+    if getattr(_local, "dentro", False):
+        return {nome: funcao() for nome, funcao in tarefas.items()}
+    futuros = {
+        nome: _pool.submit(_executar, contextvars.copy_context(), funcao)
+        for nome, funcao in tarefas.items()
+    }
+    return {nome: futuro.result() for nome, futuro in futuros.items()}
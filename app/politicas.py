@@ -0,0 +1,100 @@
+"""
+Políticas de acesso declarativas: quem pode fazer o quê, e em qual unidade.
+
+Cada ação tem uma `Regra` (níveis permitidos + a partir de que nível o acesso é
+de todas as unidades). A rota recebe um `Acesso` via Depends e, em vez de ler a
+linha para conferir a unidade antes de gravar, aplica o escopo no próprio
+filtro da consulta/escrita:
+
+    acesso.escopar(supabase.table("x").update(d).eq("id", id)).execute()
+
+Se a linha é de outra unidade o UPDATE simplesmente não casa com nada, e
+`acesso.exigir_linhas` transforma isso em 404. Uma ida ao banco em vez de duas.
+"""
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, FrozenSet, Optional
+
+from fastapi import Header, HTTPException
+
+# Nível a partir do qual o colaborador enxerga todas as unidades (Diretoria)
+NIVEL_TODAS_UNIDADES = 9
+
+
+@dataclass(frozen=True)
+class Regra:
+    niveis: Optional[FrozenSet[int]] = None     # níveis exatos permitidos
+    nivel_minimo: Optional[int] = None          # ou: qualquer nível a partir deste
+    todas_unidades_a_partir: int = NIVEL_TODAS_UNIDADES
+    mensagem: str = "Sem permissão."
+
+    def permite(self, nivel: int) -> bool:
+        if self.niveis is not None and nivel not in self.niveis:
+            return False
+        if self.nivel_minimo is not None and nivel < self.nivel_minimo:
+            return False
+        return True
+
+
+_FESTAS = Regra(niveis=frozenset({8, 9, 10}), mensagem="Acesso restrito (nível 8/9/10).")
+_LEADS = Regra(niveis=frozenset({3, 4, 8, 9, 10}))
+
+POLITICAS: Dict[str, Regra] = {
+    "festas.ler": _FESTAS,
+    "festas.gravar": _FESTAS,
+    "leads.ler": Regra(),
+    "leads.gravar": _LEADS,
+    "alunos.ler": Regra(),
+    "alunos.gravar": Regra(nivel_minimo=8, mensagem="Acesso restrito à Gerência."),
+    "diretoria": Regra(nivel_minimo=9, mensagem="Acesso restrito à Diretoria."),
+}
+
+
+class Acesso:
+    """Contexto do colaborador + regra da ação, com os filtros de unidade prontos."""
+
+    def __init__(self, ctx: Dict[str, Any], regra: Regra):
+        self.ctx = ctx
+        self.regra = regra
+
+    @property
+    def nivel(self) -> int:
+        return self.ctx["nivel"]
+
+    @property
+    def restrito_a_unidade(self) -> bool:
+        return self.nivel < self.regra.todas_unidades_a_partir
+
+    def escopar(self, query, coluna: str = "id_unidade", id_unidade: Optional[int] = None):
+        """Filtra pela unidade do colaborador; quem vê todas pode filtrar por `id_unidade`."""
+        if self.restrito_a_unidade:
+            return query.eq(coluna, self.ctx["id_unidade"])
+        if id_unidade:
+            return query.eq(coluna, id_unidade)
+        return query
+
+    def unidade_para_gravar(self, informada: Optional[int], padrao: Optional[int] = None) -> Optional[int]:
+        """Unidade de um registro novo: a do colaborador, se ele for restrito."""
+        if self.restrito_a_unidade:
+            return self.ctx["id_unidade"]
+        return informada or padrao
+
+    def exigir_linhas(self, resp, mensagem: str = "Registro não encontrado (ou de outra unidade).") -> list:
+        if not resp.data:
+            raise HTTPException(status_code=404, detail=mensagem)
+        return resp.data
+
+
+def dependencia(acao: str, obter_contexto: Callable[[str], Dict[str, Any]]):
+    """Cria a dependência FastAPI da ação: autentica, aplica a regra e devolve o Acesso."""
+    regra = POLITICAS[acao]
+
+    def _dep(authorization: str = Header(None)) -> Acesso:
+        if not authorization:
+            raise HTTPException(status_code=401)
+        token = authorization.split(" ")[-1]
+        ctx = obter_contexto(token)
+        if not regra.permite(ctx["nivel"]):
+            raise HTTPException(status_code=403, detail=regra.mensagem)
+        return Acesso(ctx, regra)
+
+    return _dep
@@ -0,0 +1,156 @@
+"""
+Resumo de faturamento das festas de aniversário por unidade, vendedor e mês.
+
+`tb_festas_resumo` guarda um registro por (id_unidade, id_vendedor, mes) com
+receita, quantidade e quantidade com kit. Criar/editar uma festa recalcula só os
+grupos afetados (no máximo dois: o de antes e o de depois da edição), lendo as
+festas daquele grupo. Recalcular o grupo inteiro, em vez de somar/subtrair
+diferenças, deixa a operação idempotente: duas edições concorrentes ou uma
+falha no meio não deixam o total torto. O relatório lê só o resumo.
+
+Colunas esperadas em tb_festas_resumo: id_unidade, id_vendedor, mes (YYYY-MM),
+qtd, qtd_kit, qtd_canceladas, receita, receita_paga, atualizado_em, com
+unique (id_unidade, id_vendedor, mes).
+"""
+import logging
+from datetime import date, datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# id_vendedor nulo vira 0: no unique do Postgres, NULLs nunca colidem
+SEM_VENDEDOR = 0
+
+Grupo = Tuple[int, int, str]
+
+
+def _mes(data_festa: Optional[str]) -> Optional[str]:
+    if not data_festa:
+        return None
+    return str(data_festa)[:7]
+
+
+def _cancelada(status: Optional[str]) -> bool:
+    return "CANCEL" in (status or "").upper()
+
+
+def grupo_da_festa(festa: dict) -> Optional[Grupo]:
+    mes = _mes(festa.get("data_festa"))
+    if not mes or not festa.get("id_unidade"):
+        return None
+    return (festa["id_unidade"], festa.get("id_vendedor") or SEM_VENDEDOR, mes)
+
+
+def _intervalo_mes(mes: str) -> Tuple[str, str]:
+    ano, m = int(mes[:4]), int(mes[5:7])
+    inicio = date(ano, m, 1)
+    fim = date(ano + (m == 12), m % 12 + 1, 1)
+    return inicio.isoformat(), fim.isoformat()
+
+
+def _zerado() -> dict:
+    return {"qtd": 0, "qtd_kit": 0, "qtd_canceladas": 0, "receita": 0.0, "receita_paga": 0.0}
+
+
+def agregar(festas: Iterable[dict]) -> Dict[Grupo, dict]:
+    grupos: Dict[Grupo, dict] = {}
+    for f in festas:
+        grupo = grupo_da_festa(f)
+        if not grupo:
+            continue
+        g = grupos.setdefault(grupo, _zerado())
+        if _cancelada(f.get("status")):
+            g["qtd_canceladas"] += 1
+            continue
+        valor = float(f.get("valor") or 0)
+        g["qtd"] += 1
+        g["qtd_kit"] += 1 if f.get("kit_festa") else 0
+        g["receita"] += valor
+        if f.get("data_pagamento"):
+            g["receita_paga"] += valor
+    return grupos
+
+
+def _linha(grupo: Grupo, valores: dict) -> dict:
+    id_unidade, id_vendedor, mes = grupo
+    return {
+        "id_unidade": id_unidade,
+        "id_vendedor": id_vendedor,
+        "mes": mes,
+        **{k: round(v, 2) if isinstance(v, float) else v for k, v in valores.items()},
+        "atualizado_em": datetime.now().isoformat(),
+    }
+
+
+def recalcular_grupos(cliente, grupos: Iterable[Optional[Grupo]]) -> None:
+    """Recalcula os grupos informados a partir das festas (ignora None)."""
+    linhas = []
+    for grupo in {g for g in grupos if g}:
+        id_unidade, id_vendedor, mes = grupo
+        inicio, fim = _intervalo_mes(mes)
+        query = cliente.table("tb_festas_aniversario")\
+            .select("id_unidade, id_vendedor, data_festa, valor, kit_festa, data_pagamento, status")\
+            .eq("id_unidade", id_unidade)\
+            .gte("data_festa", inicio)\
+            .lt("data_festa", fim)
+        if id_vendedor == SEM_VENDEDOR:
+            query = query.is_("id_vendedor", "null")
+        else:
+            query = query.eq("id_vendedor", id_vendedor)
+        agregado = agregar(query.execute().data or [])
+        # grupo que ficou vazio continua no resumo, zerado
+        linhas.append(_linha(grupo, agregado.get(grupo) or _zerado()))
+    if linhas:
+        cliente.table("tb_festas_resumo").upsert(linhas, on_conflict="id_unidade,id_vendedor,mes").execute()
+
+
+def atualizar_apos_alteracao(cliente, antes: Optional[dict], depois: Optional[dict]) -> None:
+    """Chamado (em background) depois de criar/editar uma festa."""
+    try:
+        recalcular_grupos(cliente, [
+            grupo_da_festa(antes) if antes else None,
+            grupo_da_festa(depois) if depois else None,
+        ])
+    except Exception as e:
+        logger.exception(f"Erro ao atualizar resumo de festas: {e}")
+
+
+def reconstruir(cliente, lote: int = 1000) -> int:
+    """Recalcula o resumo inteiro (carga inicial e correção de deriva)."""
+    def todas():
+        ultimo = 0
+        while True:
+            pagina = cliente.table("tb_festas_aniversario")\
+                .select("id, id_unidade, id_vendedor, data_festa, valor, kit_festa, data_pagamento, status")\
+                .gt("id", ultimo).order("id").limit(lote).execute().data or []
+            yield from pagina
+            if len(pagina) < lote:
+                return
+            ultimo = pagina[-1]["id"]
+
+    linhas = [_linha(g, v) for g, v in agregar(todas()).items()]
+    for i in range(0, len(linhas), lote):
+        cliente.table("tb_festas_resumo").upsert(linhas[i:i + lote], on_conflict="id_unidade,id_vendedor,mes").execute()
+    return len(linhas)
+
+
+def relatorio(linhas: Iterable[dict], agrupar: List[str]) -> List[dict]:
+    """Soma as linhas do resumo pelas dimensões pedidas (unidade/vendedor/mes)."""
+    colunas = {"unidade": "id_unidade", "vendedor": "id_vendedor", "mes": "mes"}
+    chaves = [colunas[a] for a in agrupar]
+    res: Dict[tuple, dict] = {}
+    for l in linhas:
+        k = tuple(l.get(c) for c in chaves)
+        r = res.setdefault(k, {**dict(zip(chaves, k)), **_zerado()})
+        for campo in ("qtd", "qtd_kit", "qtd_canceladas"):
+            r[campo] += l.get(campo) or 0
+        for campo in ("receita", "receita_paga"):
+            r[campo] += float(l.get(campo) or 0)
+    saida = []
+    for r in res.values():
+        r["receita"] = round(r["receita"], 2)
+        r["receita_paga"] = round(r["receita_paga"], 2)
+        r["ticket_medio"] = round(r["receita"] / r["qtd"], 2) if r["qtd"] else 0.0
+        r["taxa_kit"] = round(r["qtd_kit"] / r["qtd"], 3) if r["qtd"] else 0.0
+        saida.append(r)
+    return sorted(saida, key=lambda r: tuple(str(r[c]) for c in chaves))
@@ -1,14 +1,23 @@
 """
 Rotas administrativas do sistema
 """
+import hashlib
 import os
-from fastapi import APIRouter, HTTPException, Header, UploadFile, File, Form
+from fastapi import APIRouter, Response, HTTPException, Header, UploadFile, File, Form, Depends, BackgroundTasks
 from pydantic import BaseModel
 from supabase import create_client, Client
 from datetime import datetime, timedelta
 import requests
 import logging
 from typing import Optional
+from app.carregador import Carregador
+from app.logs import definir_usuario
+from app import arquivo_chat, busca_chat, calendario, chat_grupo, chat_nao_lidas, disponibilidade, duplicidade, exportacao, frequencia, ingestao, paralelo, politicas, resumo_festas, uploads, versoes_aula
+from app.agendador import agendador
+from app.limitador import limitador
+from app.cache import CacheCurto, cache
+from app.singleflight import chave_consulta
+from app.rotas_aluno import cache_cursos_didaticos
 from app.modelos import (
     FestaAniversarioCreate,
     FestaAniversarioUpdate,
@@ -22,8 +31,10 @@ from app.modelos import (
     ReposicaoData,
     ChatAdminReply,
     StatusUpdateData,
+    LeadsStatusLoteData,
     NovoFuncionarioData,
     AulaConteudoData,
+    FeriadoData,
     MensagemDiretaData, # <--- Verifique se está aqui
     MensagemGrupoData   # <--- Verifique se está aqui
 )
@@ -64,13 +75,6 @@ ZAPI_INSTANCE_ID = os.getenv("ZAPI_INSTANCE_ID")
 ZAPI_TOKEN = os.getenv("ZAPI_TOKEN")
 ZAPI_BASE_URL = f"https://api.z-api.io/instances/{ZAPI_INSTANCE_ID}/token/{ZAPI_TOKEN}/send-text"
 
-# Dicionário para traduzir dia da semana
-DIAS_MAPA = {
-    "Segunda": 0, "Segunda-feira": 0, "Terça": 1, "Terça-feira": 1,
-    "Quarta": 2, "Quarta-feira": 2, "Quinta": 3, "Quinta-feira": 3,
-    "Sexta": 4, "Sexta-feira": 4, "Sábado": 5, "Sabado": 5, "Domingo": 6
-}
-
 MAPA_CURSOS = {
     "GAME PRO": "game-pro",
     "DESIGNER START": "designer-start",
@@ -80,6 +84,11 @@ MAPA_CURSOS = {
 
 # --- FUNÇÕES AUXILIARES ---
 
+def _carregador() -> Carregador:
+    # Um por requisição (Depends): memoiza e agrupa buscas só dentro dela
+    return Carregador(supabase)
+
+
 def enviar_mensagem_zapi(telefone_destino: str, mensagem_texto: str):
     headers = {"Content-Type": "application/json"}
     payload = {"phone": telefone_destino, "message": mensagem_texto}
@@ -87,29 +96,43 @@ def enviar_mensagem_zapi(telefone_destino: str, mensagem_texto: str):
         response = requests.post(ZAPI_BASE_URL, json=payload, headers=headers)
         return response.status_code == 200
     except Exception as e:
-        print(f"Erro Z-API: {e}")
+        logger.exception(f"Erro Z-API: {e}")
         return False
 
 
-def calcular_previsao(data_inicio_str: str, qtd: int):
+def calcular_previsao(data_inicio_str: str, qtd: int, dia_semana: str | None = None, id_unidade: int | None = None):
+    # Mesma regra do calendário materializado (dia da semana + feriados)
     if not data_inicio_str or not qtd:
         return None
     try:
-        dt_inicio = datetime.strptime(data_inicio_str, "%Y-%m-%d")
-        dias_totais = (qtd - 1) * 7
-        dt_fim = dt_inicio + timedelta(days=dias_totais)
-        return dt_fim.strftime("%Y-%m-%d")
+        feriados = calendario.carregar_feriados(supabase, id_unidade)
+        datas = calendario.calcular_datas(data_inicio_str, dia_semana, qtd, feriados)["datas"]
+        return datas[-1].strftime("%Y-%m-%d") if datas else None
     except:
         return None
 
 
+# Contexto do colaborador por token (evita auth + consulta a cada rota)
+CONTEXTO_CACHE_TTL = float(os.getenv("CONTEXTO_CACHE_TTL", "60"))
+
+
 def get_contexto_usuario(token: str):
+    ctx = cache.obter(
+        "contexto", hashlib.sha256(token.encode()).hexdigest(),
+        lambda: _montar_contexto_usuario(token), CONTEXTO_CACHE_TTL
+    )
+    definir_usuario(ctx["user_id"])
+    return ctx
+
+
+def _montar_contexto_usuario(token: str):
     try:
         user = supabase.auth.get_user(token)
         user_id = user.user.id
+        definir_usuario(user_id)
         
         resp = supabase.table("tb_colaboradores")\
-            .select("id_colaborador, id_unidade, id_cargo, tb_cargos!fk_cargos(nivel_acesso)")\
+            .select("id_colaborador, nome_completo, id_unidade, id_cargo, tb_cargos!fk_cargos(nivel_acesso)")\
             .eq("user_id", user_id)\
             .single()\
             .execute()
@@ -118,15 +141,21 @@ def get_contexto_usuario(token: str):
         return {
             "user_id": user_id,
             "id_colaborador": dados['id_colaborador'],
+            "nome": dados.get('nome_completo'),
             "id_unidade": dados['id_unidade'],
             "id_cargo": dados['id_cargo'],
             "nivel": dados['tb_cargos']['nivel_acesso']
         }
     except Exception as e:
-        print(f"Erro contexto usuario: {e}")
+        logger.exception(f"Erro contexto usuario: {e}")
         raise HTTPException(status_code=401, detail="Usuário não identificado.")
 
 
+def exigir(acao: str):
+    """Depends com a política da ação (níveis + escopo de unidade, ver app/politicas.py)."""
+    return Depends(politicas.dependencia(acao, get_contexto_usuario))
+
+
 # --- ROTAS ---
 # As rotas serão adicionadas abaixo
 
@@ -167,7 +196,7 @@ def admin_listar_equipe(filtro_unidade: int | None = None, authorization: str =
             
         return query.execute().data
     except Exception as e:
-        print(f"Erro listar equipe: {e}")
+        logger.exception(f"Erro listar equipe: {e}")
         return []
         
 
@@ -201,7 +230,7 @@ def admin_cadastrar_funcionario(dados: NovoFuncionarioData, authorization: str =
 
         return {"message": "Funcionário cadastrado com sucesso!"}
     except Exception as e:
-        print(f"Erro cadastro func: {e}")
+        logger.exception(f"Erro cadastro func: {e}")
         raise HTTPException(status_code=400, detail="Erro ao criar funcionário.")
 
 
@@ -223,11 +252,15 @@ def admin_editar_funcionario(id_colaborador: int, dados: FuncionarioEdicaoData,
         if dados.ativo is not None: updates["ativo"] = dados.ativo
 
         if updates:
-            supabase.table("tb_colaboradores").update(updates).eq("id_colaborador", id_colaborador).execute()
+            resp = supabase.table("tb_colaboradores").update(updates).eq("id_colaborador", id_colaborador).execute()
+            # cargo/ativo mudam o contexto em cache de todos os workers
+            cache.invalidar("contexto")
+            if resp.data and ("nome_completo" in updates or "id_cargo" in updates):
+                chat_grupo.invalidar_identidade(resp.data[0].get("user_id"))
 
         return {"message": "Funcionário atualizado com sucesso!"}
     except Exception as e:
-        print(f"Erro update func: {e}")
+        logger.exception(f"Erro update func: {e}")
         raise HTTPException(status_code=400, detail="Erro ao atualizar funcionário.")
 
 # 2. GESTÃO DE TURMAS
@@ -244,7 +277,7 @@ def admin_listar_turmas_completo(authorization: str = Header(None)):
             query = query.eq("id_unidade", ctx['id_unidade'])
         return query.execute().data
     except Exception as e:
-        print(f"Erro listar turmas: {e}")
+        logger.exception(f"Erro listar turmas: {e}")
         return []
 
 
@@ -255,7 +288,7 @@ def admin_salvar_turma(dados: TurmaData, authorization: str = Header(None)):
     ctx = get_contexto_usuario(token)
 
     try:
-        previsao = calcular_previsao(dados.data_inicio, dados.qtd_aulas)
+        previsao = calcular_previsao(dados.data_inicio, dados.qtd_aulas, dados.dia_semana, ctx['id_unidade'])
         supabase.table("tb_turmas").insert({
             "codigo_turma": dados.codigo.upper(),
             "id_professor": dados.id_professor,
@@ -271,6 +304,7 @@ def admin_salvar_turma(dados: TurmaData, authorization: str = Header(None)):
             "data_termino_real": dados.data_termino_real,
             "id_unidade": ctx['id_unidade']
         }).execute()
+        calendario.invalidar(dados.codigo.upper())
         return {"message": "Turma criada!"}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -280,7 +314,11 @@ def admin_salvar_turma(dados: TurmaData, authorization: str = Header(None)):
 def admin_editar_turma(codigo_original: str, dados: TurmaData, authorization: str = Header(None)):
     if not authorization: raise HTTPException(status_code=401)
     try:
-        previsao = calcular_previsao(dados.data_inicio, dados.qtd_aulas)
+        # Feriados da unidade da turma, como no salvar-turma e no calendário
+        turma = supabase.table("tb_turmas").select("id_unidade").eq("codigo_turma", codigo_original).limit(1).execute().data
+        if not turma:
+            raise HTTPException(status_code=404, detail="Turma não encontrada.")
+        previsao = calcular_previsao(dados.data_inicio, dados.qtd_aulas, dados.dia_semana, turma[0].get("id_unidade"))
         supabase.table("tb_turmas").update({
             "id_professor": dados.id_professor,
             "nome_curso": dados.curso,
@@ -294,7 +332,12 @@ def admin_editar_turma(codigo_original: str, dados: TurmaData, authorization: st
             "previsao_termino": previsao,
             "data_termino_real": dados.data_termino_real
         }).eq("codigo_turma", codigo_original).execute()
+        calendario.invalidar(codigo_original)
+        # curso/data de início fazem parte do contexto dos alunos
+        cache.invalidar("aluno_contexto")
         return {"message": "Turma atualizada!"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -350,7 +393,7 @@ def admin_listar_cursos_didaticos(authorization: str = Header(None)):
                 
         return resp.data
     except Exception as e:
-        print(f"Erro ao listar cursos didáticos: {e}")
+        logger.exception(f"Erro ao listar cursos didáticos: {e}")
         return []
 
 @router.get("/meus-cursos-permitidos")
@@ -386,7 +429,7 @@ def get_cursos_permitidos(authorization: str = Header(None)):
             
         return {"cursos": cursos_permitidos}
     except Exception as e:
-        print(f"Erro cursos permitidos: {e}")
+        logger.exception(f"Erro cursos permitidos: {e}")
         return {"cursos": []}
 
 @router.get("/conteudo-aula")
@@ -430,7 +473,7 @@ def get_conteudo_aula(titulo: str):
             "desafio": desafio
         }
     except Exception as e:
-        print(f"Erro ao buscar conteúdo: {e}")
+        logger.exception(f"Erro ao buscar conteúdo: {e}")
         return {"titulo": titulo, "script": "Erro ao carregar conteúdo."}
         
 # 4. CADASTRO DE ALUNO
@@ -493,6 +536,7 @@ def admin_cadastrar_aluno(dados: NovoAlunoData, authorization: str = Header(None
         if not mat_resp.data:
             raise Exception("Falha ao inserir matrícula em tb_matriculas.")
 
+        duplicidade.invalidar()
         return {"message": "Sucesso!", "id_aluno": novo_id_aluno, "user_id": new_user_id}
 
     except Exception as e:
@@ -515,23 +559,19 @@ def admin_cadastrar_aluno(dados: NovoAlunoData, authorization: str = Header(None
 
 
 @router.get("/listar-alunos")
-def admin_listar_alunos(authorization: str = Header(None)):
-    if not authorization: raise HTTPException(status_code=401)
-    token = authorization.split(" ")[1]
-    ctx = get_contexto_usuario(token)
+def admin_listar_alunos(acesso: politicas.Acesso = exigir("alunos.ler")):
     try:
         # Agora buscamos também o 'tipo_turma' dentro de tb_turmas, através da matrícula
         query = supabase.table("tb_alunos").select("*, tb_matriculas(codigo_turma, status_financeiro, tb_turmas(tipo_turma, dia_semana))")
-        if ctx['nivel'] < 9: query = query.eq("id_unidade", ctx['id_unidade'])
-        return query.execute().data
+        return acesso.escopar(query).execute().data
     except Exception as e: 
-        print(f"Erro listar alunos: {e}")
+        logger.exception(f"Erro listar alunos: {e}")
         return []
 
 # 5. REPOSIÇÕES E AGENDA
 
 @router.delete("/reposicao/{id_repo}")
-def deletar_reposicao(id_repo: str, authorization: str = Header(None)):
+def deletar_reposicao(id_repo: str, background_tasks: BackgroundTasks, authorization: str = Header(None)):
     if not authorization: raise HTTPException(status_code=401)
     
     token = authorization.split(" ")[1]
@@ -542,16 +582,18 @@ def deletar_reposicao(id_repo: str, authorization: str = Header(None)):
         raise HTTPException(status_code=403, detail="Você não tem permissão para excluir esta reposição.")
 
     try:
-        supabase.table("tb_reposicoes").delete().eq("id", id_repo).execute()
+        removida = supabase.table("tb_reposicoes").delete().eq("id", id_repo).execute()
+        if removida.data:
+            background_tasks.add_task(frequencia.atualizar_por_reposicao, supabase, id_repo, removida.data[0].get("id_aluno"))
         return {"message": "Reposição excluída com sucesso."}
     except Exception as e:
-        print(f"Erro delete repo: {e}")
+        logger.exception(f"Erro delete repo: {e}")
         raise HTTPException(status_code=500, detail="Erro ao excluir.")
         
     return False
 
 @router.post("/agendar-reposicao")
-def admin_reposicao(dados: ReposicaoData, authorization: str = Header(None)):
+def admin_reposicao(dados: ReposicaoData, background_tasks: BackgroundTasks, authorization: str = Header(None)):
     if not authorization: raise HTTPException(status_code=401)
     try:
         token = authorization.split(" ")[1]
@@ -564,19 +606,13 @@ def admin_reposicao(dados: ReposicaoData, authorization: str = Header(None)):
         resp_turmas = supabase.table("tb_turmas").select("*").eq("id_professor", dados.id_professor).in_("status", ["Em Andamento", "Planejada"]).execute()
 
         for turma in resp_turmas.data:
-            if not turma['data_inicio'] or not turma['qtd_aulas'] or not turma['horario']: continue
-            dt_inicio_turma = datetime.strptime(turma['data_inicio'], "%Y-%m-%d")
-            dia_alvo = DIAS_MAPA.get(turma['dia_semana'].split("-")[0].strip(), 0)
-            dias_diff = (dia_alvo - dt_inicio_turma.weekday() + 7) % 7
-            dt_aula_atual = dt_inicio_turma + timedelta(days=dias_diff)
-            hora_h, hora_m = map(int, turma['horario'].split("-")[0].strip().split(":"))
-
-            for _ in range(turma['qtd_aulas']):
-                inicio_aula = dt_aula_atual.replace(hour=hora_h, minute=hora_m)
-                fim_aula = inicio_aula + timedelta(hours=2, minutes=30)
+            cal = calendario.obter_calendario(supabase, turma['codigo_turma'], turma)
+            for aula in cal["aulas"]:
+                if not aula["inicio"]: continue
+                inicio_aula = datetime.strptime(aula["inicio"], "%Y-%m-%dT%H:%M")
+                fim_aula = datetime.strptime(aula["fim"], "%Y-%m-%dT%H:%M")
                 if (dt_repo_inicio < fim_aula) and (dt_repo_fim > inicio_aula):
                     raise HTTPException(status_code=409, detail=f"Conflito de horário com turma {turma['codigo_turma']}.")
-                dt_aula_atual += timedelta(days=7)
 
         supabase.table("tb_reposicoes").insert({
             "id_aluno": dados.id_aluno,
@@ -590,12 +626,95 @@ def admin_reposicao(dados: ReposicaoData, authorization: str = Header(None)):
             "status": "Agendada",
             "presenca": None 
         }).execute()
+        background_tasks.add_task(frequencia.atualizar_alunos, supabase, [dados.id_aluno])
         
         return {"message": "Agendada com sucesso!"}
     except HTTPException as he: raise he
     except Exception as e: raise HTTPException(status_code=400, detail="Erro interno.")
         
 
+# Janela máxima da busca de horários livres (dias)
+HORARIOS_LIVRES_MAX_DIAS = 62
+
+
+@router.get("/reposicao/horarios-livres")
+def horarios_livres_reposicao(
+    id_professor: int,
+    data_ini: str,
+    data_fim: str,
+    sala: Optional[str] = None,
+    duracao_min: int = 60,
+    passo_min: int = 30,
+    authorization: str = Header(None)
+):
+    """Slots livres do professor (e da sala, se informada) no período, dentro do expediente."""
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    ctx = get_contexto_usuario(token)
+
+    try:
+        ini = datetime.strptime(data_ini, "%Y-%m-%d").date()
+        fim = datetime.strptime(data_fim, "%Y-%m-%d").date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Datas no formato AAAA-MM-DD.")
+    if fim < ini or (fim - ini).days > HORARIOS_LIVRES_MAX_DIAS:
+        raise HTTPException(status_code=400, detail=f"Período inválido (máximo {HORARIOS_LIVRES_MAX_DIAS} dias).")
+    if duracao_min < 15 or passo_min < 5:
+        raise HTTPException(status_code=400, detail="Duração mínima de 15 min e passo mínimo de 5 min.")
+
+    colunas_turma = "codigo_turma, nome_curso, id_professor, dia_semana, horario, sala, data_inicio, qtd_aulas, id_unidade"
+
+    def turmas_do_professor():
+        return supabase.table("tb_turmas").select(colunas_turma)\
+            .eq("id_professor", id_professor)\
+            .in_("status", ["Em Andamento", "Planejada"])\
+            .execute().data or []
+
+    def turmas_da_sala():
+        if not sala:
+            return []
+        query = supabase.table("tb_turmas").select(colunas_turma)\
+            .eq("sala", sala)\
+            .in_("status", ["Em Andamento", "Planejada"])
+        if ctx['nivel'] < 9:
+            query = query.eq("id_unidade", ctx['id_unidade'])
+        return query.execute().data or []
+
+    def reposicoes():
+        return supabase.table("tb_reposicoes").select("data_reposicao, status")\
+            .eq("id_professor", id_professor)\
+            .gte("data_reposicao", ini.isoformat())\
+            .lt("data_reposicao", (fim + timedelta(days=1)).isoformat())\
+            .execute().data or []
+
+    try:
+        r = paralelo.reunir(professor=turmas_do_professor, sala=turmas_da_sala, reposicoes=reposicoes)
+
+        ocupados = []
+        turmas = {t["codigo_turma"]: t for t in r["professor"] + r["sala"]}
+        for codigo, turma in turmas.items():
+            cal = calendario.obter_calendario(supabase, codigo, turma)
+            ocupados.extend(disponibilidade.aulas_do_calendario(cal, ini, fim))
+        for rep in r["reposicoes"]:
+            if "CANCEL" in (rep.get("status") or "").upper() or not rep.get("data_reposicao"):
+                continue
+            inicio_rep = datetime.strptime(rep["data_reposicao"][:16], "%Y-%m-%dT%H:%M")
+            ocupados.append((inicio_rep, inicio_rep + disponibilidade.DURACAO_REPOSICAO))
+
+        id_unidade = next((t.get("id_unidade") for t in r["professor"]), None) or ctx['id_unidade']
+        slots = disponibilidade.horarios_livres(
+            ocupados, ini, fim,
+            feriados=calendario.carregar_feriados(supabase, id_unidade),
+            duracao=timedelta(minutes=duracao_min),
+            passo=timedelta(minutes=passo_min),
+            agora=datetime.now(),
+        )
+        return {"id_professor": id_professor, "sala": sala, "duracao_min": duracao_min, "slots": slots}
+    except Exception as e:
+        logger.exception(f"Erro horarios livres: {e}")
+        raise HTTPException(status_code=500, detail="Erro ao calcular horários livres.")
+
+
 @router.get("/agenda-geral")
 def admin_agenda(authorization: str = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
@@ -666,13 +785,13 @@ def admin_agenda(authorization: str = Header(None)):
         return eventos
 
     except Exception as e:
-        print(f"Erro agenda: {e}")
+        logger.exception(f"Erro agenda: {e}")
         return []
 
 
 
 @router.put("/reposicao-completa/{id_repo}")
-def atualizar_reposicao_completa(id_repo: str, presenca: str = Form(...), observacoes: str = Form(None), arquivo: UploadFile = File(None), authorization: str = Header(None)):
+def atualizar_reposicao_completa(background_tasks: BackgroundTasks, id_repo: str, presenca: str = Form(...), observacoes: str = Form(None), arquivo: UploadFile = File(None), authorization: str = Header(None)):
     if not authorization: raise HTTPException(status_code=401)
     try:
         presenca_bool = None
@@ -681,14 +800,19 @@ def atualizar_reposicao_completa(id_repo: str, presenca: str = Form(...), observ
         updates = { "presenca": presenca_bool, "observacoes": observacoes }
 
         if arquivo:
-            file_content = arquivo.file.read()
-            file_ext = arquivo.filename.split('.')[-1]
-            file_path = f"assinatura_{id_repo}.{file_ext}" 
-            supabase.storage.from_("listas-chamada").upload(file_path, file_content, file_options={"content-type": arquivo.content_type, "upsert": "true"})
-            updates["arquivo_assinatura"] = supabase.storage.from_("listas-chamada").get_public_url(file_path)
+            # Só grava no staging (em blocos, com limite); o envio ao Storage é em segundo plano.
+            # Fotos viram JPEG otimizado (+ miniatura), outros formatos sobem como vieram;
+            # a URL de arquivo_assinatura é gravada depois do envio, já com o nome final.
+            staging = uploads.salvar_em_staging(
+                arquivo, "listas-chamada", f"assinatura_{id_repo}", thumb=True,
+                registrar={"tabela": "tb_reposicoes", "coluna": "arquivo_assinatura", "id_coluna": "id", "id": id_repo},
+            )
+            background_tasks.add_task(uploads.processar_staging, supabase, staging)
 
         supabase.table("tb_reposicoes").update(updates).eq("id", id_repo).execute()
+        background_tasks.add_task(frequencia.atualizar_por_reposicao, supabase, id_repo)
         return {"message": "Atualizado!"}
+    except HTTPException: raise
     except Exception as e: raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -720,7 +844,7 @@ def atualizar_dados_reposicao(id_repo: str, dados: ReposicaoEdicaoData, authoriz
         
 
 @router.patch("/reposicao/{id_repo}")
-def atualizar_reposicao_status(id_repo: str, dados: ReposicaoUpdate, authorization: str = Header(None)):
+def atualizar_reposicao_status(id_repo: str, dados: ReposicaoUpdate, background_tasks: BackgroundTasks, authorization: str = Header(None)):
     if not authorization: raise HTTPException(status_code=401)
     token = authorization.split(" ")[1]
     ctx = get_contexto_usuario(token)
@@ -731,16 +855,14 @@ def atualizar_reposicao_status(id_repo: str, dados: ReposicaoUpdate, authorizati
 
     try:
         supabase.table("tb_reposicoes").update({"presenca": dados.presenca, "observacoes": dados.observacoes}).eq("id", id_repo).execute()
+        background_tasks.add_task(frequencia.atualizar_por_reposicao, supabase, id_repo)
         return {"message": "OK"}
     except: raise HTTPException(status_code=400)
 
 # 6. CRM / LEADS
 
 @router.get("/leads-crm")
-def get_leads_crm(filtro_unidade: int | None = None, authorization: str = Header(None)):
-    if not authorization: raise HTTPException(status_code=401)
-    token = authorization.split(" ")[1]
-    ctx = get_contexto_usuario(token)
+def get_leads_crm(filtro_unidade: int | None = None, acesso: politicas.Acesso = exigir("leads.ler")):
     
     try:
         # Tenta buscar os leads. 
@@ -748,23 +870,20 @@ def get_leads_crm(filtro_unidade: int | None = None, authorization: str = Header
         # Se não tiver, crie a coluna ou remova os filtros de .eq("id_unidade") abaixo.
         query = supabase.table("inscricoes").select("*").order("created_at", desc=True)
         
-        # Filtros de Unidade
-        if ctx['nivel'] < 9:
-            # Se for Vendedor, tenta filtrar. Se a coluna nao existir, isso pode dar erro.
-            # Se der erro, remova essa linha temporariamente até criar a coluna no banco.
-            query = query.eq("id_unidade", ctx['id_unidade'])
-        elif filtro_unidade:
-            query = query.eq("id_unidade", filtro_unidade)
+        # Filtros de Unidade (vendedor: a dele; diretoria: a do filtro, se vier)
+        # Se a coluna nao existir, isso pode dar erro: crie a coluna no banco.
+        query = acesso.escopar(query, id_unidade=filtro_unidade)
 
         leads = query.execute().data
         
-        # Busca CPFs de alunos para comparar
-        alunos = supabase.table("tb_alunos").select("cpf").execute().data
-        cpfs = set(''.join(filter(str.isdigit, a['cpf'])) for a in alunos if a.get('cpf'))
+        # Compara com os alunos por CPF, telefone, e-mail e nome (índice de blocos, ver app/duplicidade.py)
+        indice = duplicidade.obter_indice(supabase)
         
         res = []
         for l in leads:
-            cpf_l = ''.join(filter(str.isdigit, l.get('cpf','') or ''))
+            achado = indice.melhor(duplicidade.registro(
+                nome=l.get('nome'), cpf=l.get('cpf'), email=l.get('email'), telefones=(l.get('whatsapp'),)
+            )) if indice else None
             res.append({
                 "id": l['id'], 
                 "nome": l['nome'], 
@@ -774,27 +893,72 @@ def get_leads_crm(filtro_unidade: int | None = None, authorization: str = Header
                 "data_agendada": l['data_agendada'], 
                 "status": l.get('status','Pendente'),
                 "vendedor": l.get('vendedor','-'), 
-                "ja_e_aluno": (cpf_l in cpfs and cpf_l != ''),
+                "ja_e_aluno": bool(achado and achado["provavel"]),
+                "possivel_aluno": achado,
                 "id_unidade": l.get('id_unidade') 
             })
         return res
     except Exception as e:
-        print(f"Erro CRM: {e}") 
+        logger.exception(f"Erro CRM: {e}") 
         # Retorna lista vazia em vez de erro 500 para não travar a tela
         return []
 
 
+# Declarada antes de /leads-crm/{id_inscricao} para "lote" não cair no parâmetro
+@router.patch("/leads-crm/lote")
+def atualizar_status_leads_lote(dados: LeadsStatusLoteData, acesso: politicas.Acesso = exigir("leads.gravar")):
+    ctx = acesso.ctx
+
+    ids = list(dict.fromkeys(dados.ids))
+    if not ids:
+        return {"atualizados": 0, "resultados": []}
+    if len(ids) > 500:
+        raise HTTPException(status_code=400, detail="Máximo de 500 leads por vez.")
+
+    try:
+        # Vendedor: quem está logado (nome já vem do contexto em cache) ou outro, escolhido pela gerência
+        if dados.id_vendedor and dados.id_vendedor != ctx['id_colaborador']:
+            if ctx['nivel'] < 8:
+                raise HTTPException(status_code=403, detail="Só a gerência atribui leads a outro vendedor.")
+            resp = supabase.table("tb_colaboradores").select("nome_completo").eq("id_colaborador", dados.id_vendedor).execute()
+            if not resp.data:
+                raise HTTPException(status_code=404, detail="Vendedor não encontrado.")
+            nome = resp.data[0]['nome_completo']
+        else:
+            nome = _nome_colaborador(ctx)
+
+        # Um único UPDATE filtrado; o escopo de unidade vai no próprio filtro
+        query = supabase.table("inscricoes").update({"status": dados.status, "vendedor": nome}).in_("id", ids)
+        atualizados = {l['id'] for l in (acesso.escopar(query).execute().data or [])}
+
+        resultados = [
+            {"id": i, "ok": i in atualizados, "erro": None if i in atualizados else "Lead não encontrado ou de outra unidade"}
+            for i in ids
+        ]
+        return {"atualizados": len(atualizados), "status": dados.status, "vendedor": nome, "resultados": resultados}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"Erro atualizar leads em lote: {e}")
+        raise HTTPException(status_code=500, detail="Erro ao atualizar leads.")
+
+
+def _nome_colaborador(ctx):
+    # Contextos antigos no cache podem não ter o nome ainda
+    if ctx.get('nome'):
+        return ctx['nome']
+    resp = supabase.table("tb_colaboradores").select("nome_completo").eq("user_id", ctx['user_id']).execute()
+    return resp.data[0]['nome_completo']
+
+
 @router.patch("/leads-crm/{id_inscricao}")
-def atualizar_status_lead(id_inscricao: int, dados: StatusUpdateData, authorization: str = Header(None)):
-    if not authorization: raise HTTPException(status_code=401)
-    token = authorization.split(" ")[1]
-    ctx = get_contexto_usuario(token)
-    if ctx['nivel'] not in [3, 4, 8, 9, 10]: raise HTTPException(status_code=403)
+def atualizar_status_lead(id_inscricao: int, dados: StatusUpdateData, acesso: politicas.Acesso = exigir("leads.gravar")):
     try:
-        resp = supabase.table("tb_colaboradores").select("nome_completo").eq("user_id", ctx['user_id']).execute()
-        nome = resp.data[0]['nome_completo']
-        supabase.table("inscricoes").update({ "status": dados.status, "vendedor": nome }).eq("id", id_inscricao).execute()
+        nome = _nome_colaborador(acesso.ctx)
+        query = supabase.table("inscricoes").update({ "status": dados.status, "vendedor": nome }).eq("id", id_inscricao)
+        acesso.exigir_linhas(acesso.escopar(query).execute(), "Lead não encontrado ou de outra unidade.")
         return {"message": "OK"}
+    except HTTPException: raise
     except: raise HTTPException(status_code=500)
 
 
@@ -808,7 +972,11 @@ def atualizar_meu_perfil(dados: PerfilUpdateData, authorization: str = Header(No
         if dados.nome: updates["nome_completo"] = dados.nome.upper()
         if dados.telefone: updates["telefone"] = dados.telefone
         if dados.email_contato: updates["email"] = dados.email_contato
-        if updates: supabase.table("tb_colaboradores").update(updates).eq("user_id", user_id).execute()
+        if updates:
+            supabase.table("tb_colaboradores").update(updates).eq("user_id", user_id).execute()
+            cache.invalidar("contexto")
+            if "nome_completo" in updates:
+                chat_grupo.invalidar_identidade(user_id)
         
         auth_up = {}
         if dados.email_login: auth_up["email"] = dados.email_login
@@ -820,7 +988,7 @@ def atualizar_meu_perfil(dados: PerfilUpdateData, authorization: str = Header(No
         return {"message": "Perfil atualizado!"}
     except Exception as e: 
         # Melhoria: Mostra o erro real no log do servidor
-        print(f"Erro ao atualizar perfil: {str(e)}")
+        logger.exception(f"Erro ao atualizar perfil: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -895,10 +1063,42 @@ def admin_listar_conversas_ativas(authorization: str = Header(None)):
         return list(conversas.values())
 
     except Exception as e:
-        print(f"Erro ao listar conversas: {e}")
+        logger.exception(f"Erro ao listar conversas: {e}")
         return []
 
 
+def _turmas_do_professor(id_professor: int) -> list:
+    turmas_resp = supabase.table("tb_turmas").select("codigo_turma").eq("id_professor", id_professor).execute()
+    return [t['codigo_turma'] for t in turmas_resp.data]
+
+
+def _alunos_visiveis_chat(ctx) -> Optional[set]:
+    """
+    Alunos cujas conversas o colaborador pode ver (None = todos):
+    - Professor (nível 5) só vê alunos das próprias turmas
+    - Coord/Vendedor/Secretaria (nível < 9) só vê alunos da sua unidade
+    - Gerência/Diretoria (>= 9) vê tudo
+    """
+    if ctx['nivel'] == 5:
+        codigos = _turmas_do_professor(ctx['id_colaborador'])
+        if not codigos:
+            return set()
+        matr_resp = supabase.table("tb_matriculas").select("id_aluno").in_("codigo_turma", codigos).execute()
+        return {m['id_aluno'] for m in matr_resp.data}
+
+    if ctx['nivel'] < 9:
+        alunos_unidade = supabase.table("tb_alunos").select("id_aluno").eq("id_unidade", ctx['id_unidade']).execute()
+        return {a['id_aluno'] for a in alunos_unidade.data}
+
+    return None
+
+
+def _exigir_conversa(ctx, id_aluno: int) -> None:
+    visiveis = _alunos_visiveis_chat(ctx)
+    if visiveis is not None and id_aluno not in visiveis:
+        raise HTTPException(status_code=403, detail="Sem permissão para acessar esta conversa")
+
+
 @router.get("/chat/mensagens/{id_aluno}")
 def admin_ler_mensagens(id_aluno: int, authorization: str = Header(None)):
     if not authorization:
@@ -906,43 +1106,153 @@ def admin_ler_mensagens(id_aluno: int, authorization: str = Header(None)):
     try:
         token = authorization.split(" ")[1]
         ctx = get_contexto_usuario(token)
+        _exigir_conversa(ctx, id_aluno)
 
-        # Permissões:
-        # - Professor (nível 5) só vê alunos das próprias turmas
-        # - Coord/Vendedor/Secretaria (nível < 9) só vê alunos da sua unidade
-        # - Gerência/Diretoria (>= 9) vê tudo
-        permitido = True
+        msgs = supabase.table("tb_chat").select("*").eq("id_aluno", id_aluno).order("created_at").execute()
+        return msgs.data
 
-        if ctx['nivel'] == 5:
-            turmas_resp = supabase.table("tb_turmas").select("codigo_turma").eq("id_professor", ctx['id_colaborador']).execute()
-            codigos = [t['codigo_turma'] for t in turmas_resp.data]
-            if not codigos:
-                permitido = False
-            else:
-                matr_resp = supabase.table("tb_matriculas").select("id_aluno").in_("codigo_turma", codigos).execute()
-                alunos = [m['id_aluno'] for m in matr_resp.data]
-                permitido = id_aluno in alunos
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"Erro ao ler mensagens: {e}")
+        raise HTTPException(status_code=500, detail="Erro ao buscar mensagens")
 
-        elif ctx['nivel'] < 9:
-            alunos_unidade = supabase.table("tb_alunos").select("id_aluno").eq("id_unidade", ctx['id_unidade']).execute()
-            alunos = [a['id_aluno'] for a in alunos_unidade.data]
-            permitido = id_aluno in alunos
 
+@router.get("/chat/buscar")
+def admin_buscar_mensagens(
+    q: str,
+    response: Response,
+    id_aluno: Optional[int] = None,
+    codigo_turma: Optional[str] = None,
+    data_ini: Optional[str] = None,
+    data_fim: Optional[str] = None,
+    limite: int = 50,
+    authorization: str = Header(None)
+):
+    """
+    Busca no chat privado e nos grupos (índice invertido, ver app/busca_chat.py).
+    `X-Busca-Truncada: 1` = algum termo é tão comum que as ocorrências mais
+    antigas ficaram de fora; refine a busca (mais palavras, período, aluno).
+    """
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    ctx = get_contexto_usuario(token)
+
+    if not busca_chat.termos(q):
+        raise HTTPException(status_code=400, detail="Informe ao menos uma palavra para buscar.")
+
+    # Mesmo escopo de admin_ler_mensagens; grupos seguem a mesma regra pelas turmas
+    escopo = {}
+    if ctx['nivel'] == 5:
+        escopo["turmas_permitidas"] = set(_turmas_do_professor(ctx['id_colaborador']))
+        escopo["alunos_permitidos"] = _alunos_visiveis_chat(ctx)
+    elif ctx['nivel'] < 9:
+        escopo["id_unidade"] = ctx['id_unidade']
+
+    try:
+        info = {}
+        resultado = busca_chat.buscar(
+            supabase, q,
+            id_aluno=id_aluno, codigo_turma=codigo_turma,
+            data_ini=data_ini, data_fim=data_fim,
+            limite=min(max(limite, 1), 200),
+            info=info,
+            **escopo
+        )
+        if info.get("truncada"):
+            response.headers["X-Busca-Truncada"] = "1"
+        return resultado
+    except Exception as e:
+        logger.exception(f"Erro busca chat: {e}")
+        raise HTTPException(status_code=500, detail="Erro ao buscar mensagens")
+
+
+@router.get("/chat/arquivo")
+def admin_chat_arquivo(
+    origem: str,
+    id_aluno: Optional[int] = None,
+    codigo_turma: Optional[str] = None,
+    antes: Optional[str] = None,
+    authorization: str = Header(None)
+):
+    """Mensagens arquivadas (frias) anteriores a `antes`, um segmento por chamada."""
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    ctx = get_contexto_usuario(token)
+
+    if origem == "privado" and id_aluno:
+        _exigir_conversa(ctx, id_aluno)
+        chave = id_aluno
+    elif origem == "grupo" and codigo_turma:
+        if ctx['nivel'] == 5:
+            permitido = codigo_turma in _turmas_do_professor(ctx['id_colaborador'])
+        elif ctx['nivel'] < 9:
+            turma = supabase.table("tb_turmas").select("id_unidade").eq("codigo_turma", codigo_turma).limit(1).execute().data
+            permitido = bool(turma) and turma[0].get("id_unidade") == ctx['id_unidade']
+        else:
+            permitido = True
         if not permitido:
             raise HTTPException(status_code=403, detail="Sem permissão para acessar esta conversa")
+        chave = codigo_turma
+    else:
+        raise HTTPException(status_code=400, detail="Informe origem=privado&id_aluno=... ou origem=grupo&codigo_turma=...")
 
-        msgs = supabase.table("tb_chat").select("*").eq("id_aluno", id_aluno).order("created_at").execute()
-        return msgs.data
+    try:
+        return arquivo_chat.segmento_anterior(supabase, origem, chave, antes)
+    except Exception as e:
+        logger.exception(f"Erro arquivo chat: {e}")
+        raise HTTPException(status_code=500, detail="Erro ao buscar mensagens arquivadas")
 
-    except HTTPException:
-        raise
+
+@router.post("/chat/mensagens/{id_aluno}/lidas")
+def admin_marcar_lidas(id_aluno: int, id_colaborador: Optional[int] = None, authorization: str = Header(None)):
+    """
+    Marca como lidas (um UPDATE só) as mensagens do aluno numa conversa com a equipe.
+    Professor marca só a própria; os demais informam id_colaborador (0 = suporte
+    geral) ou, sem ele, marcam a conversa em que responderiam (ver admin_responder).
+    """
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    ctx = get_contexto_usuario(token)
+    _exigir_conversa(ctx, id_aluno)
+    if ctx['nivel'] == 5:
+        id_colaborador = ctx['id_colaborador']
+    elif id_colaborador is None:
+        id_colaborador = ctx['id_colaborador'] if ctx['nivel'] >= 4 else chat_nao_lidas.SUPORTE_GERAL
+    try:
+        return {"marcadas": chat_nao_lidas.marcar_lidas(supabase, id_aluno, para_equipe=True, id_colaborador=id_colaborador)}
     except Exception as e:
-        print(f"Erro ao ler mensagens: {e}")
-        raise HTTPException(status_code=500, detail="Erro ao buscar mensagens")
+        logger.exception(f"Erro ao marcar lidas: {e}")
+        raise HTTPException(status_code=500, detail="Erro ao marcar mensagens como lidas")
+
+
+@router.get("/chat/nao-lidas")
+def admin_contar_nao_lidas(authorization: str = Header(None)):
+    """Badges da equipe: não lidas por aluno, lidas só dos contadores."""
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    ctx = get_contexto_usuario(token)
+    try:
+        query = supabase.table("tb_chat_nao_lidas")\
+            .select("id_aluno, qtd, tb_alunos!inner(id_unidade)")\
+            .eq("para_equipe", True)\
+            .gt("qtd", 0)
+        if ctx['nivel'] == 5:
+            visiveis = _alunos_visiveis_chat(ctx)
+            if not visiveis:
+                return {"total": 0, "por_aluno": {}}
+            query = query.in_("id_aluno", list(visiveis))
+        elif ctx['nivel'] < 9:
+            query = query.eq("tb_alunos.id_unidade", ctx['id_unidade'])
+        por_aluno = chat_nao_lidas.somar(query.execute().data or [], "id_aluno")
+        return {"total": sum(por_aluno.values()), "por_aluno": por_aluno}
+    except Exception as e:
+        logger.exception(f"Erro ao contar não lidas: {e}")
+        return {"total": 0, "por_aluno": {}}
 
 
 @router.post("/chat/responder")
-def admin_responder(dados: ChatAdminReply, authorization: str = Header(None)):
+def admin_responder(dados: ChatAdminReply, background_tasks: BackgroundTasks, authorization: str = Header(None)):
     if not authorization: 
         raise HTTPException(status_code=401, detail="Token ausente")
     
@@ -966,62 +1276,112 @@ def admin_responder(dados: ChatAdminReply, authorization: str = Header(None)):
             "enviado_por_admin": True,
             "id_colaborador": id_colab_save
         }).execute()
+        background_tasks.add_task(chat_nao_lidas.registrar_mensagem, supabase, dados.id_aluno, id_colab_save, True)
         
         return {"message": "Respondido"}
     except Exception as e:
-        print(f"Erro ao responder: {e}")
+        logger.exception(f"Erro ao responder: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# Snapshots do dashboard são recalculados pela tarefa agendada (app/tarefas.py)
+DASHBOARD_SNAPSHOT_MAX_IDADE = timedelta(minutes=15)
+# Gestores atualizando ao mesmo tempo compartilham a mesma leitura
+_cache_dashboard = CacheCurto("dashboard", ttl=30)
+
+
+def calcular_dashboard_stats(id_unidade: int | None):
+    """Agrega os números do dashboard (id_unidade=None -> todas as unidades)."""
+    # 1. CRM / LEADS
+    q_leads = supabase.table("inscricoes").select("status", count="exact")
+    if id_unidade is not None: q_leads = q_leads.eq("id_unidade", id_unidade)
+    leads_data = q_leads.execute().data
+    
+    pendentes = sum(1 for l in leads_data if l.get('status') == 'Pendente')
+    atendimento = sum(1 for l in leads_data if l.get('status') == 'Em Atendimento')
+    matriculados = sum(1 for l in leads_data if l.get('status') == 'Matriculado')
+    perdidos = sum(1 for l in leads_data if l.get('status') == 'Perdido')
+    total_leads = len(leads_data)
+    taxa_conversao = (matriculados / total_leads * 100) if total_leads > 0 else 0
+
+    # 2. ALUNOS E TURMAS
+    q_alunos = supabase.table("tb_alunos").select("id_aluno", count="exact")
+    if id_unidade is not None: q_alunos = q_alunos.eq("id_unidade", id_unidade)
+    total_alunos = q_alunos.execute().count
+
+    q_turmas = supabase.table("tb_turmas").select("status, nome_curso")
+    if id_unidade is not None: q_turmas = q_turmas.eq("id_unidade", id_unidade)
+    turmas_data = q_turmas.execute().data
+    
+    # CORREÇÃO: Turmas Ativas agora são "Em Andamento" (Vagas) + "Fechada" (Lotada/Sem Vagas)
+    turmas_ativas = sum(1 for t in turmas_data if t['status'] in ['Em Andamento', 'Fechada'])
+    
+    # Agrupar cursos para o gráfico
+    cursos_map = {}
+    for t in turmas_data:
+        nome = t.get('nome_curso', 'Outros')
+        cursos_map[nome] = cursos_map.get(nome, 0) + 1
+
+    # 3. REPOSIÇÕES PENDENTES
+    repo_count = supabase.table("tb_reposicoes").select("id", count="exact").eq("status", "Agendada").execute().count
+
+    return {
+        "leads": { "pendentes": pendentes, "atendimento": atendimento, "matriculados": matriculados, "perdidos": perdidos, "total": total_leads, "conversao": round(taxa_conversao, 1) },
+        "escola": { "total_alunos": total_alunos, "turmas_ativas": turmas_ativas },
+        "reposicoes": repo_count,
+        "grafico_cursos": cursos_map
+    }
+
+
+def _chave_dashboard(id_unidade: int | None) -> str:
+    return "geral" if id_unidade is None else str(id_unidade)
+
+
+def atualizar_snapshots_dashboard():
+    """Recalcula e grava o snapshot geral e o de cada unidade."""
+    unidades = supabase.table("tb_unidades").select("id_unidade").execute().data or []
+    agora = datetime.now().isoformat()
+    linhas = []
+    for id_unidade in [None] + [u['id_unidade'] for u in unidades]:
+        linhas.append({
+            "chave": _chave_dashboard(id_unidade),
+            "id_unidade": id_unidade,
+            "dados": calcular_dashboard_stats(id_unidade),
+            "atualizado_em": agora
+        })
+    supabase.table("tb_dashboard_snapshots").upsert(linhas, on_conflict="chave").execute()
+
+
 @router.get("/dashboard-stats")
 def get_dashboard_stats(authorization: str = Header(None)):
     if not authorization: raise HTTPException(status_code=401)
     token = authorization.split(" ")[1]
     ctx = get_contexto_usuario(token)
-    
+    id_unidade = ctx['id_unidade'] if ctx['nivel'] < 9 else None
     try:
-        # 1. CRM / LEADS
-        q_leads = supabase.table("inscricoes").select("status", count="exact")
-        if ctx['nivel'] < 9: q_leads = q_leads.eq("id_unidade", ctx['id_unidade'])
-        leads_data = q_leads.execute().data
-        
-        pendentes = sum(1 for l in leads_data if l.get('status') == 'Pendente')
-        atendimento = sum(1 for l in leads_data if l.get('status') == 'Em Atendimento')
-        matriculados = sum(1 for l in leads_data if l.get('status') == 'Matriculado')
-        perdidos = sum(1 for l in leads_data if l.get('status') == 'Perdido')
-        total_leads = len(leads_data)
-        taxa_conversao = (matriculados / total_leads * 100) if total_leads > 0 else 0
-
-        # 2. ALUNOS E TURMAS
-        q_alunos = supabase.table("tb_alunos").select("id_aluno", count="exact")
-        if ctx['nivel'] < 9: q_alunos = q_alunos.eq("id_unidade", ctx['id_unidade'])
-        total_alunos = q_alunos.execute().count
-
-        q_turmas = supabase.table("tb_turmas").select("status, nome_curso")
-        if ctx['nivel'] < 9: q_turmas = q_turmas.eq("id_unidade", ctx['id_unidade'])
-        turmas_data = q_turmas.execute().data
-        
-        # CORREÇÃO: Turmas Ativas agora são "Em Andamento" (Vagas) + "Fechada" (Lotada/Sem Vagas)
-        turmas_ativas = sum(1 for t in turmas_data if t['status'] in ['Em Andamento', 'Fechada'])
-        
-        # Agrupar cursos para o gráfico
-        cursos_map = {}
-        for t in turmas_data:
-            nome = t.get('nome_curso', 'Outros')
-            cursos_map[nome] = cursos_map.get(nome, 0) + 1
+        return _cache_dashboard.obter(chave_consulta("dashboard", id_unidade=id_unidade), lambda: _ler_dashboard(id_unidade))
+    except Exception as e:
+        logger.exception(f"Erro dashboard: {e}")
+        return {}
 
-        # 3. REPOSIÇÕES PENDENTES
-        repo_count = supabase.table("tb_reposicoes").select("id", count="exact").eq("status", "Agendada").execute().count
 
-        return {
-            "leads": { "pendentes": pendentes, "atendimento": atendimento, "matriculados": matriculados, "perdidos": perdidos, "total": total_leads, "conversao": round(taxa_conversao, 1) },
-            "escola": { "total_alunos": total_alunos, "turmas_ativas": turmas_ativas },
-            "reposicoes": repo_count,
-            "grafico_cursos": cursos_map
-        }
+def _ler_dashboard(id_unidade: int | None):
+    # 1. Lê o snapshot pré-calculado (uma consulta só)
+    try:
+        snap = supabase.table("tb_dashboard_snapshots")\
+            .select("dados, atualizado_em")\
+            .eq("chave", _chave_dashboard(id_unidade))\
+            .limit(1)\
+            .execute()
+        if snap.data:
+            atualizado = datetime.fromisoformat(snap.data[0]['atualizado_em'].replace("Z", "+00:00")).replace(tzinfo=None)
+            if datetime.now() - atualizado < DASHBOARD_SNAPSHOT_MAX_IDADE:
+                return snap.data[0]['dados']
     except Exception as e:
-        print(f"Erro dashboard: {e}")
-        return {}
+        logger.warning(f"Snapshot do dashboard indisponível: {e}")
+
+    # 2. Sem snapshot recente (agendador parado/atrasado): calcula na hora
+    return calcular_dashboard_stats(id_unidade)
 
 
 
@@ -1095,7 +1455,7 @@ def get_historico_unificado(authorization: str = Header(None)):
         return historico
 
     except Exception as e:
-        print(f"Erro historico unificado: {e}")
+        logger.exception(f"Erro historico unificado: {e}")
         return []
 
 
@@ -1111,32 +1471,23 @@ def get_aula_conteudo(id_aula: int, authorization: str = Header(None)):
         # 1. Se for Professor (Nível 5), tenta buscar a VERSÃO DELE primeiro
         if ctx['nivel'] == 5:
             try:
-                # .maybe_single() retorna None se não achar, sem dar erro
-                personalizado = supabase.table("conteudos_personalizados")\
-                    .select("conteudo")\
-                    .eq("id_aula", id_aula)\
-                    .eq("id_professor", ctx['id_colaborador'])\
-                    .maybe_single()\
-                    .execute()
-                
-                # Se achou conteúdo personalizado, retorna ele
-                if personalizado.data and personalizado.data.get('conteudo'):
-                    return {"html": personalizado.data['conteudo'], "tipo": "personalizado"}
+                personalizado = versoes_aula.conteudo_professor(supabase, id_aula, ctx['id_colaborador'])
+                if personalizado:
+                    return {"html": personalizado["html"], "hash": personalizado["hash"], "tipo": "personalizado"}
             except Exception as e:
-                print(f"Erro ao buscar personalizado (ignorando): {e}")
+                logger.warning(f"Erro ao buscar personalizado (ignorando): {e}")
 
         # 2. Se não achou personalizado (ou se é Coordenação), busca o CONTEÚDO BASE
-        base = supabase.table("aulas").select("conteudo").eq("id", id_aula).maybe_single().execute()
-        
-        if base.data and base.data.get('conteudo'):
-            return {"html": base.data['conteudo'], "tipo": "base"}
+        base = versoes_aula.conteudo_base(supabase, id_aula)
+        if base["html"]:
+            return {"html": base["html"], "hash": base["hash"], "tipo": "base"}
         
         # 3. Se não tem em lugar nenhum, retorna vazio para começar do zero
-        return {"html": "", "tipo": "vazio"}
+        return {"html": "", "hash": None, "tipo": "vazio"}
 
     except Exception as e:
-        print(f"Erro buscar conteudo: {e}")
-        return {"html": "", "tipo": "erro"}
+        logger.exception(f"Erro buscar conteudo: {e}")
+        return {"html": "", "hash": None, "tipo": "erro"}
 
 
 @router.put("/aula/{id_aula}/salvar")
@@ -1149,28 +1500,81 @@ def salvar_aula_conteudo(id_aula: int, dados: AulaConteudoData, authorization: s
     try:
         # A. COORDENAÇÃO (Nível 8+): Edita a AULA BASE (Afeta todos que não tem cópia)
         if ctx['nivel'] >= 8:
-            supabase.table("aulas").update({"conteudo": dados.conteudo}).eq("id", id_aula).execute()
-            return {"message": "Conteúdo BASE atualizado (Modo Coordenação)."}
+            h = versoes_aula.salvar_base(supabase, id_aula, dados.conteudo, ctx['id_colaborador'])
+            cache_cursos_didaticos.invalidar()
+            return {"message": "Conteúdo BASE atualizado (Modo Coordenação).", "hash": h}
 
-        # B. PROFESSOR (Nível 5): Salva na tabela PERSONALIZADA (Cópia dele)
+        # B. PROFESSOR (Nível 5): Salva a versão PERSONALIZADA (aponta para o hash do conteúdo)
         elif ctx['nivel'] == 5:
-            payload = {
-                "id_aula": id_aula,
-                "id_professor": ctx['id_colaborador'],
-                "conteudo": dados.conteudo
-            }
-            # Upsert garante que cria se não existe, ou atualiza se já existe
-            # Requer que a tabela tenha constraint unique(id_aula, id_professor)
-            supabase.table("conteudos_personalizados").upsert(payload, on_conflict="id_aula,id_professor").execute()
-            
-            return {"message": "Sua versão personalizada foi salva!"}
+            res = versoes_aula.salvar_professor(supabase, id_aula, ctx['id_colaborador'], dados.conteudo)
+            if res["tipo"] == "base":
+                return {"message": "Conteúdo igual ao da coordenação: sua cópia foi descartada.", "hash": res["hash"]}
+            return {"message": "Sua versão personalizada foi salva!", "hash": res["hash"]}
         
         else:
             raise HTTPException(status_code=403, detail="Sem permissão para editar.")
 
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Erro ao salvar: {e}")
+        logger.exception(f"Erro ao salvar: {e}")
         raise HTTPException(status_code=500, detail=f"Erro ao salvar: {str(e)}")
+
+
+def _professor_do_historico(ctx, id_professor: Optional[int]) -> Optional[int]:
+    # professor só enxerga o próprio histórico; coordenação vê base (None) ou qualquer professor
+    if ctx['nivel'] == 5:
+        return ctx['id_colaborador']
+    if ctx['nivel'] >= 8:
+        return id_professor
+    raise HTTPException(status_code=403, detail="Sem permissão.")
+
+
+def _versao_da_aula(ctx, id_aula: int, hash_conteudo: str) -> str:
+    # o hash precisa estar no histórico desta aula (e visível para quem pede)
+    id_professor = _professor_do_historico(ctx, None)
+    html = None
+    if versoes_aula.versao_no_historico(supabase, id_aula, hash_conteudo, id_professor):
+        html = versoes_aula.ler_conteudo(supabase, hash_conteudo)
+    if html is None:
+        raise HTTPException(status_code=404, detail="Versão não encontrada.")
+    return html
+
+
+@router.get("/aula/{id_aula}/versoes")
+def listar_versoes_aula(id_aula: int, id_professor: Optional[int] = None, authorization: str = Header(None)):
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    ctx = get_contexto_usuario(token)
+    id_professor = _professor_do_historico(ctx, id_professor)
+    try:
+        return versoes_aula.historico(supabase, id_aula, id_professor)
+    except Exception as e:
+        logger.exception(f"Erro historico aula: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/aula/{id_aula}/versoes/{hash_conteudo}")
+def obter_versao_aula(id_aula: int, hash_conteudo: str, response: Response, authorization: str = Header(None)):
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    ctx = get_contexto_usuario(token)
+    html = _versao_da_aula(ctx, id_aula, hash_conteudo)
+    # o corpo de um hash nunca muda
+    response.headers["ETag"] = f'"{hash_conteudo}"'
+    response.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    return {"id_aula": id_aula, "hash": hash_conteudo, "html": html}
+
+
+@router.post("/aula/{id_aula}/versoes/{hash_conteudo}/restaurar")
+def restaurar_versao_aula(id_aula: int, hash_conteudo: str, authorization: str = Header(None)):
+    """Volta a aula (base ou cópia do professor) para uma versão do histórico."""
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    ctx = get_contexto_usuario(token)
+    html = _versao_da_aula(ctx, id_aula, hash_conteudo)
+    # mesma regra de quem pode salvar o quê (base x cópia do professor)
+    return salvar_aula_conteudo(id_aula, AulaConteudoData(conteudo=html), authorization)
         
 @router.get("/conteudo-didatico/cursos")
 def admin_listar_cursos_didaticos(authorization: str = Header(None)):
@@ -1184,22 +1588,18 @@ def admin_listar_cursos_didaticos(authorization: str = Header(None)):
             .execute()
         return resp.data
     except Exception as e:
-        print(f"Erro ao listar cursos didáticos: {e}")
+        logger.exception(f"Erro ao listar cursos didáticos: {e}")
         return []
 
-def calcular_progresso_automatico(data_inicio_str, total_aulas):
-    if not data_inicio_str:
+def calcular_progresso_automatico(codigo_turma, total_aulas):
+    if not codigo_turma or not total_aulas:
         return 0
     
-    # Converte a data de início da turma (ex: "2023-10-01")
-    inicio = datetime.strptime(data_inicio_str, "%Y-%m-%d")
-    hoje = datetime.now()
-    
-    # Calcula a diferença de dias
-    dias_passados = (hoje - inicio).days
-    
-    # Calcula quantas aulas foram liberadas (1 a cada 7 dias)
-    aulas_liberadas = (dias_passados // 7) + 1
+    # Aulas já realizadas segundo o calendário da turma (considera feriados)
+    cal = calendario.obter_calendario(supabase, codigo_turma)
+    if not cal:
+        return 0
+    aulas_liberadas = max(1, calendario.aulas_realizadas(cal))
     
     # Garante que não ultrapasse o total de aulas do curso
     aulas_liberadas = min(aulas_liberadas, total_aulas)
@@ -1208,19 +1608,18 @@ def calcular_progresso_automatico(data_inicio_str, total_aulas):
     return round((aulas_liberadas / total_aulas) * 100)
 
 @router.get("/aluno/meus-contatos")
-def get_contatos_aluno(authorization: str = Header(None)):
+def get_contatos_aluno(authorization: str = Header(None), carregador: Carregador = Depends(_carregador)):
     if not authorization: raise HTTPException(status_code=401)
     try:
         token = authorization.split(" ")[1]
-        user = supabase.auth.get_user(token)
-        user_id = user.user.id
+        user_id = carregador.usuario(token).id
 
         # 1. Busca Aluno e Unidade
-        aluno_resp = supabase.table("tb_alunos").select("id_aluno, id_unidade").eq("user_id", user_id).single().execute()
-        if not aluno_resp.data: return []
+        aluno = carregador.linha("tb_alunos", "user_id", user_id, "id_aluno, id_unidade")
+        if not aluno: return []
         
-        id_unidade = aluno_resp.data['id_unidade']
-        id_aluno = aluno_resp.data['id_aluno']
+        id_unidade = aluno['id_unidade']
+        id_aluno = aluno['id_aluno']
         contatos = []
 
         # --- PARTE A: COORDENADOR (ID Cargo 4) ---
@@ -1234,37 +1633,47 @@ def get_contatos_aluno(authorization: str = Header(None)):
                 "codigo_turma_grupo": None
             })
 
-        # --- PARTE B: GRUPO E PROFESSOR ---
-        matricula = supabase.table("tb_matriculas").select("codigo_turma").eq("id_aluno", id_aluno).execute()
-        if matricula.data:
-            cod_turma = matricula.data[0]['codigo_turma']
-            turma_info = supabase.table("tb_turmas").select("nome_curso, id_professor, tb_colaboradores(nome_completo)").eq("codigo_turma", cod_turma).single().execute()
-            
-            if turma_info.data:
-                t = turma_info.data
-                # Card do Grupo
+        # --- PARTE B: GRUPO E PROFESSOR (uma turma por matrícula, da mais recente) ---
+        matriculas = sorted(
+            carregador.linhas("tb_matriculas", "id_aluno", id_aluno, "id_matricula, codigo_turma, data_matricula"),
+            key=lambda m: (m.get("data_matricula") or "", m.get("id_matricula") or 0), reverse=True
+        )
+        codigos = list(dict.fromkeys(m['codigo_turma'] for m in matriculas if m.get('codigo_turma')))
+        # Declara todas as turmas e depois todos os professores: um in_() por tabela
+        for cod in codigos:
+            carregador.prever("tb_turmas", "codigo_turma", cod, "codigo_turma, nome_curso, id_professor")
+        turmas = [t for t in (carregador.linha("tb_turmas", "codigo_turma", cod, "codigo_turma, nome_curso, id_professor") for cod in codigos) if t]
+        for t in turmas:
+            carregador.prever("tb_colaboradores", "id_colaborador", t.get('id_professor'), "id_colaborador, nome_completo")
+
+        professores_vistos = set()
+        for t in turmas:
+            cod_turma = t['codigo_turma']
+            # Card do Grupo
+            contatos.append({
+                "id": f"grupo-{cod_turma}",
+                "nome": f"Grupo {t['nome_curso']}",
+                "cargo": f"Turma {cod_turma}",
+                "tipo": "Grupo",
+                "codigo_turma_grupo": cod_turma
+            })
+            # Card do Professor (um só, mesmo que dê aula em duas turmas do aluno)
+            prof = carregador.linha("tb_colaboradores", "id_colaborador", t.get('id_professor'), "id_colaborador, nome_completo") if t.get('id_professor') else None
+            if prof and t['id_professor'] not in professores_vistos:
+                professores_vistos.add(t['id_professor'])
                 contatos.append({
-                    "id": f"grupo-{cod_turma}",
-                    "nome": f"Grupo {t['nome_curso']}",
-                    "cargo": f"Turma {cod_turma}",
-                    "tipo": "Grupo",
-                    "codigo_turma_grupo": cod_turma
+                    "id": t['id_professor'],
+                    "nome": prof['nome_completo'],
+                    "cargo": f"Prof. {t['nome_curso']}",
+                    "tipo": "Professor",
+                    "codigo_turma_grupo": None
                 })
-                # Card do Professor
-                if t.get('tb_colaboradores'):
-                    contatos.append({
-                        "id": t['id_professor'],
-                        "nome": t['tb_colaboradores']['nome_completo'],
-                        "cargo": f"Prof. {t['nome_curso']}",
-                        "tipo": "Professor",
-                        "codigo_turma_grupo": None
-                    })
 
         # Suporte Geral
         contatos.append({"id": "geral", "nome": "Suporte Javis", "cargo": "Secretaria", "tipo": "Admin", "codigo_turma_grupo": None})
         return contatos
     except Exception as e:
-        print(f"Erro contatos: {e}")
+        logger.exception(f"Erro contatos: {e}")
         return []
 
 # Rota para buscar o histórico de mensagens com um contato específico
@@ -1290,7 +1699,7 @@ def get_mensagens_chat(target: str, authorization: str = Header(None)):
 
 # Rota para o aluno enviar uma mensagem direta
 @router.post("/chat/enviar-direto")
-def enviar_mensagem_aluno(dados: dict, authorization: str = Header(None)):
+def enviar_mensagem_aluno(dados: dict, background_tasks: BackgroundTasks, authorization: str = Header(None)):
     if not authorization: raise HTTPException(status_code=401)
     try:
         token = authorization.split(" ")[1]
@@ -1303,9 +1712,84 @@ def enviar_mensagem_aluno(dados: dict, authorization: str = Header(None)):
             "id_colaborador": dados.get('id_colaborador'),
             "enviado_por_admin": False
         }).execute()
+        background_tasks.add_task(chat_nao_lidas.registrar_mensagem, supabase, aluno.data['id_aluno'], dados.get('id_colaborador'), False)
         return {"status": "ok"}
     except: raise HTTPException(status_code=400)
 
+
+def _id_aluno_do_token(token: str) -> int:
+    user_id = supabase.auth.get_user(token).user.id
+    aluno = supabase.table("tb_alunos").select("id_aluno").eq("user_id", user_id).single().execute()
+    return aluno.data['id_aluno']
+
+
+# Rotas de não lidas do lado do aluno (target como em /chat/mensagens-com: 'geral' ou id do colaborador)
+@router.post("/chat/mensagens-com/{target}/lidas")
+def marcar_lidas_aluno(target: str, authorization: str = Header(None)):
+    if not authorization: raise HTTPException(status_code=401)
+    try:
+        token = authorization.split(" ")[1]
+        id_aluno = _id_aluno_do_token(token)
+        id_colaborador = chat_nao_lidas.SUPORTE_GERAL if target == 'geral' else int(target)
+        return {"marcadas": chat_nao_lidas.marcar_lidas(supabase, id_aluno, para_equipe=False, id_colaborador=id_colaborador)}
+    except Exception as e:
+        logger.exception(f"Erro ao marcar lidas (aluno): {e}")
+        raise HTTPException(status_code=400)
+
+
+@router.get("/chat/arquivo-aluno/{target}")
+def arquivo_chat_aluno(target: str, antes: Optional[str] = None, authorization: str = Header(None)):
+    """Histórico arquivado do aluno: target 'geral', id do colaborador ou 'grupo-<codigo_turma>'."""
+    if not authorization: raise HTTPException(status_code=401)
+    try:
+        token = authorization.split(" ")[1]
+        id_aluno = _id_aluno_do_token(token)
+    except Exception:
+        raise HTTPException(status_code=401)
+
+    try:
+        if target.startswith("grupo-"):
+            codigo_turma = target[len("grupo-"):]
+            matricula = supabase.table("tb_matriculas").select("id_aluno")\
+                .eq("id_aluno", id_aluno).eq("codigo_turma", codigo_turma).limit(1).execute().data
+            if not matricula:
+                raise HTTPException(status_code=403, detail="Sem permissão para acessar esta conversa")
+            return arquivo_chat.segmento_anterior(supabase, "grupo", codigo_turma, antes)
+
+        # O segmento é da conversa inteira do aluno; aqui fica só a do contato pedido
+        res = arquivo_chat.segmento_anterior(supabase, "privado", id_aluno, antes)
+        id_colaborador = None if target == 'geral' else int(target)
+        res["mensagens"] = [m for m in res["mensagens"] if m.get("id_colaborador") == id_colaborador]
+        return res
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"Erro arquivo chat (aluno): {e}")
+        raise HTTPException(status_code=400)
+
+
+@router.get("/chat/nao-lidas-aluno")
+def contar_nao_lidas_aluno(authorization: str = Header(None)):
+    """Badges do aluno por contato ('geral' = suporte)."""
+    if not authorization: raise HTTPException(status_code=401)
+    try:
+        token = authorization.split(" ")[1]
+        id_aluno = _id_aluno_do_token(token)
+        linhas = supabase.table("tb_chat_nao_lidas")\
+            .select("id_colaborador, qtd")\
+            .eq("id_aluno", id_aluno)\
+            .eq("para_equipe", False)\
+            .gt("qtd", 0)\
+            .execute().data or []
+        por_contato = {
+            ("geral" if k == chat_nao_lidas.SUPORTE_GERAL else k): v
+            for k, v in chat_nao_lidas.somar(linhas, "id_colaborador").items()
+        }
+        return {"total": sum(por_contato.values()), "por_contato": por_contato}
+    except Exception as e:
+        logger.exception(f"Erro ao contar não lidas (aluno): {e}")
+        return {"total": 0, "por_contato": {}}
+
 @router.get("/chat/mensagens-grupo/{codigo_turma}")
 def get_mensagens_grupo(codigo_turma: str, authorization: str = Header(None)):
     if not authorization: raise HTTPException(status_code=401)
@@ -1331,47 +1815,44 @@ def get_chat_turma(codigo_turma: str, authorization: str = Header(None)):
             .execute()
         return msgs.data
     except Exception as e:
-        print(f"Erro chat turma: {e}")
+        logger.exception(f"Erro chat turma: {e}")
         return []
 
+# Envio no grupo: identidade em cache por user_id e insert agrupado em micro-lotes
+_gravador_chat_turma = chat_grupo.GravadorLotes(supabase)
+
+
+def _user_id_do_token(token: str) -> str:
+    user_id = cache.obter(
+        "chat_usuario", hashlib.sha256(token.encode()).hexdigest(),
+        lambda: supabase.auth.get_user(token).user.id, CONTEXTO_CACHE_TTL
+    )
+    definir_usuario(user_id)
+    return user_id
+
+
 @router.post("/chat/turma/enviar")
 def enviar_chat_turma(dados: MensagemGrupoData, authorization: str = Header(None)):
     if not authorization: raise HTTPException(status_code=401)
     try:
         token = authorization.split(" ")[1]
-        user = supabase.auth.get_user(token)
-        user_id = user.user.id
-        
-        nome_exibicao = "Usuário"
-        cargo_exibicao = "Aluno"
-        
-        # 1. Tenta buscar como Colaborador de forma segura
-        colab_resp = supabase.table("tb_colaboradores").select("nome_completo, id_cargo").eq("user_id", user_id).execute()
-        
-        # Verificação robusta: se o objeto de resposta existe e tem dados
-        if colab_resp and hasattr(colab_resp, 'data') and colab_resp.data:
-            c = colab_resp.data[0]
-            nome_exibicao = c['nome_completo'].split()[0]
-            cargo_exibicao = "Professor" if c['id_cargo'] == 6 else "Staff"
-        else:
-            # 2. Se não é colaborador, busca na tabela de alunos
-            aluno_resp = supabase.table("tb_alunos").select("nome_completo").eq("user_id", user_id).execute()
-            if aluno_resp and hasattr(aluno_resp, 'data') and aluno_resp.data:
-                nome_exibicao = aluno_resp.data[0]['nome_completo'].split()[0]
-                cargo_exibicao = "Aluno"
-
-        # 3. Inserção na tabela
-        supabase.table("tb_chat_turma").insert({
+        user_id = _user_id_do_token(token)
+        quem = chat_grupo.identidade(supabase, user_id)
+
+        _gravador_chat_turma.enviar({
             "codigo_turma": dados.codigo_turma,
             "mensagem": dados.mensagem,
             "id_usuario_envio": user_id,
-            "nome_exibicao": nome_exibicao,
-            "cargo_exibicao": cargo_exibicao
-        }).execute()
+            "nome_exibicao": quem["nome_exibicao"],
+            "cargo_exibicao": quem["cargo_exibicao"],
+        })
         
         return {"message": "OK"}
+    except TimeoutError:
+        # a mensagem saiu da fila sem ser gravada: pode reenviar
+        raise HTTPException(status_code=503, detail="Chat ocupado, tente novamente.")
     except Exception as e:
-        print(f"Erro ao enviar no grupo: {e}")
+        logger.exception(f"Erro ao enviar no grupo: {e}")
         raise HTTPException(status_code=500, detail="Erro interno no servidor.")
 
 
@@ -1385,7 +1866,7 @@ def get_aula_por_id(aula_id: int, authorization: str = Header(None)):
             raise HTTPException(status_code=404, detail="Aula não encontrada")
         return res.data
     except Exception as e:
-        print(f"Erro ao buscar aula {aula_id}: {e}")
+        logger.exception(f"Erro ao buscar aula {aula_id}: {e}")
         raise HTTPException(status_code=500)
 
 @router.get("/conteudo-didatico/cursos")
@@ -1407,7 +1888,7 @@ def admin_listar_cursos_didaticos(authorization: str = Header(None)):
                 
         return resp.data
     except Exception as e:
-        print(f"Erro ao carregar estrutura: {e}")
+        logger.exception(f"Erro ao carregar estrutura: {e}")
         return []
 @router.post("/criar-login-aluno")
 def criar_login_aluno(dados: NovoUsuarioData, authorization: str = Header(None)):
@@ -1472,37 +1953,10 @@ def criar_login_aluno(dados: NovoUsuarioData, authorization: str = Header(None))
         raise HTTPException(status_code=500, detail=f"Erro ao criar login: {str(e)}")
 
 @router.put("/editar-aluno/{id_aluno}")
-def admin_editar_aluno(id_aluno: int, dados: AlunoEdicaoData, authorization: str = Header(None)):
-    # Valida header Bearer
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Token ausente")
-
-    token = authorization.split(" ", 1)[1]
-    ctx = get_contexto_usuario(token)
-
-    # Gerência (8+)
-    if ctx["nivel"] < 8:
-        raise HTTPException(status_code=403, detail="Acesso restrito à Gerência.")
+def admin_editar_aluno(id_aluno: int, dados: AlunoEdicaoData, acesso: politicas.Acesso = exigir("alunos.gravar")):
+    ctx = acesso.ctx
 
     try:
-        # Busca aluno (inclui email pra possível rollback)
-        aluno_resp = (
-            supabase.table("tb_alunos")
-            .select("id_aluno,id_unidade,user_id,email")
-            .eq("id_aluno", id_aluno)
-            .single()
-            .execute()
-        )
-
-        if not aluno_resp.data:
-            raise HTTPException(status_code=404, detail="Aluno não encontrado.")
-
-        aluno = aluno_resp.data
-
-        # Se não for nível 9+, só edita aluno da própria unidade
-        if ctx["nivel"] < 9 and aluno.get("id_unidade") != ctx["id_unidade"]:
-            raise HTTPException(status_code=403, detail="Sem permissão para editar aluno de outra unidade.")
-
         updates = {}
 
         if getattr(dados, "nome", None):
@@ -1525,6 +1979,13 @@ def admin_editar_aluno(id_aluno: int, dados: AlunoEdicaoData, authorization: str
         if novo_email:
             novo_email = novo_email.strip().lower()
 
+            # Só aqui a leitura prévia é necessária (user_id e e-mail anterior pro rollback)
+            # (nível < 9 só alcança aluno da própria unidade: o filtro vai na consulta)
+            aluno_resp = acesso.escopar(
+                supabase.table("tb_alunos").select("id_aluno,id_unidade,user_id,email").eq("id_aluno", id_aluno)
+            ).execute()
+            aluno = acesso.exigir_linhas(aluno_resp, "Aluno não encontrado.")[0]
+
             user_id = aluno.get("user_id")
             if not user_id:
                 raise HTTPException(
@@ -1542,8 +2003,10 @@ def admin_editar_aluno(id_aluno: int, dados: AlunoEdicaoData, authorization: str
             try:
                 updates["email"] = novo_email
                 supabase.table("tb_alunos").update(updates).eq("id_aluno", id_aluno).execute()
+                if "nome_completo" in updates:
+                    chat_grupo.invalidar_identidade(str(user_id))
                 # remove do updates pra não re-updar duas vezes abaixo
-                updates.pop("email", None)
+                updates.clear()
             except Exception as e_db:
                 # 3) rollback do Auth (melhor esforço)
                 if email_anterior_db:
@@ -1553,9 +2016,17 @@ def admin_editar_aluno(id_aluno: int, dados: AlunoEdicaoData, authorization: str
                         pass
                 raise HTTPException(status_code=400, detail=f"Erro ao salvar e-mail no aluno: {str(e_db)}")
 
-        # Atualiza tb_alunos (demais campos)
-        if updates:
-            supabase.table("tb_alunos").update(updates).eq("id_aluno", id_aluno).execute()
+        # Atualiza tb_alunos (demais campos): o UPDATE escopado também valida aluno/unidade
+        elif updates:
+            resp = acesso.escopar(supabase.table("tb_alunos").update(updates).eq("id_aluno", id_aluno)).execute()
+            acesso.exigir_linhas(resp, "Aluno não encontrado.")
+            if "nome_completo" in updates and resp.data[0].get("user_id"):
+                chat_grupo.invalidar_identidade(resp.data[0]["user_id"])
+
+        # Só troca de turma: ainda precisa confirmar que o aluno está no escopo
+        elif getattr(dados, "turma_codigo", None):
+            resp = acesso.escopar(supabase.table("tb_alunos").select("id_aluno").eq("id_aluno", id_aluno)).execute()
+            acesso.exigir_linhas(resp, "Aluno não encontrado.")
 
         # Atualiza turma na matrícula (se vier turma_codigo)
         turma_codigo = getattr(dados, "turma_codigo", None)
@@ -1582,6 +2053,11 @@ def admin_editar_aluno(id_aluno: int, dados: AlunoEdicaoData, authorization: str
                     "status_financeiro": "Ok"
                 }).execute()
 
+        if turma_codigo:
+            cache.invalidar("aluno_contexto")
+        if novo_email or updates:
+            duplicidade.invalidar()
+
         return {"message": "Aluno atualizado!"}
 
     except HTTPException:
@@ -1606,7 +2082,7 @@ def listar_alunos_chamada(codigo_turma: str, authorization: str = Header(None)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/chamada/salvar")
-def salvar_chamada(dados: list, authorization: str = Header(None)):
+def salvar_chamada(dados: list, background_tasks: BackgroundTasks, authorization: str = Header(None)):
     if not authorization: raise HTTPException(status_code=401)
     token = authorization.split(" ")[1]
     ctx = get_contexto_usuario(token)
@@ -1617,10 +2093,76 @@ def salvar_chamada(dados: list, authorization: str = Header(None)):
             item['data_aula'] = datetime.now().strftime("%Y-%m-%d")
             
         supabase.table("tb_chamadas").upsert(dados, on_conflict="id_aluno,codigo_turma,data_aula").execute()
+        background_tasks.add_task(frequencia.atualizar_alunos, supabase, [item.get('id_aluno') for item in dados])
         return {"message": "Chamada realizada com sucesso!"}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
     
+@router.get("/frequencia/turma/{codigo_turma}")
+def frequencia_turma(codigo_turma: str, authorization: str = Header(None)):
+    """Frequência dos alunos da turma (lida do consolidado, sem varrer as chamadas)."""
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    ctx = get_contexto_usuario(token)
+    try:
+        query = supabase.table("tb_frequencia_alunos").select("*").eq("codigo_turma", codigo_turma)
+        if ctx['nivel'] < 9: query = query.eq("id_unidade", ctx['id_unidade'])
+        alunos = query.order("nome_aluno").execute().data or []
+        for a in alunos:
+            a["motivos_risco"] = frequencia.motivos_risco(a)
+        return {"turma": codigo_turma, "resumo": frequencia.resumo_turma(alunos), "alunos": alunos}
+    except Exception as e:
+        logger.exception(f"Erro frequencia turma: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/frequencia/em-risco")
+def alunos_em_risco(
+    codigo_turma: Optional[str] = None,
+    taxa_minima: float = frequencia.FREQUENCIA_TAXA_MINIMA,
+    faltas_seguidas: int = frequencia.FREQUENCIA_FALTAS_SEGUIDAS,
+    authorization: str = Header(None)
+):
+    """Alunos com faltas seguidas, presença baixa ou falta em reposição."""
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    ctx = get_contexto_usuario(token)
+    try:
+        # o filtro grosso vai para o banco; motivos_risco refina
+        query = supabase.table("tb_frequencia_alunos").select("*").or_(
+            f"faltas_consecutivas.gte.{faltas_seguidas},taxa_presenca.lt.{taxa_minima},reposicoes_faltou.gt.0"
+        )
+        if ctx['nivel'] < 9: query = query.eq("id_unidade", ctx['id_unidade'])
+        if codigo_turma: query = query.eq("codigo_turma", codigo_turma)
+
+        res = []
+        for a in query.execute().data or []:
+            motivos = frequencia.motivos_risco(a, taxa_minima, faltas_seguidas)
+            if motivos:
+                res.append({**a, "motivos_risco": motivos})
+        res.sort(key=lambda a: (-(a.get("faltas_consecutivas") or 0), a.get("taxa_presenca") or 0))
+        return res
+    except Exception as e:
+        logger.exception(f"Erro alunos em risco: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/frequencia/reconstruir")
+def reconstruir_frequencia(authorization: str = Header(None)):
+    """Recalcula a frequência de todos os alunos (carga inicial/correção)."""
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    ctx = get_contexto_usuario(token)
+
+    if ctx['nivel'] < 9:
+        raise HTTPException(status_code=403, detail="Acesso restrito à Diretoria.")
+
+    try:
+        return {"alunos": frequencia.reconstruir(supabase)}
+    except Exception as e:
+        logger.exception(f"Erro reconstruir frequencia: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.get("/festas-aniversario")
 def listar_festas_aniversario(
     status: Optional[str] = None,
@@ -1631,17 +2173,8 @@ def listar_festas_aniversario(
     id_unidade: Optional[int] = None,
     sort_by: str = "data_festa",
     sort_dir: str = "asc",
-    authorization: str = Header(None)
+    acesso: politicas.Acesso = exigir("festas.ler")
 ):
-    if not authorization:
-        raise HTTPException(status_code=401)
-
-    token = authorization.split(" ")[1]
-    ctx = get_contexto_usuario(token)
-
-    # só 8/9/10
-    if ctx["nivel"] not in (8, 9, 10):
-        raise HTTPException(status_code=403, detail="Acesso restrito (nível 8/9/10).")
 
     # ✅ agora suporta ordenação por TODAS as colunas do cabeçalho
     allowed_sort = {
@@ -1672,12 +2205,8 @@ def listar_festas_aniversario(
         if id_vendedor:
             query = query.eq("id_vendedor", id_vendedor)
 
-        # unidade:
-        if ctx["nivel"] == 8:
-            query = query.eq("id_unidade", ctx["id_unidade"])
-        else:
-            if id_unidade:
-                query = query.eq("id_unidade", id_unidade)
+        # unidade: nível 8 fica na dele; 9/10 podem filtrar
+        query = acesso.escopar(query, id_unidade=id_unidade)
 
         if q:
             query = query.or_(
@@ -1689,97 +2218,582 @@ def listar_festas_aniversario(
         return query.execute().data
 
     except Exception as e:
-        print("Erro listar festas:", e)
+        logger.exception(f"Erro listar festas: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/festas-aniversario/vendedores")
-def listar_vendedores_festas(authorization: str = Header(None)):
-    if not authorization:
-        raise HTTPException(status_code=401)
-
-    token = authorization.split(" ")[1]
-    ctx = get_contexto_usuario(token)
-
-    if ctx["nivel"] not in (8, 9, 10):
-        raise HTTPException(status_code=403, detail="Acesso restrito (nível 8/9/10).")
-
+def listar_vendedores_festas(acesso: politicas.Acesso = exigir("festas.ler")):
     try:
         q = supabase.table("tb_colaboradores").select("id_colaborador, nome_completo").eq("ativo", True)
 
         # nível 8: só da unidade dele
-        if ctx["nivel"] == 8:
-            q = q.eq("id_unidade", ctx["id_unidade"])
+        q = acesso.escopar(q)
 
         # nível 9/10: pode ver todos (ou você pode filtrar depois por parâmetro se quiser)
         q = q.order("nome_completo")
 
         return q.execute().data
     except Exception as e:
-        print("Erro vendedores:", e)
+        logger.exception(f"Erro vendedores: {e}")
         raise HTTPException(status_code=500, detail=str(e))
     
-@router.post("/festas-aniversario")
-def criar_festa_aniversario(dados: FestaAniversarioCreate, authorization: str = Header(None)):
-    if not authorization:
-        raise HTTPException(status_code=401)
+@router.get("/festas-aniversario/resumo")
+def resumo_festas_aniversario(
+    agrupar: str = "unidade,vendedor,mes",
+    mes_ini: Optional[str] = None,      # YYYY-MM
+    mes_fim: Optional[str] = None,      # YYYY-MM
+    id_vendedor: Optional[int] = None,
+    id_unidade: Optional[int] = None,
+    acesso: politicas.Acesso = exigir("festas.ler")
+):
+    """Receita, quantidade e taxa de kit por unidade/vendedor/mês (lido do resumo pré-calculado)."""
+
+    dimensoes = [d.strip() for d in agrupar.split(",") if d.strip()]
+    if any(d not in ("unidade", "vendedor", "mes") for d in dimensoes):
+        raise HTTPException(status_code=400, detail="agrupar aceita: unidade, vendedor, mes.")
+
+    try:
+        query = supabase.table("tb_festas_resumo").select("*")
+        if mes_ini:
+            query = query.gte("mes", mes_ini)
+        if mes_fim:
+            query = query.lte("mes", mes_fim)
+        if id_vendedor:
+            query = query.eq("id_vendedor", id_vendedor)
+        query = acesso.escopar(query, id_unidade=id_unidade)
+
+        linhas = resumo_festas.relatorio(query.execute().data or [], dimensoes)
+
+        # nomes para exibição
+        if "vendedor" in dimensoes:
+            ids = list({l["id_vendedor"] for l in linhas if l["id_vendedor"]})
+            nomes = {}
+            if ids:
+                resp = supabase.table("tb_colaboradores").select("id_colaborador, nome_completo").in_("id_colaborador", ids).execute()
+                nomes = {c["id_colaborador"]: c["nome_completo"] for c in resp.data or []}
+            for l in linhas:
+                l["vendedor"] = nomes.get(l["id_vendedor"], "Sem vendedor")
+        if "unidade" in dimensoes:
+            resp = supabase.table("tb_unidades").select("id_unidade, nome_unidade").execute()
+            nomes = {u["id_unidade"]: u["nome_unidade"] for u in resp.data or []}
+            for l in linhas:
+                l["unidade"] = nomes.get(l["id_unidade"], "-")
+        return linhas
+
+    except Exception as e:
+        logger.exception(f"Erro resumo festas: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-    token = authorization.split(" ")[1]
-    ctx = get_contexto_usuario(token)
 
-    if ctx["nivel"] not in (8, 9, 10):
-        raise HTTPException(status_code=403, detail="Acesso restrito (nível 8/9/10).")
+@router.post("/festas-aniversario/resumo/reconstruir")
+def reconstruir_resumo_festas(acesso: politicas.Acesso = exigir("diretoria")):
+    """Recalcula o resumo inteiro a partir das festas (carga inicial/correção)."""
+    try:
+        return {"grupos": resumo_festas.reconstruir(supabase)}
+    except Exception as e:
+        logger.exception(f"Erro reconstruir resumo festas: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 
+@router.post("/festas-aniversario")
+def criar_festa_aniversario(dados: FestaAniversarioCreate, background_tasks: BackgroundTasks, acesso: politicas.Acesso = exigir("festas.gravar")):
     payload = dados.model_dump(exclude_none=True)
 
-    # unidade:
-    # nível 8: força unidade do contexto
-    if ctx["nivel"] == 8:
-        payload["id_unidade"] = ctx["id_unidade"]
-    else:
-        # se não veio, default Cuiabá (=1)
-        payload["id_unidade"] = payload.get("id_unidade") or 1
+    # unidade: nível 8 usa a do contexto; se não veio, default Cuiabá (=1)
+    payload["id_unidade"] = acesso.unidade_para_gravar(payload.get("id_unidade"), padrao=1)
 
     # tipo fixo
     payload["tipo"] = "ANIVERSARIO_GAMER"
 
     try:
         resp = supabase.table("tb_festas_aniversario").insert(payload).execute()
+        background_tasks.add_task(resumo_festas.atualizar_apos_alteracao, supabase, None, resp.data[0] if resp.data else payload)
         return resp.data[0] if resp.data else {"message": "ok"}
     except Exception as e:
-        print("Erro criar festa:", e)
+        logger.exception(f"Erro criar festa: {e}")
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @router.put("/festas-aniversario/{id_festa}")
-def editar_festa_aniversario(id_festa: int, dados: FestaAniversarioUpdate, authorization: str = Header(None)):
-    if not authorization:
+def editar_festa_aniversario(id_festa: int, dados: FestaAniversarioUpdate, background_tasks: BackgroundTasks, acesso: politicas.Acesso = exigir("festas.gravar")):
+    updates = dados.model_dump(exclude_none=True)
+
+    # garante que nível 8 não troca unidade
+    if acesso.restrito_a_unidade:
+        updates.pop("id_unidade", None)
+
+    try:
+        # O estado anterior só interessa ao resumo quando muda o grupo (unidade/vendedor/mês)
+        antes = None
+        if {"id_unidade", "id_vendedor", "data_festa"} & updates.keys():
+            resp_antes = acesso.escopar(
+                supabase.table("tb_festas_aniversario").select("id_unidade, id_vendedor, data_festa").eq("id", id_festa)
+            ).execute()
+            antes = acesso.exigir_linhas(resp_antes, "Festa não encontrada.")[0]
+
+        # O escopo de unidade vai no filtro do UPDATE: festa de outra unidade não casa
+        resp = acesso.escopar(
+            supabase.table("tb_festas_aniversario").update(updates).eq("id", id_festa)
+        ).execute()
+        depois = acesso.exigir_linhas(resp, "Festa não encontrada.")[0]
+
+        background_tasks.add_task(resumo_festas.atualizar_apos_alteracao, supabase, antes, depois)
+        return {"message": "Festa atualizada!"}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"Erro editar festa: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+# 8. CALENDÁRIO DAS TURMAS
+
+@router.get("/turma/{codigo_turma}/calendario")
+def obter_calendario_turma(codigo_turma: str, authorization: str = Header(None)):
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    get_contexto_usuario(token)
+
+    cal = calendario.obter_calendario(supabase, codigo_turma)
+    if not cal:
+        raise HTTPException(status_code=404, detail="Turma não encontrada.")
+    return cal
+
+
+@router.post("/calendario/token-feed")
+def gerar_token_feed_calendario(authorization: str = Header(None)):
+    """Token fixo para assinar o .ics em apps de calendário (?feed=). Gerar de novo invalida o anterior."""
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    ctx = get_contexto_usuario(token)
+    return {"feed": calendario.gerar_token_feed(supabase, ctx["user_id"])}
+
+
+@router.delete("/calendario/token-feed")
+def revogar_token_feed_calendario(authorization: str = Header(None)):
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    ctx = get_contexto_usuario(token)
+    calendario.revogar_token_feed(supabase, ctx["user_id"])
+    return {"message": "Token de feed revogado."}
+
+
+def _colaborador_do_feed(feed: str) -> None:
+    user_id = calendario.usuario_do_token_feed(supabase, feed)
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Token de feed inválido.")
+    # colaborador desligado perde o feed junto com o acesso
+    ativo = supabase.table("tb_colaboradores").select("id_colaborador")\
+        .eq("user_id", user_id).eq("ativo", True).limit(1).execute().data
+    if not ativo:
+        raise HTTPException(status_code=401, detail="Token de feed inválido.")
+    definir_usuario(user_id)
+
+
+@router.get("/turma/{codigo_turma}/calendario.ics")
+def exportar_calendario_turma(codigo_turma: str, feed: str | None = None, authorization: str = Header(None)):
+    # Apps de calendário não mandam header: assinam com o token de feed na query (?feed=)
+    if authorization:
+        get_contexto_usuario(authorization.split(" ")[1])
+    elif feed:
+        _colaborador_do_feed(feed)
+    else:
         raise HTTPException(status_code=401)
 
+    cal = calendario.obter_calendario(supabase, codigo_turma)
+    if not cal:
+        raise HTTPException(status_code=404, detail="Turma não encontrada.")
+    return Response(
+        content=calendario.gerar_ical(cal),
+        media_type="text/calendar; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="turma-{codigo_turma}.ics"'}
+    )
+
+
+@router.get("/feriados")
+def listar_feriados(authorization: str = Header(None)):
+    if not authorization: raise HTTPException(status_code=401)
     token = authorization.split(" ")[1]
     ctx = get_contexto_usuario(token)
+    try:
+        query = supabase.table("tb_feriados").select("*").order("data")
+        if ctx['nivel'] < 9:
+            query = query.or_(f"id_unidade.is.null,id_unidade.eq.{ctx['id_unidade']}")
+        return query.execute().data
+    except Exception as e:
+        logger.exception(f"Erro listar feriados: {e}")
+        return []
 
-    if ctx["nivel"] not in (8, 9, 10):
-        raise HTTPException(status_code=403, detail="Acesso restrito (nível 8/9/10).")
 
-    updates = dados.model_dump(exclude_none=True)
+@router.post("/feriados")
+def criar_feriado(dados: FeriadoData, authorization: str = Header(None)):
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    ctx = get_contexto_usuario(token)
+
+    if ctx['nivel'] < 8:
+        raise HTTPException(status_code=403, detail="Acesso restrito à Gerência.")
+
+    payload = dados.model_dump()
+    # Gerente (8) só cadastra feriado da própria unidade
+    if ctx['nivel'] < 9:
+        payload["id_unidade"] = ctx['id_unidade']
 
     try:
-        # valida unidade quando nível 8
-        if ctx["nivel"] == 8:
-            festa = supabase.table("tb_festas_aniversario").select("id_unidade").eq("id", id_festa).single().execute()
-            if not festa.data:
-                raise HTTPException(status_code=404, detail="Festa não encontrada.")
-            if festa.data.get("id_unidade") != ctx["id_unidade"]:
-                raise HTTPException(status_code=403, detail="Sem permissão para editar festa de outra unidade.")
+        resp = supabase.table("tb_feriados").insert(payload).execute()
+        calendario.invalidar_feriados()
+        return resp.data[0] if resp.data else {"message": "ok"}
+    except Exception as e:
+        logger.exception(f"Erro criar feriado: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
 
-            # garante que nível 8 não troca unidade
-            updates.pop("id_unidade", None)
 
-        supabase.table("tb_festas_aniversario").update(updates).eq("id", id_festa).execute()
-        return {"message": "Festa atualizada!"}
+@router.delete("/feriados/{id_feriado}")
+def remover_feriado(id_feriado: int, authorization: str = Header(None)):
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    ctx = get_contexto_usuario(token)
 
-    except HTTPException:
-        raise
+    if ctx['nivel'] < 8:
+        raise HTTPException(status_code=403, detail="Acesso restrito à Gerência.")
+
+    try:
+        query = supabase.table("tb_feriados").delete().eq("id", id_feriado)
+        if ctx['nivel'] < 9:
+            query = query.eq("id_unidade", ctx['id_unidade'])
+        query.execute()
+        calendario.invalidar_feriados()
+        return {"message": "Feriado removido."}
+    except Exception as e:
+        logger.exception(f"Erro remover feriado: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/tarefas")
+def listar_tarefas_agendadas(authorization: str = Header(None)):
+    """Métricas das tarefas periódicas deste worker (execuções, falhas, duração)."""
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    ctx = get_contexto_usuario(token)
+
+    if ctx['nivel'] < 9:
+        raise HTTPException(status_code=403, detail="Acesso restrito à Diretoria.")
+
+    return agendador.metricas()
+
+
+@router.get("/limitador")
+def metricas_limitador(authorization: str = Header(None)):
+    """Contadores do limitador das rotas públicas (permitidas, rejeitadas, descartadas)."""
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    ctx = get_contexto_usuario(token)
+
+    if ctx['nivel'] < 9:
+        raise HTTPException(status_code=403, detail="Acesso restrito à Diretoria.")
+
+    return limitador.metricas()
+
+
+@router.get("/ingestao")
+def metricas_ingestao(authorization: str = Header(None)):
+    """Inscrições no log local aguardando envio ao Supabase (e as que desistiram)."""
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    ctx = get_contexto_usuario(token)
+
+    if ctx['nivel'] < 9:
+        raise HTTPException(status_code=403, detail="Acesso restrito à Diretoria.")
+
+    return ingestao.estatisticas()
+
+
+# 9. EXPORTAÇÕES (CSV/XLSX em streaming, mesmos filtros das listagens)
+
+COLUNAS_ALUNOS = [
+    ("id_aluno", "ID"), ("nome_completo", "Nome"), ("cpf", "CPF"), ("email", "E-mail"),
+    ("celular", "Celular"), ("telefone", "Telefone"), ("data_nascimento", "Nascimento"),
+    ("tb_matriculas.codigo_turma", "Turma"), ("tb_matriculas.status_financeiro", "Financeiro"),
+    ("tb_matriculas.tb_turmas.tipo_turma", "Tipo de turma"), ("id_unidade", "Unidade"),
+]
+
+COLUNAS_LEADS = [
+    ("id", "ID"), ("nome", "Nome"), ("cpf", "CPF"), ("whatsapp", "WhatsApp"), ("workshop", "Workshop"),
+    ("data_agendada", "Data agendada"), ("status", "Status"), ("vendedor", "Vendedor"),
+    ("ja_e_aluno", "Já é aluno"), ("id_unidade", "Unidade"), ("created_at", "Criado em"),
+]
+
+COLUNAS_FESTAS = [
+    ("id", "ID"), ("data_festa", "Data"), ("horario", "Horário"), ("contratante", "Contratante"),
+    ("telefone", "Telefone"), ("aniversariante", "Aniversariante"), ("idade", "Idade"),
+    ("valor", "Valor"), ("kit_festa", "Kit festa"), ("data_pagamento", "Pagamento"),
+    ("status", "Status"), ("tb_colaboradores.nome_completo", "Vendedor"), ("tb_unidades.nome_unidade", "Unidade"),
+]
+
+COLUNAS_CHAMADAS = [
+    ("id", "ID"), ("data_aula", "Data"), ("codigo_turma", "Turma"), ("tb_turmas.nome_curso", "Curso"),
+    ("id_aluno", "ID aluno"), ("tb_alunos.nome_completo", "Aluno"), ("presenca", "Presença"),
+    ("id_professor", "ID professor"),
+]
+
+
+def _so_digitos(valor: str | None) -> str:
+    return "".join(filter(str.isdigit, valor or ""))
+
+
+@router.get("/exportar/alunos")
+def exportar_alunos(formato: str = "csv", acesso: politicas.Acesso = exigir("alunos.ler")):
+    def montar_query():
+        query = supabase.table("tb_alunos").select("*, tb_matriculas(codigo_turma, status_financeiro, tb_turmas(tipo_turma, dia_semana))")
+        return acesso.escopar(query)
+
+    linhas = exportacao.paginar(montar_query, "id_aluno")
+    return exportacao.resposta_exportacao("alunos", formato, linhas, COLUNAS_ALUNOS)
+
+
+@router.get("/exportar/leads")
+def exportar_leads(formato: str = "csv", filtro_unidade: int | None = None, acesso: politicas.Acesso = exigir("leads.ler")):
+    def montar_query():
+        return acesso.escopar(supabase.table("inscricoes").select("*"), id_unidade=filtro_unidade)
+
+    def com_ja_e_aluno():
+        # "Já é aluno" página a página: só os CPFs da página vão ao banco
+        for pagina in exportacao.paginas(exportacao.paginar(montar_query, "id")):
+            cpfs = {l['cpf'] for l in pagina if l.get('cpf')}
+            cpfs |= {_so_digitos(c) for c in cpfs if _so_digitos(c)}
+            alunos = set()
+            if cpfs:
+                resp = supabase.table("tb_alunos").select("cpf").in_("cpf", list(cpfs)).execute()
+                alunos = {_so_digitos(a['cpf']) for a in resp.data or [] if a.get('cpf')}
+            for l in pagina:
+                cpf_l = _so_digitos(l.get('cpf'))
+                l['ja_e_aluno'] = cpf_l != '' and cpf_l in alunos
+                l.setdefault('status', 'Pendente')
+                yield l
+
+    return exportacao.resposta_exportacao("leads", formato, com_ja_e_aluno(), COLUNAS_LEADS)
+
+
+@router.get("/exportar/festas")
+def exportar_festas(
+    formato: str = "csv",
+    status: Optional[str] = None,
+    q: Optional[str] = None,
+    data_ini: Optional[str] = None,
+    data_fim: Optional[str] = None,
+    id_vendedor: Optional[int] = None,
+    id_unidade: Optional[int] = None,
+    acesso: politicas.Acesso = exigir("festas.ler")
+):
+    def montar_query():
+        query = supabase.table("tb_festas_aniversario").select(
+            "*, tb_unidades!fk_festas_unidade(nome_unidade), tb_colaboradores!fk_festas_vendedor(nome_completo)"
+        )
+        if status:
+            query = query.eq("status", status)
+        if data_ini:
+            query = query.gte("data_festa", data_ini)
+        if data_fim:
+            query = query.lte("data_festa", data_fim)
+        if id_vendedor:
+            query = query.eq("id_vendedor", id_vendedor)
+        query = acesso.escopar(query, id_unidade=id_unidade)
+        if q:
+            query = query.or_(
+                f"contratante.ilike.%{q}%,aniversariante.ilike.%{q}%,telefone.ilike.%{q}%"
+            )
+        return query
+
+    linhas = exportacao.paginar(montar_query, "id")
+    return exportacao.resposta_exportacao("festas", formato, linhas, COLUNAS_FESTAS)
+
+
+@router.get("/exportar/chamadas")
+def exportar_chamadas(
+    formato: str = "csv",
+    codigo_turma: Optional[str] = None,
+    data_ini: Optional[str] = None,
+    data_fim: Optional[str] = None,
+    authorization: str = Header(None)
+):
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    ctx = get_contexto_usuario(token)
+
+    def montar_query():
+        # !inner: o filtro de unidade vale pela turma da chamada
+        query = supabase.table("tb_chamadas").select(
+            "*, tb_turmas!inner(nome_curso, id_unidade), tb_alunos(nome_completo)"
+        )
+        if ctx['nivel'] < 9:
+            query = query.eq("tb_turmas.id_unidade", ctx['id_unidade'])
+        if codigo_turma:
+            query = query.eq("codigo_turma", codigo_turma)
+        if data_ini:
+            query = query.gte("data_aula", data_ini)
+        if data_fim:
+            query = query.lte("data_aula", data_fim)
+        return query
+
+    linhas = exportacao.paginar(montar_query, "id")
+    return exportacao.resposta_exportacao("chamadas", formato, linhas, COLUNAS_CHAMADAS)
+
+
+# 10. ÁREA DO PROFESSOR
+
+# A tela inicial do professor é aberta várias vezes ao dia; 30s bastam para não repetir as consultas
+_cache_workspace = CacheCurto("workspace_professor", ttl=30)
+
+
+def _montar_workspace(id_professor: int, id_unidade: Optional[int]):
+    hoje = datetime.now().date()
+    inicio_semana = hoje - timedelta(days=hoje.weekday())
+    fim_semana = inicio_semana + timedelta(days=7)
+
+    def buscar_turmas():
+        query = supabase.table("tb_turmas")\
+            .select("codigo_turma, nome_curso, id_professor, dia_semana, horario, sala, data_inicio, qtd_aulas, id_unidade, status")\
+            .eq("id_professor", id_professor)\
+            .in_("status", ["Em Andamento", "Planejada"])
+        if id_unidade:
+            query = query.eq("id_unidade", id_unidade)
+        return query.order("codigo_turma").execute().data or []
+
+    def buscar_reposicoes():
+        # tb_reposicoes não tem unidade: o escopo vem do aluno, como nas turmas acima
+        query = supabase.table("tb_reposicoes")\
+            .select("*, tb_alunos!inner(nome_completo, id_unidade)" if id_unidade else "*, tb_alunos(nome_completo)")\
+            .eq("id_professor", id_professor)\
+            .gte("data_reposicao", inicio_semana.isoformat())\
+            .lt("data_reposicao", fim_semana.isoformat())
+        if id_unidade:
+            query = query.eq("tb_alunos.id_unidade", id_unidade)
+        return query.order("data_reposicao").execute().data or []
+
+    def buscar_nao_lidas():
+        # Mensagens privadas dos alunos para o professor ainda não lidas (contadores)
+        return supabase.table("tb_chat_nao_lidas")\
+            .select("id_aluno, qtd")\
+            .eq("id_colaborador", id_professor)\
+            .eq("para_equipe", True)\
+            .gt("qtd", 0)\
+            .execute().data or []
+
+    # 1ª rodada: nada depende de nada
+    r = paralelo.reunir(turmas=buscar_turmas, reposicoes=buscar_reposicoes, nao_lidas=buscar_nao_lidas)
+    turmas = r["turmas"]
+    codigos = [t["codigo_turma"] for t in turmas]
+
+    # 2ª rodada: alunos e frequência das turmas encontradas
+    alunos, freq = [], []
+    if codigos:
+        r2 = paralelo.reunir(
+            alunos=lambda: supabase.table("tb_matriculas")
+                .select("codigo_turma, id_aluno, tb_alunos(nome_completo)")
+                .in_("codigo_turma", codigos)
+                .execute().data or [],
+            freq=lambda: supabase.table("tb_frequencia_alunos")
+                .select("id_aluno, codigo_turma, total_aulas, presencas, taxa_presenca, faltas_consecutivas, reposicoes_pendentes, reposicoes_realizadas, reposicoes_faltou")
+                .in_("codigo_turma", codigos)
+                .execute().data or [],
+        )
+        alunos, freq = r2["alunos"], r2["freq"]
+
+    freq_por_aluno = {(f["id_aluno"], f["codigo_turma"]): f for f in freq}
+    nao_lidas = chat_nao_lidas.somar(r["nao_lidas"], "id_aluno")
+
+    alunos_por_turma = {c: [] for c in codigos}
+    for m in alunos:
+        f = freq_por_aluno.get((m["id_aluno"], m["codigo_turma"])) or {}
+        alunos_por_turma[m["codigo_turma"]].append({
+            "id_aluno": m["id_aluno"],
+            "nome": (m.get("tb_alunos") or {}).get("nome_completo"),
+            "taxa_presenca": f.get("taxa_presenca"),
+            "motivos_risco": frequencia.motivos_risco(f) if f else [],
+            "mensagens_nao_lidas": nao_lidas.get(m["id_aluno"], 0),
+        })
+
+    # 3ª rodada: calendário de cada turma (feriados/reposições por turma)
+    calendarios = paralelo.reunir(**{
+        f"t{i}": (lambda t=t: calendario.obter_calendario(supabase, t["codigo_turma"], t))
+        for i, t in enumerate(turmas)
+    })
+
+    aulas_hoje, aulas_semana = [], []
+    for i, t in enumerate(turmas):
+        t["alunos"] = sorted(alunos_por_turma[t["codigo_turma"]], key=lambda a: a["nome"] or "")
+        cal = calendarios[f"t{i}"] or {"aulas": []}
+        for aula in cal["aulas"]:
+            if not (inicio_semana.isoformat() <= aula["data"] < fim_semana.isoformat()):
+                continue
+            sessao = {
+                "codigo_turma": t["codigo_turma"],
+                "nome_curso": t.get("nome_curso"),
+                "sala": t.get("sala"),
+                "numero": aula["numero"],
+                "data": aula["data"],
+                "inicio": aula["inicio"],
+                "fim": aula["fim"],
+            }
+            aulas_semana.append(sessao)
+            if aula["data"] == hoje.isoformat():
+                aulas_hoje.append(sessao)
+    aulas_semana.sort(key=lambda s: s["inicio"] or s["data"])
+    aulas_hoje.sort(key=lambda s: s["inicio"] or s["data"])
+
+    reposicoes = [{
+        "id": rep["id"],
+        "data_reposicao": rep["data_reposicao"],
+        "nome_aluno": (rep.get("tb_alunos") or {}).get("nome_completo", "Aluno?"),
+        "id_aluno": rep.get("id_aluno"),
+        "turma": rep.get("codigo_turma"),
+        "conteudo": rep.get("conteudo_aula"),
+        "status": rep.get("status"),
+        "presenca": rep.get("presenca"),
+    } for rep in r["reposicoes"]]
+
+    return {
+        "id_professor": id_professor,
+        "gerado_em": datetime.now().isoformat(),
+        "turmas": turmas,
+        "hoje": {
+            "aulas": aulas_hoje,
+            "reposicoes": [x for x in reposicoes if x["data_reposicao"][:10] == hoje.isoformat()],
+        },
+        "semana": {
+            "inicio": inicio_semana.isoformat(),
+            "fim": (fim_semana - timedelta(days=1)).isoformat(),
+            "aulas": aulas_semana,
+            "reposicoes": reposicoes,
+        },
+        "chat": {
+            "nao_lidas": sum(nao_lidas.values()),
+            "por_aluno": nao_lidas,
+        },
+    }
+
+
+@router.get("/professor/workspace")
+def workspace_professor(id_professor: Optional[int] = None, authorization: str = Header(None)):
+    """Turmas ativas com alunos, aulas e reposições de hoje/da semana e chats não lidos, numa chamada só."""
+    if not authorization: raise HTTPException(status_code=401)
+    token = authorization.split(" ")[1]
+    ctx = get_contexto_usuario(token)
+
+    # Professor vê o próprio; Gerência/Diretoria pode abrir o de um professor (da unidade, se < 9)
+    if ctx['nivel'] == 5:
+        id_professor = ctx['id_colaborador']
+    elif ctx['nivel'] < 8:
+        raise HTTPException(status_code=403, detail="Acesso restrito a professores.")
+    elif not id_professor:
+        raise HTTPException(status_code=400, detail="Informe id_professor.")
+    id_unidade = ctx['id_unidade'] if ctx['nivel'] < 9 else None
+
+    try:
+        return _cache_workspace.obter(
+            chave_consulta("workspace", id_professor=id_professor, id_unidade=id_unidade),
+            lambda: _montar_workspace(id_professor, id_unidade)
+        )
     except Exception as e:
-        print("Erro editar festa:", e)
-        raise HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
+        logger.exception(f"Erro workspace professor: {e}")
+        raise HTTPException(status_code=500, detail="Erro ao montar a área do professor.")
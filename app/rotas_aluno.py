@@ -1,14 +1,27 @@
 from __future__ import annotations
 
+import gzip
+import hashlib
+import json
+import logging
 import os
 import re
 import unicodedata
 from datetime import datetime, timezone
 from typing import Any, Dict, List, Optional
 
-from fastapi import APIRouter, Header, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response
+from pydantic import BaseModel
 from supabase import create_client, Client
 
+from app import calendario, chat_grupo, paralelo, versoes_aula
+from app.carregador import Carregador
+from app.logs import definir_usuario
+from app.cache import CacheCurto, cache
+from app.singleflight import chave_consulta
+
+logger = logging.getLogger(__name__)
+
 # Mantém a mesma estratégia do projeto: backend acessa Supabase com key do servidor
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
@@ -21,6 +34,16 @@ supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 router = APIRouter(prefix="/aluno", tags=["aluno"])
 
+# Árvore didática: muitos alunos pedem ao mesmo tempo quando uma aula libera
+cache_cursos_didaticos = CacheCurto("cursos", ttl=float(os.getenv("CURSOS_CACHE_TTL", "60")))
+# Contexto do aluno (auth + matrículas) por token; invalidado quando a matrícula muda
+ALUNO_CONTEXTO_TTL = float(os.getenv("CONTEXTO_CACHE_TTL", "60"))
+
+
+def _carregador() -> Carregador:
+    # Depends cria um por requisição: memoização não vaza entre requisições
+    return Carregador(supabase)
+
 
 def _get_bearer_token(authorization: Optional[str]) -> str:
     if not authorization:
@@ -44,20 +67,33 @@ def _now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
-def _get_user_id_from_token(token: str) -> str:
+def _get_user_id_from_token(token: str, carregador: Optional[Carregador] = None) -> str:
     try:
-        user = supabase.auth.get_user(token)
-        return user.user.id
+        if carregador is not None:
+            user_id = carregador.usuario(token).id
+        else:
+            user_id = supabase.auth.get_user(token).user.id
+        definir_usuario(user_id)
+        return user_id
     except Exception:
         raise HTTPException(status_code=401, detail="Token inválido ou expirado")
 
 
 def _get_aluno_context(token: str) -> Dict[str, Any]:
+    ctx = cache.obter(
+        "aluno_contexto", hashlib.sha256(token.encode()).hexdigest(),
+        lambda: _montar_aluno_context(token), ALUNO_CONTEXTO_TTL
+    )
+    definir_usuario(ctx["user_id"])
+    return ctx
+
+
+def _montar_aluno_context(token: str) -> Dict[str, Any]:
     user_id = _get_user_id_from_token(token)
 
     aluno_resp = (
         supabase.table("tb_alunos")
-        .select("id_aluno, nome_completo")
+        .select("id_aluno, nome_completo, id_unidade")
         .eq("user_id", user_id)
         .execute()
     )
@@ -141,6 +177,7 @@ def _get_aluno_context(token: str) -> Dict[str, Any]:
         "user_id": user_id,
         "id_aluno": aluno["id_aluno"],
         "nome": aluno.get("nome_completo") or "",
+        "id_unidade": aluno.get("id_unidade"),
         "matriculas": matriculas,
         "turmas_by_codigo": turma_by_codigo,
         "cursos_by_slug": cursos_by_slug,
@@ -152,7 +189,13 @@ def _get_aluno_context(token: str) -> Dict[str, Any]:
 def _fetch_cursos_didaticos() -> List[Dict[str, Any]]:
     """
     Busca cursos com módulos e aulas aninhados, e normaliza a ordenação.
+    Chamadas simultâneas compartilham uma única consulta (single-flight + TTL curto);
+    cada chamador recebe sua própria cópia.
     """
+    return cache_cursos_didaticos.obter(chave_consulta("cursos", select="*, modulos(*, aulas(*))"), _buscar_cursos_didaticos)
+
+
+def _buscar_cursos_didaticos() -> List[Dict[str, Any]]:
     resp = supabase.table("cursos")        .select("*, modulos(*, aulas(*))")        .order("ordem")        .execute()
 
     cursos = resp.data or []
@@ -205,7 +248,10 @@ def curso_estrutura(curso_slug: str, authorization: Optional[str] = Header(None)
     """
     token = _get_bearer_token(authorization)
     ctx = _get_aluno_context(token)
+    return _montar_estrutura(ctx, curso_slug)
 
+
+def _montar_estrutura(ctx: Dict[str, Any], curso_slug: str) -> Dict[str, Any]:
     slug_req = _slugify(curso_slug)
     info = (ctx.get("cursos_by_slug") or {}).get(slug_req)
     if not info:
@@ -242,6 +288,15 @@ def curso_estrutura(curso_slug: str, authorization: Optional[str] = Header(None)
         dias_passados = 0
 
     aulas_liberadas = (dias_passados // 7) + 1
+
+    # Se a turma tem calendário (dia da semana + feriados), ele é a fonte da liberação
+    try:
+        cal = calendario.obter_calendario(supabase, str(turma.get("codigo_turma") or ""))
+        if cal and cal.get("aulas"):
+            aulas_liberadas = max(1, calendario.aulas_realizadas(cal))
+    except Exception as e:
+        logger.warning(f"Calendário indisponível para {turma.get('codigo_turma')}: {e}")
+
     if aulas_liberadas > total_aulas:
         aulas_liberadas = total_aulas
 
@@ -264,6 +319,103 @@ def curso_estrutura(curso_slug: str, authorization: Optional[str] = Header(None)
 
 
 
+# --- PACOTE OFFLINE ---
+# O app baixa de uma vez todas as aulas liberadas do curso (já com a versão do
+# professor da turma) e depois só sincroniza o que mudou, comparando hashes.
+
+class SincronizarCurso(BaseModel):
+    # {id_aula: conteudo_hash} do que o app já tem guardado
+    hashes: Dict[int, str] = {}
+    estrutura_hash: Optional[str] = None
+
+
+def _montar_pacote(ctx: Dict[str, Any], curso_slug: str) -> Dict[str, Any]:
+    curso = _montar_estrutura(ctx, curso_slug)
+    turma = (ctx.get("cursos_by_slug") or {})[_slugify(curso_slug)]["turma"]
+
+    liberadas: Dict[int, Dict[str, Any]] = {}
+    for m in curso.get("modulos", []) or []:
+        for a in m.get("aulas", []) or []:
+            conteudo = a.pop("conteudo", None) or ""
+            a.pop("conteudo_hash", None)
+            if a.get("liberada"):
+                liberadas[a["id"]] = {
+                    "id": a["id"],
+                    "titulo": a.get("titulo"),
+                    "conteudo": conteudo,
+                    "conteudo_hash": versoes_aula.hash_conteudo(conteudo),
+                }
+
+    # Versão do professor da turma, quando houver (uma consulta para todas as aulas)
+    if turma.get("id_professor") and liberadas:
+        copias = versoes_aula.conteudos_professor(supabase, list(liberadas), turma["id_professor"])
+        for id_aula, copia in copias.items():
+            liberadas[id_aula]["conteudo"] = copia["html"]
+            liberadas[id_aula]["conteudo_hash"] = copia["hash"]
+
+    # dias_passados muda todo dia sem que nada no curso mude
+    estavel = {k: v for k, v in curso.items() if k != "dias_passados"}
+    estrutura_hash = hashlib.sha256(
+        json.dumps(estavel, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+    return {"curso": curso, "estrutura_hash": estrutura_hash, "aulas": liberadas}
+
+
+def _resposta_compactada(dados: Dict[str, Any], request: Request, etag: Optional[str] = None) -> Response:
+    headers = {"Cache-Control": "private, no-cache", "Vary": "Accept-Encoding"}
+    if etag:
+        headers["ETag"] = f'"{etag}"'
+        if request.headers.get("if-none-match") == headers["ETag"]:
+            return Response(status_code=304, headers=headers)
+    corpo = json.dumps(dados, ensure_ascii=False, default=str).encode("utf-8")
+    if "gzip" in (request.headers.get("accept-encoding") or ""):
+        corpo = gzip.compress(corpo, compresslevel=6)
+        headers["Content-Encoding"] = "gzip"
+    return Response(content=corpo, media_type="application/json", headers=headers)
+
+
+@router.get("/curso/{curso_slug}/pacote")
+def baixar_pacote_curso(curso_slug: str, request: Request, authorization: Optional[str] = Header(None)):
+    """Estrutura + conteúdo de todas as aulas liberadas do curso, compactado (gzip)."""
+    token = _get_bearer_token(authorization)
+    ctx = _get_aluno_context(token)
+
+    pacote = _montar_pacote(ctx, curso_slug)
+    manifesto = {str(i): a["conteudo_hash"] for i, a in sorted(pacote["aulas"].items())}
+    versao = hashlib.sha256(
+        (pacote["estrutura_hash"] + json.dumps(manifesto, sort_keys=True)).encode("utf-8")
+    ).hexdigest()
+    return _resposta_compactada({
+        "versao": versao,
+        "gerado_em": _now_iso(),
+        "estrutura_hash": pacote["estrutura_hash"],
+        "curso": pacote["curso"],
+        "aulas": list(pacote["aulas"].values()),
+    }, request, etag=versao)
+
+
+@router.post("/curso/{curso_slug}/sincronizar")
+def sincronizar_curso(curso_slug: str, dados: SincronizarCurso, request: Request, authorization: Optional[str] = Header(None)):
+    """Devolve só as aulas novas/alteradas e os ids que o app deve apagar."""
+    token = _get_bearer_token(authorization)
+    ctx = _get_aluno_context(token)
+
+    pacote = _montar_pacote(ctx, curso_slug)
+    aulas = pacote["aulas"]
+    alteradas = [a for i, a in aulas.items() if dados.hashes.get(i) != a["conteudo_hash"]]
+    removidas = [i for i in dados.hashes if i not in aulas]
+
+    mudou_estrutura = dados.estrutura_hash != pacote["estrutura_hash"]
+    return _resposta_compactada({
+        "gerado_em": _now_iso(),
+        "estrutura_hash": pacote["estrutura_hash"],
+        # a estrutura só vai junto se mudou (liberação nova, título, ordem...)
+        "curso": pacote["curso"] if mudou_estrutura else None,
+        "alteradas": alteradas,
+        "removidas": removidas,
+    }, request)
+
+
 @router.get("/aula/{id_aula}")
 def obter_aula(id_aula: int, authorization: Optional[str] = Header(None)):
     token = _get_bearer_token(authorization)
@@ -282,6 +434,7 @@ def obter_aula(id_aula: int, authorization: Optional[str] = Header(None)):
 
         aula = aula_resp.data[0]
         conteudo = aula.get("conteudo") or ""
+        conteudo_hash = aula.get("conteudo_hash") or versoes_aula.hash_conteudo(conteudo)
 
         # aceita modulo_id ou id_modulo (caso seu banco use outro nome)
         modulo_id = aula.get("modulo_id") or aula.get("id_modulo")
@@ -324,21 +477,17 @@ def obter_aula(id_aula: int, authorization: Optional[str] = Header(None)):
         id_professor = turma.get("id_professor")
 
         if id_professor:
-            pers_resp = (
-                supabase.table("conteudos_personalizados")
-                .select("conteudo")
-                .eq("id_aula", id_aula)
-                .eq("id_professor", id_professor)
-                .limit(1)
-                .execute()
-            )
-            if pers_resp.data and pers_resp.data[0].get("conteudo"):
-                conteudo = pers_resp.data[0]["conteudo"]
+            personalizado = versoes_aula.conteudo_professor(supabase, id_aula, id_professor)
+            if personalizado:
+                conteudo = personalizado["html"]
+                conteudo_hash = personalizado["hash"]
 
         return {
             "id": aula.get("id"),
             "titulo": aula.get("titulo"),
             "conteudo": conteudo,
+            # estável enquanto o conteúdo não muda: o app pode usar como chave de cache
+            "conteudo_hash": conteudo_hash,
             "updated_at": _now_iso(),
         }
 
@@ -346,7 +495,7 @@ def obter_aula(id_aula: int, authorization: Optional[str] = Header(None)):
         raise
     except Exception as e:
         # Isso vai aparecer no Render Logs:
-        print("ERRO obter_aula:", repr(e))
+        logger.exception(f"ERRO obter_aula: {e!r}")
         raise HTTPException(status_code=500, detail=f"Erro interno obter_aula: {e}")
 
 from pydantic import BaseModel
@@ -362,29 +511,18 @@ class SenhaUpdate(BaseModel):
 
 
 @router.get("/perfil")
-def get_perfil(authorization: Optional[str] = Header(None)):
+def get_perfil(authorization: Optional[str] = Header(None), carregador: Carregador = Depends(_carregador)):
     token = _get_bearer_token(authorization)
-    user_id = _get_user_id_from_token(token)
+    user_id = _get_user_id_from_token(token, carregador)
 
-    # pega email do auth
-    try:
-        user = supabase.auth.get_user(token)
-        email = getattr(user.user, "email", None)
-    except Exception:
-        email = None
+    # pega email do auth (já carregado acima, não repete a chamada)
+    email = getattr(carregador.usuario(token), "email", None)
 
     # pega dados do aluno (select * pra não quebrar se seu schema variar)
-    aluno_resp = (
-        supabase.table("tb_alunos")
-        .select("*")
-        .eq("user_id", user_id)
-        .limit(1)
-        .execute()
-    )
-    if not aluno_resp.data:
+    aluno = carregador.linha("tb_alunos", "user_id", user_id)
+    if not aluno:
         raise HTTPException(status_code=404, detail="Aluno não encontrado")
 
-    aluno = aluno_resp.data[0]
     return {
         "email": email,
         "nome_completo": aluno.get("nome_completo") or "",
@@ -409,6 +547,8 @@ def update_perfil(payload: PerfilUpdate, authorization: Optional[str] = Header(N
 
     if update_data:
         supabase.table("tb_alunos").update(update_data).eq("user_id", user_id).execute()
+        if "nome_completo" in update_data:
+            chat_grupo.invalidar_identidade(user_id)
 
     # 2) atualiza email no auth (se enviado)
     if payload.email is not None and payload.email.strip():
@@ -421,15 +561,14 @@ def update_perfil(payload: PerfilUpdate, authorization: Optional[str] = Header(N
 
 
 @router.put("/senha")
-def update_senha(payload: SenhaUpdate, authorization: Optional[str] = Header(None)):
+def update_senha(payload: SenhaUpdate, authorization: Optional[str] = Header(None), carregador: Carregador = Depends(_carregador)):
     token = _get_bearer_token(authorization)
-    user_id = _get_user_id_from_token(token)
+    user_id = _get_user_id_from_token(token, carregador)
 
     # (opcional) valida senha atual
     if payload.senha_atual:
         try:
-            user = supabase.auth.get_user(token)
-            email = getattr(user.user, "email", None)
+            email = getattr(carregador.usuario(token), "email", None)
             if not email:
                 raise HTTPException(status_code=400, detail="Email do usuário não encontrado para validar senha atual")
 
@@ -447,3 +586,105 @@ def update_senha(payload: SenhaUpdate, authorization: Optional[str] = Header(Non
         raise HTTPException(status_code=400, detail=f"Erro ao atualizar senha: {e}")
 
     return {"ok": True}
+
+
+# --- HOME DO APP ---
+# Uma chamada só na abertura do app: cursos, perfil, contatos e chat. O aluno é
+# resolvido uma vez (contexto em cache) e as consultas restantes vão em paralelo.
+
+def _buscar_contatos(ctx: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Mesmos cards de /admin/aluno/meus-contatos, a partir do contexto já carregado."""
+    # uma turma por matrícula, da mais recente para a mais antiga
+    turmas = []
+    for m in ctx.get("matriculas") or []:
+        turma = ctx["turmas_by_codigo"].get(str(m.get("codigo_turma")).strip())
+        if turma and turma not in turmas:
+            turmas.append(turma)
+    ids_professores = list({t["id_professor"] for t in turmas if t.get("id_professor")})
+
+    def buscar_coords():
+        if not ctx.get("id_unidade"):
+            return []
+        return supabase.table("tb_colaboradores")\
+            .select("id_colaborador, nome_completo")\
+            .eq("id_unidade", ctx["id_unidade"])\
+            .eq("id_cargo", 4)\
+            .eq("ativo", True)\
+            .execute().data or []
+
+    def buscar_professores():
+        if not ids_professores:
+            return []
+        return supabase.table("tb_colaboradores").select("id_colaborador, nome_completo")\
+            .in_("id_colaborador", ids_professores).execute().data or []
+
+    r = paralelo.reunir(coords=buscar_coords, professores=buscar_professores)
+    professores = {p["id_colaborador"]: p for p in r["professores"]}
+
+    contatos = [{
+        "id": c["id_colaborador"],
+        "nome": c["nome_completo"],
+        "cargo": "Coordenador Pedagógico",
+        "tipo": "Coordenacao",
+        "codigo_turma_grupo": None,
+    } for c in r["coords"]]
+
+    professores_vistos = set()
+    for turma in turmas:
+        cod_turma = turma["codigo_turma"]
+        contatos.append({
+            "id": f"grupo-{cod_turma}",
+            "nome": f"Grupo {turma['nome_curso']}",
+            "cargo": f"Turma {cod_turma}",
+            "tipo": "Grupo",
+            "codigo_turma_grupo": cod_turma,
+        })
+        id_professor = turma.get("id_professor")
+        if id_professor in professores and id_professor not in professores_vistos:
+            professores_vistos.add(id_professor)
+            contatos.append({
+                "id": id_professor,
+                "nome": professores[id_professor]["nome_completo"],
+                "cargo": f"Prof. {turma['nome_curso']}",
+                "tipo": "Professor",
+                "codigo_turma_grupo": None,
+            })
+
+    contatos.append({"id": "geral", "nome": "Suporte Javis", "cargo": "Secretaria", "tipo": "Admin", "codigo_turma_grupo": None})
+    return contatos
+
+
+@router.get("/home")
+def home_aluno(authorization: Optional[str] = Header(None)):
+    """Tudo o que a tela inicial precisa: substitui meus-cursos, perfil, meus-contatos e /chat/historico."""
+    token = _get_bearer_token(authorization)
+    ctx = _get_aluno_context(token)
+
+    try:
+        r = paralelo.reunir(
+            usuario=lambda: supabase.auth.get_user(token).user,
+            aluno=lambda: supabase.table("tb_alunos").select("*").eq("id_aluno", ctx["id_aluno"]).limit(1).execute().data,
+            contatos=lambda: _buscar_contatos(ctx),
+            chat=lambda: supabase.table("tb_chat").select("*").eq("id_aluno", ctx["id_aluno"]).order("created_at").execute().data or [],
+        )
+    except Exception as e:
+        logger.exception(f"Erro home aluno: {e}")
+        raise HTTPException(status_code=500, detail="Erro ao carregar a tela inicial")
+
+    aluno = r["aluno"][0] if r["aluno"] else {}
+    chat = r["chat"]
+    return {
+        "nome": ctx.get("nome", "Aluno"),
+        "cursos": ctx.get("cursos", []),
+        "perfil": {
+            "email": getattr(r["usuario"], "email", None),
+            "nome_completo": aluno.get("nome_completo") or "",
+            "telefone": aluno.get("telefone") or "",
+        },
+        "contatos": r["contatos"],
+        "chat": {
+            "historico": chat,
+            # mensagens da equipe que o aluno ainda não leu
+            "nao_lidas": sum(1 for m in chat if m.get("enviado_por_admin") and not m.get("lida")),
+        },
+    }
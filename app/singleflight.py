@@ -0,0 +1,62 @@
+"""
+Coalescência de chamadas concorrentes idênticas (single-flight).
+
+Se várias requisições pedem o mesmo dado ao mesmo tempo, só a primeira vai ao
+Supabase; as outras esperam e recebem o mesmo resultado (ou a mesma exceção).
+O cache (app/cache.py) recarrega através daqui, então nem o cache frio nem a
+expiração de uma entrada viram uma avalanche de consultas iguais.
+
+As rotas são síncronas (rodam no threadpool), por isso a espera é com threading.
+"""
+import threading
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+def chave_consulta(nome: str, **filtros) -> Tuple:
+    """Chave normalizada: mesma consulta com filtros em outra ordem dá a mesma chave."""
+    return (nome,) + tuple(sorted((k, v) for k, v in filtros.items() if v is not None))
+
+
+class _Chamada:
+    __slots__ = ("evento", "resultado", "erro")
+
+    def __init__(self):
+        self.evento = threading.Event()
+        self.resultado = None
+        self.erro = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._em_voo: Dict[Hashable, _Chamada] = {}
+        self.compartilhadas = 0
+        self.executadas = 0
+
+    def executar(self, chave: Hashable, funcao: Callable[[], Any]) -> Any:
+        with self._lock:
+            chamada = self._em_voo.get(chave)
+            lider = chamada is None
+            if lider:
+                chamada = _Chamada()
+                self._em_voo[chave] = chamada
+                self.executadas += 1
+            else:
+                self.compartilhadas += 1
+
+        if not lider:
+            chamada.evento.wait()
+            if chamada.erro is not None:
+                raise chamada.erro
+            return chamada.resultado
+
+        try:
+            chamada.resultado = funcao()
+            return chamada.resultado
+        except BaseException as e:
+            chamada.erro = e
+            raise
+        finally:
+            with self._lock:
+                self._em_voo.pop(chave, None)
+            chamada.evento.set()
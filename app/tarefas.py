@@ -0,0 +1,129 @@
+"""
+Tarefas periódicas registradas no agendador (ver app/agendador.py).
+Importar este módulo registra as tarefas; o lifespan do main.py as inicia.
+"""
+import logging
+import os
+from datetime import datetime, timedelta
+
+from app import arquivo_chat, busca_chat, chat_nao_lidas, frequencia, ingestao, resumo_festas, uploads
+from app.agendador import agendador
+from app.rotas_admin import atualizar_snapshots_dashboard, enviar_mensagem_zapi, supabase
+
+logger = logging.getLogger(__name__)
+
+DASHBOARD_INTERVALO = int(os.getenv("DASHBOARD_INTERVALO", "300"))
+LEMBRETE_REPOSICAO_CRON = os.getenv("LEMBRETE_REPOSICAO_CRON", "0 18 * * *")
+INGESTAO_INTERVALO = float(os.getenv("INGESTAO_INTERVALO", "2"))
+RESUMO_FESTAS_CRON = os.getenv("RESUMO_FESTAS_CRON", "30 3 * * *")
+FREQUENCIA_CRON = os.getenv("FREQUENCIA_CRON", "0 4 * * *")
+CHAT_NAO_LIDAS_CRON = os.getenv("CHAT_NAO_LIDAS_CRON", "30 4 * * *")
+CHAT_INDICE_INTERVALO = float(os.getenv("CHAT_INDICE_INTERVALO", "10"))
+CHAT_ARQUIVO_CRON = os.getenv("CHAT_ARQUIVO_CRON", "0 5 * * *")
+UPLOADS_INTERVALO = float(os.getenv("UPLOADS_INTERVALO", "120"))
+
+
+@agendador.a_cada(DASHBOARD_INTERVALO, nome="snapshot_dashboard")
+def tarefa_snapshot_dashboard():
+    atualizar_snapshots_dashboard()
+
+
+@agendador.a_cada(INGESTAO_INTERVALO, nome="descarregar_inscricoes")
+def tarefa_descarregar_inscricoes():
+    """Envia ao Supabase, em lote, as inscrições gravadas no log local."""
+    ingestao.descarregar(supabase)
+
+
+@agendador.a_cada(CHAT_INDICE_INTERVALO, nome="indexar_chat")
+def tarefa_indexar_chat():
+    """Leva as mensagens novas do chat para o índice de busca."""
+    busca_chat.indexar(supabase)
+
+
+@agendador.a_cada(UPLOADS_INTERVALO, nome="retomar_uploads")
+def tarefa_retomar_uploads():
+    """Reenvia uploads parados no staging (falha transitória do Storage, reinício)."""
+    pendentes = uploads.retomar_pendentes(supabase)
+    if pendentes:
+        logger.info(f"Uploads retomados do staging: {pendentes}")
+
+
+@agendador.cron(CHAT_ARQUIVO_CRON, nome="arquivar_chat")
+def tarefa_arquivar_chat():
+    """Move mensagens antigas (ou de turmas encerradas) para o arquivo frio."""
+    movidas = arquivo_chat.arquivar(supabase)
+    logger.info(f"Chat arquivado: {movidas}")
+
+
+@agendador.cron(RESUMO_FESTAS_CRON, nome="reconstruir_resumo_festas")
+def tarefa_reconstruir_resumo_festas():
+    """Recalcula o resumo de festas inteiro (corrige alterações feitas fora da API)."""
+    grupos = resumo_festas.reconstruir(supabase)
+    logger.info(f"Resumo de festas reconstruído: {grupos} grupo(s)")
+
+
+@agendador.cron(FREQUENCIA_CRON, nome="reconstruir_frequencia")
+def tarefa_reconstruir_frequencia():
+    """Recalcula a frequência de todos os alunos (pega chamadas alteradas fora da API)."""
+    alunos = frequencia.reconstruir(supabase)
+    logger.info(f"Frequência recalculada: {alunos} aluno(s)")
+
+
+@agendador.cron(CHAT_NAO_LIDAS_CRON, nome="reconstruir_chat_nao_lidas")
+def tarefa_reconstruir_chat_nao_lidas():
+    """Reconta as não lidas do chat (pega mensagens gravadas/lidas fora da API)."""
+    conversas = chat_nao_lidas.reconstruir(supabase)
+    logger.info(f"Não lidas do chat recontadas: {conversas} conversa(s)")
+
+
+def _telefone_whatsapp(numero: str | None) -> str | None:
+    digitos = "".join(filter(str.isdigit, numero or ""))
+    if not digitos:
+        return None
+    # Z-API espera DDI + DDD + número
+    return digitos if len(digitos) > 11 else f"55{digitos}"
+
+
+@agendador.cron(LEMBRETE_REPOSICAO_CRON, nome="lembrete_reposicao")
+def tarefa_lembrete_reposicao():
+    """Avisa por WhatsApp os alunos com reposição agendada para amanhã."""
+    amanha = (datetime.now() + timedelta(days=1)).date()
+    depois = amanha + timedelta(days=1)
+
+    resp = supabase.table("tb_reposicoes")\
+        .select("id, data_reposicao, tb_alunos(nome_completo, celular)")\
+        .eq("status", "Agendada")\
+        .gte("data_reposicao", f"{amanha.isoformat()}T00:00")\
+        .lt("data_reposicao", f"{depois.isoformat()}T00:00")\
+        .is_("lembrete_enviado", "null")\
+        .execute()
+
+    enviados = 0
+    for rep in resp.data or []:
+        aluno = rep.get("tb_alunos") or {}
+        telefone = _telefone_whatsapp(aluno.get("celular"))
+        if not telefone:
+            continue
+
+        # Marca antes de enviar (update condicional): dois workers nunca mandam o mesmo lembrete
+        marcado = supabase.table("tb_reposicoes")\
+            .update({"lembrete_enviado": datetime.now().isoformat()})\
+            .eq("id", rep["id"])\
+            .is_("lembrete_enviado", "null")\
+            .execute()
+        if not marcado.data:
+            continue
+
+        nome = (aluno.get("nome_completo") or "").split(" ")[0].title() or "aluno(a)"
+        dt = datetime.fromisoformat(rep["data_reposicao"][:16])
+        mensagem = (
+            f"Olá, {nome}! Lembrete da Javis Games: sua aula de reposição é amanhã, "
+            f"{dt.strftime('%d/%m')} às {dt.strftime('%H:%M')}. Te esperamos!"
+        )
+        if enviar_mensagem_zapi(telefone, mensagem):
+            enviados += 1
+        else:
+            # Libera para a próxima execução tentar de novo
+            supabase.table("tb_reposicoes").update({"lembrete_enviado": None}).eq("id", rep["id"]).execute()
+
+    logger.info(f"Lembretes de reposição enviados: {enviados}")
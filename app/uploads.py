@@ -0,0 +1,225 @@
+"""
+Upload de arquivos em duas etapas.
+
+1. Na requisição: o arquivo é copiado em blocos para um diretório de staging
+   (com limite de tamanho e fsync) e a rota responde.
+2. Em segundo plano: imagens são reduzidas/recomprimidas num pool de processos,
+   uma miniatura é gerada e tudo é enviado ao Storage do Supabase.
+
+O nome final no Storage (e o content-type) só é decidido depois da otimização:
+`<base>.jpg` se virou JPEG, senão `<base>.<extensão original>`. Por isso a URL
+pública é gravada na linha indicada em `registrar` só depois do envio.
+
+Cada arquivo em staging tem um .json ao lado com os dados do envio. Antes de
+mexer no arquivo, quem processa o reivindica renomeando `<id>.bin` para
+`<id>.processando` (rename é atômico): a BackgroundTask da rota, o job de
+retentativa e os outros workers nunca enviam o mesmo arquivo duas vezes. Se o
+envio falha, o arquivo volta a `.bin`. `retomar_pendentes` roda pelo agendador
+e só pega o que está parado há UPLOAD_RETENTAR_APOS segundos (e `.processando`
+largado há UPLOAD_PROCESSANDO_MAX, de um worker que morreu no meio).
+"""
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from fastapi import HTTPException, UploadFile
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_STAGING_DIR = Path(os.getenv("UPLOAD_STAGING_DIR", "uploads_staging"))
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(15 * 1024 * 1024)))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+UPLOAD_RETENTAR_APOS = float(os.getenv("UPLOAD_RETENTAR_APOS", "300"))
+UPLOAD_PROCESSANDO_MAX = float(os.getenv("UPLOAD_PROCESSANDO_MAX", "1800"))
+IMAGEM_MAX_LADO = int(os.getenv("IMAGEM_MAX_LADO", "2000"))
+IMAGEM_QUALIDADE = int(os.getenv("IMAGEM_QUALIDADE", "80"))
+THUMB_LADO = 400
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow é opcional: sem ele o arquivo sobe sem otimização
+    Image = None
+
+_pool: ProcessPoolExecutor | None = None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=int(os.getenv("UPLOAD_PROCESSOS", "2")))
+    return _pool
+
+
+def eh_imagem_otimizavel(content_type: str | None) -> bool:
+    return Image is not None and (content_type or "").startswith("image/")
+
+
+def salvar_em_staging(arquivo: UploadFile, bucket: str, base: str, thumb: bool = False,
+                      registrar: dict | None = None) -> Path:
+    """
+    Copia o upload em blocos para o staging (sem carregar tudo na memória).
+    Levanta 413 se passar de UPLOAD_MAX_BYTES.
+
+    `base` é o nome no Storage sem extensão; `thumb` pede a miniatura
+    `<base>_thumb.jpg` (só quando a imagem é otimizada). `registrar` =
+    {"tabela", "coluna", "id_coluna", "id"}: onde gravar a URL pública no final.
+    """
+    UPLOAD_STAGING_DIR.mkdir(parents=True, exist_ok=True)
+    caminho = UPLOAD_STAGING_DIR / f"{uuid.uuid4().hex}.bin"
+    total = 0
+    try:
+        with open(caminho, "wb") as f:
+            while True:
+                bloco = arquivo.file.read(UPLOAD_CHUNK_BYTES)
+                if not bloco:
+                    break
+                total += len(bloco)
+                if total > UPLOAD_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail="Arquivo muito grande.")
+                f.write(bloco)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        caminho.unlink(missing_ok=True)
+        raise
+
+    meta = {
+        "bucket": bucket,
+        "base": base,
+        "extensao": Path(arquivo.filename or "").suffix.lstrip(".").lower(),
+        "thumb": thumb,
+        "content_type": arquivo.content_type,
+        "registrar": registrar,
+    }
+    meta_path = caminho.with_suffix(".json")
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+    return caminho
+
+
+def otimizar_imagem(origem: str, saida: str, thumb: str | None) -> bool:
+    """Roda no pool de processos: reduz, recomprime em JPEG e gera a miniatura."""
+    if Image is None:
+        return False
+    with Image.open(origem) as img:
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        img.thumbnail((IMAGEM_MAX_LADO, IMAGEM_MAX_LADO))
+        img.save(saida, "JPEG", quality=IMAGEM_QUALIDADE, optimize=True, progressive=True)
+        if thumb:
+            img.thumbnail((THUMB_LADO, THUMB_LADO))
+            img.save(thumb, "JPEG", quality=70, optimize=True)
+    return True
+
+
+def _reivindicar(caminho: Path) -> Path | None:
+    """Renomeia para .processando (atômico). None = outro processo chegou antes."""
+    processando = caminho.with_suffix(".processando")
+    try:
+        os.rename(caminho, processando)
+    except FileNotFoundError:
+        return None
+    # mtime = início do processamento (usado para achar processamento largado)
+    os.utime(processando)
+    return processando
+
+
+def _liberar(processando: Path) -> None:
+    """Devolve para a fila de retentativa (mtime = hora da falha)."""
+    pendente = processando.with_suffix(".bin")
+    try:
+        os.rename(processando, pendente)
+        os.utime(pendente)
+    except FileNotFoundError:
+        pass
+
+
+def processar_staging(cliente, caminho: Path) -> None:
+    """Otimiza (se for imagem) e envia ao Storage; limpa o staging no final."""
+    processando = _reivindicar(caminho)
+    if processando is None:
+        return
+    meta_path = caminho.with_suffix(".json")
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+    except (FileNotFoundError, ValueError) as e:
+        logger.warning(f"Upload em staging sem dados do envio, descartado: {caminho.name} ({e})")
+        processando.unlink(missing_ok=True)
+        meta_path.unlink(missing_ok=True)
+        return
+
+    saida = caminho.with_suffix(".opt.jpg")
+    thumb = caminho.with_suffix(".thumb.jpg")
+    base = meta["base"]
+    try:
+        otimizada = False
+        if eh_imagem_otimizavel(meta.get("content_type")):
+            try:
+                otimizada = _get_pool().submit(
+                    otimizar_imagem, str(processando), str(saida), str(thumb) if meta.get("thumb") else None
+                ).result()
+            except Exception as e:
+                logger.warning(f"Falha ao otimizar imagem {base} (enviando original): {e}")
+
+        # Nome e content-type conforme o que de fato vai subir
+        if otimizada:
+            enviar, destino, content_type = saida, f"{base}.jpg", "image/jpeg"
+        else:
+            extensao = meta.get("extensao")
+            enviar, destino, content_type = processando, f"{base}.{extensao}" if extensao else base, meta.get("content_type")
+
+        storage = cliente.storage.from_(meta["bucket"])
+        # Passa o caminho (o cliente abre o arquivo em streaming)
+        storage.upload(destino, str(enviar), file_options={"content-type": content_type, "upsert": "true"})
+        if otimizada and meta.get("thumb"):
+            storage.upload(f"{base}_thumb.jpg", str(thumb), file_options={"content-type": "image/jpeg", "upsert": "true"})
+
+        registrar = meta.get("registrar")
+        if registrar:
+            cliente.table(registrar["tabela"])\
+                .update({registrar["coluna"]: storage.get_public_url(destino)})\
+                .eq(registrar["id_coluna"], registrar["id"]).execute()
+
+        meta_path.unlink(missing_ok=True)
+        processando.unlink(missing_ok=True)
+    except Exception as e:
+        # Volta para o staging: o job de retentativa tenta de novo mais tarde
+        logger.exception(f"Erro ao enviar upload {base}: {e}")
+        _liberar(processando)
+    finally:
+        saida.unlink(missing_ok=True)
+        thumb.unlink(missing_ok=True)
+
+
+def retomar_pendentes(cliente) -> int:
+    """
+    Reenvia o que está parado no staging (job periódico). Retorna quantos pegou.
+    Arquivos recentes ficam com a BackgroundTask da rota que os recebeu.
+    """
+    if not UPLOAD_STAGING_DIR.exists():
+        return 0
+    agora = time.time()
+    # processamento largado por um worker que morreu no meio volta para a fila
+    for processando in UPLOAD_STAGING_DIR.glob("*.processando"):
+        try:
+            if agora - processando.stat().st_mtime > UPLOAD_PROCESSANDO_MAX:
+                _liberar(processando)
+        except FileNotFoundError:
+            pass
+
+    total = 0
+    for caminho in sorted(UPLOAD_STAGING_DIR.glob("*.bin")):
+        try:
+            if agora - caminho.stat().st_mtime < UPLOAD_RETENTAR_APOS:
+                continue
+        except FileNotFoundError:
+            continue
+        processar_staging(cliente, caminho)
+        total += 1
+    return total
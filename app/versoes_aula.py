@@ -0,0 +1,184 @@
+"""
+Conteúdo das aulas endereçado por hash (sha256 do HTML).
+
+- `aula_conteudos` (hash PK, conteudo, tamanho, criado_em): cada corpo distinto
+  aparece uma vez só, não importa quantas aulas/professores apontem para ele;
+- `aula_versoes` (id_aula, id_professor, hash, autor, criado_em): histórico
+  append-only. id_professor nulo = conteúdo base da coordenação;
+- `aulas.conteudo_hash` e `conteudos_personalizados.conteudo_hash` apontam para
+  a versão atual. A base continua com `aulas.conteudo` preenchido (a árvore
+  didática e /conteudo-aula leem direto dali); a cópia do professor guarda só o
+  hash, e se ficar igual à base ela é removida.
+
+Linhas antigas sem hash continuam funcionando: o hash é calculado na leitura.
+Como o corpo de um hash nunca muda, ele fica em cache sem prazo curto.
+"""
+import hashlib
+import logging
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from app.cache import cache
+
+logger = logging.getLogger(__name__)
+
+CONTEUDO_CACHE_TTL = float(os.getenv("CONTEUDO_CACHE_TTL", "86400"))
+
+
+def hash_conteudo(conteudo: Optional[str]) -> str:
+    return hashlib.sha256((conteudo or "").encode("utf-8")).hexdigest()
+
+
+def guardar_conteudo(cliente, conteudo: str) -> str:
+    """Grava o corpo (se ainda não existe) e devolve o hash."""
+    h = hash_conteudo(conteudo)
+    cliente.table("aula_conteudos").upsert({
+        "hash": h,
+        "conteudo": conteudo,
+        "tamanho": len(conteudo.encode("utf-8")),
+        "criado_em": datetime.now().isoformat(),
+    }, on_conflict="hash", ignore_duplicates=True).execute()
+    cache.set("aula_conteudo", h, conteudo, CONTEUDO_CACHE_TTL)
+    return h
+
+
+def ler_conteudo(cliente, h: str) -> Optional[str]:
+    def buscar():
+        resp = cliente.table("aula_conteudos").select("conteudo").eq("hash", h).limit(1).execute()
+        return resp.data[0]["conteudo"] if resp.data else None
+    return cache.obter("aula_conteudo", h, buscar, CONTEUDO_CACHE_TTL)
+
+
+def _registrar_versao(cliente, id_aula: int, id_professor: Optional[int], h: str, autor: Optional[int]) -> None:
+    cliente.table("aula_versoes").insert({
+        "id_aula": id_aula,
+        "id_professor": id_professor,
+        "hash": h,
+        "autor": autor,
+        "criado_em": datetime.now().isoformat(),
+    }).execute()
+
+
+def _tem_historico(cliente, id_aula: int, id_professor: Optional[int]) -> bool:
+    query = cliente.table("aula_versoes").select("id").eq("id_aula", id_aula)
+    query = query.is_("id_professor", "null") if id_professor is None else query.eq("id_professor", id_professor)
+    return bool(query.limit(1).execute().data)
+
+
+# --- LEITURA ---
+
+def conteudo_base(cliente, id_aula: int) -> Dict[str, Any]:
+    """{"html", "hash"} da aula base (hash None se a aula não tem conteúdo)."""
+    resp = cliente.table("aulas").select("conteudo, conteudo_hash").eq("id", id_aula).limit(1).execute()
+    if not resp.data or not resp.data[0].get("conteudo"):
+        return {"html": "", "hash": None}
+    linha = resp.data[0]
+    return {"html": linha["conteudo"], "hash": linha.get("conteudo_hash") or hash_conteudo(linha["conteudo"])}
+
+
+def conteudo_professor(cliente, id_aula: int, id_professor: int) -> Optional[Dict[str, Any]]:
+    """{"html", "hash"} da cópia do professor, ou None se ele usa a base."""
+    resp = cliente.table("conteudos_personalizados")\
+        .select("conteudo, conteudo_hash")\
+        .eq("id_aula", id_aula)\
+        .eq("id_professor", id_professor)\
+        .limit(1)\
+        .execute()
+    if not resp.data:
+        return None
+    linha = resp.data[0]
+    if linha.get("conteudo_hash"):
+        html = ler_conteudo(cliente, linha["conteudo_hash"])
+        if html:
+            return {"html": html, "hash": linha["conteudo_hash"]}
+    if linha.get("conteudo"):
+        # cópia antiga, gravada antes do versionamento
+        return {"html": linha["conteudo"], "hash": hash_conteudo(linha["conteudo"])}
+    return None
+
+
+def conteudos_professor(cliente, ids_aulas: List[int], id_professor: int) -> Dict[int, Dict[str, Any]]:
+    """Cópias do professor para várias aulas numa consulta só: {id_aula: {"html", "hash"}}."""
+    if not ids_aulas:
+        return {}
+    resp = cliente.table("conteudos_personalizados")\
+        .select("id_aula, conteudo, conteudo_hash")\
+        .in_("id_aula", ids_aulas)\
+        .eq("id_professor", id_professor)\
+        .execute()
+    res = {}
+    for linha in resp.data or []:
+        html = ler_conteudo(cliente, linha["conteudo_hash"]) if linha.get("conteudo_hash") else None
+        if html:
+            res[linha["id_aula"]] = {"html": html, "hash": linha["conteudo_hash"]}
+        elif linha.get("conteudo"):
+            res[linha["id_aula"]] = {"html": linha["conteudo"], "hash": hash_conteudo(linha["conteudo"])}
+    return res
+
+
+# --- ESCRITA ---
+
+def salvar_base(cliente, id_aula: int, conteudo: str, autor: Optional[int] = None) -> str:
+    atual = conteudo_base(cliente, id_aula)
+    h = guardar_conteudo(cliente, conteudo)
+    if atual["hash"] == h:
+        return h
+    # primeira edição versionada: o conteúdo que já estava lá vira a versão inicial
+    if atual["hash"] and not _tem_historico(cliente, id_aula, None):
+        guardar_conteudo(cliente, atual["html"])
+        _registrar_versao(cliente, id_aula, None, atual["hash"], None)
+    cliente.table("aulas").update({"conteudo": conteudo, "conteudo_hash": h}).eq("id", id_aula).execute()
+    _registrar_versao(cliente, id_aula, None, h, autor)
+    return h
+
+
+def salvar_professor(cliente, id_aula: int, id_professor: int, conteudo: str) -> Dict[str, Any]:
+    """Grava a cópia do professor. Igual à base: a cópia é descartada (volta a usar a base)."""
+    atual = conteudo_professor(cliente, id_aula, id_professor)
+    h = guardar_conteudo(cliente, conteudo)
+    if atual and atual["hash"] == h:
+        return {"hash": h, "tipo": "personalizado"}
+
+    if atual and not _tem_historico(cliente, id_aula, id_professor):
+        guardar_conteudo(cliente, atual["html"])
+        _registrar_versao(cliente, id_aula, id_professor, atual["hash"], id_professor)
+
+    if h == conteudo_base(cliente, id_aula)["hash"]:
+        if atual:
+            cliente.table("conteudos_personalizados").delete()\
+                .eq("id_aula", id_aula).eq("id_professor", id_professor).execute()
+            _registrar_versao(cliente, id_aula, id_professor, h, id_professor)
+        return {"hash": h, "tipo": "base"}
+
+    # Requer que a tabela tenha constraint unique(id_aula, id_professor)
+    cliente.table("conteudos_personalizados").upsert({
+        "id_aula": id_aula,
+        "id_professor": id_professor,
+        "conteudo": None,
+        "conteudo_hash": h,
+    }, on_conflict="id_aula,id_professor").execute()
+    _registrar_versao(cliente, id_aula, id_professor, h, id_professor)
+    return {"hash": h, "tipo": "personalizado"}
+
+
+def historico(cliente, id_aula: int, id_professor: Optional[int] = None, limite: int = 50) -> List[dict]:
+    query = cliente.table("aula_versoes")\
+        .select("id, id_professor, hash, autor, criado_em, aula_conteudos(tamanho)")\
+        .eq("id_aula", id_aula)
+    query = query.is_("id_professor", "null") if id_professor is None else query.eq("id_professor", id_professor)
+    versoes = query.order("criado_em", desc=True).order("id", desc=True).limit(limite).execute().data or []
+    for v in versoes:
+        v["tamanho"] = (v.pop("aula_conteudos", None) or {}).get("tamanho")
+    return versoes
+
+
+def versao_no_historico(cliente, id_aula: int, h: str, id_professor: Optional[int] = None) -> bool:
+    """
+    O hash é uma versão desta aula? Com `id_professor`, só vale a base ou a cópia
+    dele (o que ele enxerga); sem, qualquer versão da aula.
+    """
+    query = cliente.table("aula_versoes").select("id").eq("id_aula", id_aula).eq("hash", h)
+    if id_professor is not None:
+        query = query.or_(f"id_professor.is.null,id_professor.eq.{int(id_professor)}")
+    return bool(query.limit(1).execute().data)
@@ -1,6 +1,9 @@
+import asyncio
 import os
+import time
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Header
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Header, Request
 from fastapi.middleware.cors import CORSMiddleware 
 from supabase import create_client, Client
 import requests 
@@ -16,22 +19,37 @@ from app.modelos import (
 )
 from app.rotas_admin import router as admin_router
 from app.rotas_aluno import router as aluno_router
-
-# Configuração básica do Logger
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler("app.log"),
-        logging.StreamHandler()
-    ]
-)
+from app.jogos import router as jogos_router
+from app.logs import configurar_logs, iniciar_requisicao, parar_logs
+from app.agendador import agendador
+from app import tarefas  # registra as tarefas periódicas no agendador
+from app import chat_nao_lidas, duplicidade, ingestao
+from app.limitador import limitador
+
+# Logger: JSON via fila + thread de escrita (ver app/logs.py)
+configurar_logs()
 logger = logging.getLogger(__name__)
 
 # 1. Carrega as variáveis de ambiente
 load_dotenv()
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Inscrições que ficaram no log local (reinício antes do envio)
+    try:
+        reenviadas = await asyncio.to_thread(ingestao.descarregar_tudo, supabase)
+        if reenviadas:
+            logger.info(f"Inscrições reenviadas do log local: {reenviadas}")
+    except Exception as e:
+        logger.exception(f"Erro ao reenviar inscrições pendentes: {e}")
+    await agendador.iniciar()
+    yield
+    await agendador.parar()
+    parar_logs()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # 2. Configura o CORS
 app.add_middleware(
@@ -42,6 +60,28 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+@app.middleware("http")
+async def log_requisicoes(request: Request, call_next):
+    # Cada requisição registra rota, usuário e duração (amostrado, alto volume)
+    caixa = iniciar_requisicao(f"{request.method} {request.url.path}")
+    inicio = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        duracao_ms = round((time.perf_counter() - inicio) * 1000, 1)
+        nivel = logging.WARNING if status >= 500 else logging.INFO
+        logger.log(nivel, "requisicao", extra={
+            "metodo": request.method,
+            "usuario": caixa["usuario"],
+            "status": status,
+            "duracao_ms": duracao_ms,
+            "amostrar": True,
+        })
+
 # 3. Configura o Supabase
 url = os.getenv("SUPABASE_URL")
 key = os.getenv("SUPABASE_KEY")
@@ -69,6 +109,7 @@ MAPA_CURSOS = {
 # Incluir rotas administrativas
 app.include_router(admin_router)
 app.include_router(aluno_router)
+app.include_router(jogos_router)
 
 
 # --- FUNÇÕES AUXILIARES ---
@@ -80,7 +121,7 @@ def enviar_mensagem_zapi(telefone_destino: str, mensagem_texto: str):
         response = requests.post(ZAPI_BASE_URL, json=payload, headers=headers)
         return response.status_code == 200
     except Exception as e:
-        print(f"Erro Z-API: {e}")
+        logger.exception(f"Erro Z-API: {e}")
         return False
 
 
@@ -101,12 +142,12 @@ def get_historico_aluno(authorization: str = Header(None)):
         msgs = supabase.table("tb_chat").select("*").eq("id_aluno", id_aluno).order("created_at").execute()
         return msgs.data
     except Exception as e:
-        print(e)
+        logger.exception(f"Erro historico aluno: {e}")
         return []
 
 
 @app.post("/chat/enviar-aluno")
-def enviar_msg_aluno(dados: ChatMensagemData, authorization: str = Header(None)):
+def enviar_msg_aluno(dados: ChatMensagemData, background_tasks: BackgroundTasks, authorization: str = Header(None)):
     if not authorization:
         raise HTTPException(status_code=401)
     try:
@@ -122,6 +163,7 @@ def enviar_msg_aluno(dados: ChatMensagemData, authorization: str = Header(None))
             "mensagem": dados.mensagem,
             "enviado_por_admin": False
         }).execute()
+        background_tasks.add_task(chat_nao_lidas.registrar_mensagem, supabase, id_aluno, None, False)
         return {"message": "Enviado"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -135,35 +177,60 @@ def enviar_mensagem_chat(dados: MensagemChat):
 
 
 @app.post("/login")
-def realizar_login(dados: LoginData):
-    try:
-        response = supabase.auth.sign_in_with_password({"email": dados.email, "password": dados.password})
-        return {"token": response.session.access_token, "user": {"email": response.user.email}}
-    except:
-        raise HTTPException(status_code=400, detail="Email ou senha incorretos")
+def realizar_login(dados: LoginData, request: Request):
+    with limitador.controlar(request, "login", email=dados.email):
+        try:
+            response = supabase.auth.sign_in_with_password({"email": dados.email, "password": dados.password})
+            return {"token": response.session.access_token, "user": {"email": response.user.email}}
+        except:
+            raise HTTPException(status_code=400, detail="Email ou senha incorretos")
 
 
 @app.post("/recuperar-senha")
-def recuperar_senha(dados: EmailData):
-    try:
-        supabase.auth.reset_password_email(dados.email)
-        return {"message": "Email enviado"}
-    except:
-        raise HTTPException(status_code=400)
+def recuperar_senha(dados: EmailData, request: Request):
+    with limitador.controlar(request, "recuperar-senha", email=dados.email):
+        try:
+            supabase.auth.reset_password_email(dados.email)
+            return {"message": "Email enviado"}
+        except:
+            raise HTTPException(status_code=400)
 
 
-@app.post("/cadastrar")
-def realizar_cadastro(dados: InscricaoAulaData):
+def _marcar_duplicidade(nome: str, email: str, telefone: str | None) -> dict:
+    """Aluno provável por trás da inscrição (só para a equipe; nada disso volta na resposta)."""
     try:
-        supabase.table("tb_inscricoes").insert({
-            "nome": dados.nome,
-            "email": dados.email,
-            "telefone": dados.telefone,
-            "nascimento": dados.nascimento,
-            "cidade": dados.cidade,
-            "aceitou_termos": dados.aceitou_termos,
-            "status": "PENDENTE"
-        }).execute()
-        return {"message": "Inscrição realizada"}
+        # Rota pública: sem índice pronto não espera a montagem, só a dispara
+        indice = duplicidade.obter_indice(supabase, esperar=False)
+        achado = indice.melhor(duplicidade.registro(nome=nome, email=email, telefones=(telefone,))) if indice else None
     except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+        logger.exception(f"Erro na verificação de duplicidade: {e}")
+        achado = None
+    if not achado:
+        return {}
+    return {"id_aluno_provavel": achado["id_aluno"], "score_duplicidade": achado["score"]}
+
+
+@app.post("/cadastrar", status_code=202)
+def realizar_cadastro(dados: InscricaoAulaData, request: Request):
+    with limitador.controlar(request, "cadastrar", email=dados.email):
+        nome = (dados.nome or "").strip()
+        email = (dados.email or "").strip().lower()
+        if not nome or not email:
+            raise HTTPException(status_code=400, detail="Nome e e-mail são obrigatórios")
+        try:
+            payload = {
+                "nome": nome,
+                "email": email,
+                "telefone": dados.telefone,
+                "nascimento": dados.nascimento,
+                "cidade": dados.cidade,
+                "aceitou_termos": dados.aceitou_termos,
+                "status": "PENDENTE"
+            }
+            payload.update(_marcar_duplicidade(nome, email, dados.telefone))
+            # Grava no log local e responde; o envio ao Supabase é feito em lote (app/ingestao.py)
+            protocolo = ingestao.enfileirar("tb_inscricoes", payload)
+            return {"message": "Inscrição recebida", "protocolo": protocolo}
+        except Exception as e:
+            logger.exception(f"Erro ao registrar inscrição: {e}")
+            raise HTTPException(status_code=503, detail="Não foi possível registrar a inscrição agora")